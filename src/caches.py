@@ -0,0 +1,184 @@
+"""
+Caches of the repairs and of the predictions of the error rules, each with an
+in-memory LRU tier and an optional on-disk (sqlite) tier.
+"""
+
+import hashlib
+from os import getpid
+from collections import OrderedDict
+from threading import Lock
+
+
+class TwoTierCache():
+    """
+    Cache of the values of a few tables, each with an in-memory LRU tier of
+    max_size values and an optional on-disk (sqlite) tier at path, which can be
+    shared by processes. Each process has its own sqlite connection (see
+    check_process). The on-disk tier outlives whatever computed its values, so
+    the keys include the given version (e.g. a hash of the grammar or of the
+    model), and a stale entry is simply never looked up again.
+    """
+
+    TABLES = []
+
+    def __init__(self, max_size=4096, path=None, version=''):
+        self.max_size = max_size
+        self.path = path
+        self.version = version
+        self.entries = dict((table, OrderedDict()) for table in self.TABLES)
+        self.hits = dict((table, 0) for table in self.TABLES)
+        self.disk_hits = dict((table, 0) for table in self.TABLES)
+        self.misses = dict((table, 0) for table in self.TABLES)
+        self.evictions = dict((table, 0) for table in self.TABLES)
+        self.lock = Lock()
+        self.pid = getpid()
+        self.db = None
+        if path is not None:
+            # sqlite is only needed for the on-disk tier
+            import sqlite3
+            self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+            for table in self.TABLES:
+                self.db.execute("CREATE TABLE IF NOT EXISTS " + table + " (key TEXT PRIMARY KEY, value BLOB)")
+            self.db.commit()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def __getstate__(self):
+        # Only the bounds, the on-disk tier and the version are sent to other processes
+        return (self.max_size, self.path, self.version)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def check_process(self):
+        # sqlite connections cannot be used across fork(), so a forked copy of
+        # the cache starts over in the new process, like a pickled one (with
+        # its own connection, lock and in-memory tier). The inherited
+        # connection is kept, but never used (or closed), by the new process
+        if self.pid != getpid():
+            inherited_db = self.db
+            self.__init__(self.max_size, self.path, self.version)
+            self.inherited_db = inherited_db
+
+    def key(self, *contents):
+        """
+        Returns the key of the given contents (strings or bytes) for the
+        version of the cache.
+        """
+        digest = hashlib.sha256(self.version.encode('utf-8'))
+        for content in contents:
+            digest.update(b'\0')
+            digest.update(content if isinstance(content, bytes) else content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, table, key):
+        """
+        Returns whether the given key of the table is cached and its value.
+        """
+        self.check_process()
+        entries = self.entries[table]
+        with self.lock:
+            if key in entries:
+                entries.move_to_end(key)
+                self.hits[table] += 1
+                return True, entries[key]
+            if self.db is not None:
+                # (the value is the last column, whatever its name in older files)
+                row = self.db.execute("SELECT * FROM " + table + " WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits[table] += 1
+                    self.add(table, key, row[-1])
+                    return True, row[-1]
+            self.misses[table] += 1
+            return False, None
+
+    def store(self, table, key, value):
+        self.check_process()
+        with self.lock:
+            self.add(table, key, value)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO " + table + " VALUES (?, ?)", (key, value))
+                self.db.commit()
+
+    def add(self, table, key, value):
+        entries = self.entries[table]
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions[table] += 1
+
+    def table_stats(self, table):
+        """
+        Returns the counters of the given table.
+        """
+        with self.lock:
+            hits, disk_hits, misses = self.hits[table], self.disk_hits[table], self.misses[table]
+            lookups = hits + disk_hits + misses
+            return {"size": len(self.entries[table]), "hits": hits, "disk_hits": disk_hits,
+                    "misses": misses, "evictions": self.evictions[table],
+                    "hit_rate": (hits + disk_hits) / lookups if lookups else 0.0}
+
+
+class RepairCache(TwoTierCache):
+    """
+    Cache of the repairs (the fixed_seq_ops of fixed_lexed_prog), keyed by a
+    hash of the abstract token sequence of the program, its set of error rules,
+    the maximum cost and the parsing strategy (as "passes" and "agenda" can
+    find different repairs), so that a resubmitted program only needs
+    repair_prog for its own actual tokens. Its version should be the digest of
+    the grammar (Grammar.digest), as the repairs depend on it.
+    """
+
+    TABLES = ['repairs']
+
+    def key(self, tokns, erules, max_cost, strategy="passes"):
+        """
+        Returns the key of the given (normalised) abstract token sequence,
+        error rules, maximum cost and parsing strategy.
+        """
+        return super().key(strategy, str(max_cost), '\n'.join(sorted(set(erules))), ' '.join(tokns.split()))
+
+    def get(self, key):
+        """
+        Returns whether the given key is cached and its repair operations (None
+        if the program has no repair).
+        """
+        return self.lookup('repairs', key)
+
+    def put(self, key, fixed_seq_ops):
+        self.store('repairs', key, fixed_seq_ops)
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        return self.table_stats('repairs')
+
+
+class PredictionCache(TwoTierCache):
+    """
+    LRU caches of the two stages of the prediction, i.e. from the token
+    sequence of a program to its abstracted (partial parse) sequence ('seqs')
+    and from the padded token ids to the label probabilities ('labels'). Its
+    version should be the digest of the model, its vocabularies and the PCFG
+    (see Seq2ParsePredictor.digest).
+    """
+
+    TABLES = ['seqs', 'labels']
+
+    def get(self, stage, key):
+        """
+        Returns the cached value of the given key of the stage, or None.
+        """
+        return self.lookup(stage, key)[1]
+
+    def put(self, stage, key, value):
+        self.store(stage, key, value)
+
+    def stats(self):
+        """
+        Returns the counters of each stage.
+        """
+        return dict((stage, self.table_stats(stage)) for stage in self.TABLES)
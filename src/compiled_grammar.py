@@ -0,0 +1,190 @@
+"""
+Compiled grammar representation for the Earley parsers.
+
+@author: Georgios Sakkas
+"""
+
+from collections import defaultdict
+from copy import copy
+
+
+class CompiledGrammar():
+    """
+    Integer representation of a CFG, used in the hot loops of the Earley
+    parsers. Symbols are interned to ints and rules are stored as compiled
+    (rule id, lhs id, rhs ids, error score) tuples, so the parsers only
+    compare ints. Per-symbol flags (terminal, tag, nullable, error
+    non-terminal) are computed once.
+    """
+
+    def __init__(self, grammar, rule_type, start_rule):
+        # Type of the rules created for pre-terminals (the parser's Rule class)
+        self.rule_type = rule_type
+        # Symbols by id and ids by symbol
+        self.symbols = []
+        self.ids = dict([])
+        # Rules and compiled rules by rule id
+        self.rules = []
+        self.crules = []
+        # Compiled pre-terminal rules, i.e. tag -> terminal, by (tag id, terminal id)
+        self.preterminals = dict([])
+
+        for nt, rule_list in grammar.rules.items():
+            self.intern(nt)
+            for rule in rule_list:
+                for sym in rule.rhs:
+                    self.intern(sym)
+        self.intern(start_rule.lhs)
+        for sym in start_rule.rhs:
+            self.intern(sym)
+
+        # Compiled rules by their lhs id, in the same order as in the grammar
+        self.rules_of = [[] for _ in self.symbols]
+        for nt, rule_list in grammar.rules.items():
+            for rule in rule_list:
+                self.rules_of[self.ids[nt]].append(self.add_rule(rule))
+        self.start = (start_rule, self.add_rule(start_rule))
+
+        num_of_symbols = len(self.symbols)
+        self.terminal = [not self.rules_of[s] for s in range(num_of_symbols)]
+        # Tags are non-terminals with rules to solely terminals
+        self.tag = [not self.terminal[s] and
+                    all(self.terminal[r] for crule in self.rules_of[s] for r in crule[2])
+                    for s in range(num_of_symbols)]
+        # Non-terminals with rules to null
+        self.nullable = [any(len(crule[2]) == 0 for crule in self.rules_of[s])
+                         for s in range(num_of_symbols)]
+        # Error non-terminals, i.e. Err_* and InsertErr
+        self.error = [sym.startswith('Err_') or sym == 'InsertErr' for sym in self.symbols]
+        # Symbols that appear in the rhs of the rules of each symbol
+        self.rhs_symbols = [frozenset(r for crule in self.rules_of[s] for r in crule[2])
+                            for s in range(num_of_symbols)]
+        # Reverse map from each terminal to the tags that produce it
+        terminal_tags = defaultdict(set)
+        for s in range(num_of_symbols):
+            if self.tag[s]:
+                for r in self.rhs_symbols[s]:
+                    terminal_tags[r].add(s)
+        self.terminal_tags = dict((t, frozenset(tags)) for t, tags in terminal_tags.items())
+        # Scanner table from each terminal to the pre-terminal rule and its
+        # error cost for every tag that produces it
+        self.scan_table = dict((t, dict((tag, self.preterminal(tag, t) + (1 if self.error[tag] else 0,))
+                                        for tag in sorted(tags)))
+                               for t, tags in self.terminal_tags.items())
+        # The symbol X for each error non-terminal Err_X (-1 if X is unknown)
+        self.error_base = [self.ids.get(sym.replace('Err_', ''), -1) for sym in self.symbols]
+
+    def extend(self, rules):
+        """
+        Returns the compiled grammar with the given (new) rules added, as an
+        overlay of this one. Its tables are shallow copies of the tables of
+        this one, where only the entries of the symbols that the rules change
+        are recomputed, instead of compiling the whole grammar again.
+        """
+        grammar = copy(self)
+        grammar.symbols = list(self.symbols)
+        grammar.ids = dict(self.ids)
+        grammar.rules = list(self.rules)
+        grammar.crules = list(self.crules)
+        grammar.preterminals = dict(self.preterminals)
+        num_of_old_symbols = len(self.symbols)
+        # The new symbols are interned by the lhs of their rules, with the new
+        # non-terminals last, as when compiling the whole grammar, so the new
+        # tags are in the same order in the scanner table
+        rules_by_lhs = defaultdict(list)
+        for rule in rules:
+            rules_by_lhs[rule.lhs].append(rule)
+        for lhs in sorted(rules_by_lhs, key=lambda lhs: lhs not in self.ids or self.terminal[self.ids[lhs]]):
+            grammar.intern(lhs)
+            for rule in rules_by_lhs[lhs]:
+                for sym in rule.rhs:
+                    grammar.intern(sym)
+        new_symbols = grammar.symbols[num_of_old_symbols:]
+        grammar.rules_of = self.rules_of + [[] for _ in new_symbols]
+        grammar.terminal = self.terminal + [True for _ in new_symbols]
+        grammar.tag = self.tag + [False for _ in new_symbols]
+        grammar.nullable = self.nullable + [False for _ in new_symbols]
+        grammar.error = self.error + [sym.startswith('Err_') or sym == 'InsertErr' for sym in new_symbols]
+        grammar.rhs_symbols = self.rhs_symbols + [frozenset() for _ in new_symbols]
+        if new_symbols:
+            grammar.error_base = [grammar.ids.get(sym.replace('Err_', ''), -1) for sym in grammar.symbols]
+
+        # The rule lists of the symbols that get rules are copied before
+        # adding them, so the ones of this grammar are not changed
+        changed = set()
+        for rule in rules:
+            lhs = grammar.ids[rule.lhs]
+            if lhs not in changed:
+                grammar.rules_of[lhs] = list(grammar.rules_of[lhs])
+                changed.add(lhs)
+            grammar.rules_of[lhs].append(grammar.add_rule(rule))
+        no_longer_terminal = frozenset(s for s in changed if grammar.terminal[s])
+        for s in changed:
+            grammar.terminal[s] = False
+            grammar.nullable[s] = any(len(crule[2]) == 0 for crule in grammar.rules_of[s])
+            grammar.rhs_symbols[s] = frozenset(r for crule in grammar.rules_of[s] for r in crule[2])
+
+        # The tags can only change for the symbols that got rules and the ones
+        # with rules to symbols that are no longer terminals
+        retag = set(changed)
+        if no_longer_terminal:
+            retag.update(s for s, rhs in enumerate(grammar.rhs_symbols) if rhs & no_longer_terminal)
+        removed_tags = defaultdict(set)
+        added_tags = defaultdict(set)
+        for s in retag:
+            if s < num_of_old_symbols and self.tag[s]:
+                for r in self.rhs_symbols[s]:
+                    removed_tags[r].add(s)
+            grammar.tag[s] = not grammar.terminal[s] and all(grammar.terminal[r] for r in grammar.rhs_symbols[s])
+            if grammar.tag[s]:
+                for r in grammar.rhs_symbols[s]:
+                    added_tags[r].add(s)
+        grammar.terminal_tags = dict(self.terminal_tags)
+        grammar.scan_table = dict(self.scan_table)
+        for t in set(removed_tags) | set(added_tags):
+            tags = (grammar.terminal_tags.get(t, frozenset()) - removed_tags[t]) | added_tags[t]
+            if tags:
+                grammar.terminal_tags[t] = frozenset(tags)
+                grammar.scan_table[t] = dict((tag, grammar.preterminal(tag, t) + (1 if grammar.error[tag] else 0,))
+                                             for tag in sorted(tags))
+            else:
+                grammar.terminal_tags.pop(t, None)
+                grammar.scan_table.pop(t, None)
+
+        return grammar
+
+    def intern(self, sym):
+        """
+        Returns the id of the given symbol, adding it if it is new.
+        """
+        if sym not in self.ids:
+            self.ids[sym] = len(self.symbols)
+            self.symbols.append(sym)
+        return self.ids[sym]
+
+    def id(self, sym):
+        """
+        Returns the id of the given symbol, or -1 if it is not in the grammar.
+        """
+        return self.ids.get(sym, -1)
+
+    def add_rule(self, rule):
+        """
+        Compiles the given rule and returns its compiled form.
+        """
+        error_score = rule.error_score() if hasattr(rule, 'error_score') else 0
+        crule = (len(self.rules), self.ids[rule.lhs], tuple(self.ids[sym] for sym in rule.rhs), error_score)
+        self.rules.append(rule)
+        self.crules.append(crule)
+        return crule
+
+    def preterminal(self, tag, terminal):
+        """
+        Returns the (canonical) pre-terminal rule tag -> terminal and its
+        compiled form.
+        """
+        key = (tag, terminal)
+        if key not in self.preterminals:
+            crule = self.add_rule(self.rule_type(self.symbols[tag], [self.symbols[terminal]]))
+            self.preterminals[key] = (self.rules[crule[0]], crule)
+        return self.preterminals[key]
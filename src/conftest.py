@@ -0,0 +1,3 @@
+# The sample programs of these directories are not tests, even if some of them
+# are called test_*.py
+collect_ignore = ["tests", "human_study", "repairs", "golden"]
@@ -9,10 +9,10 @@ import re
 # from ast import parse
 from pathlib import Path
 from collections import defaultdict
-from nltk.tree import Tree
 import pygments
 from pygments.lexers import get_lexer_by_name
 from pygments.token import Text, Name, Number, String, Punctuation, Operator, Keyword
+from compiled_grammar import CompiledGrammar
 
 class Rule():
     """
@@ -54,6 +54,8 @@ class Grammar():
     def __init__(self):
         # The rules are represented as a dictionary from L.H.S to R.H.S.
         self.rules = defaultdict(list)
+        # Integer representation used by the parser (built on demand)
+        self.compiled = None
 
     def add(self, rule):
         """
@@ -61,6 +63,15 @@ class Grammar():
         """
 
         self.rules[rule.lhs].append(rule)
+        self.compiled = None
+
+    def compile(self):
+        """
+        Returns the compiled (integer) representation of the grammar.
+        """
+        if self.compiled is None:
+            self.compiled = CompiledGrammar(self, Rule, Rule(State.GAM, ['S']))
+        return self.compiled
 
     @staticmethod
     def load_grammar(fpath):
@@ -127,9 +138,13 @@ class State():
 
     GAM = '<GAM>'
 
-    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, back_pointers=[]):
+    __slots__ = ('rule', 'crule', 'dot', 'sent_pos', 'chart_pos', 'back', 'own_hash')
+
+    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, back=None, crule=None):
         # CFG Rule.
         self.rule = rule
+        # Compiled rule, i.e. (rule id, lhs id, rhs ids, error score)
+        self.crule = crule
         # Dot position in the rule.
         self.dot = dot
         # Sentence position.
@@ -137,18 +152,38 @@ class State():
         # Chart index.
         self.chart_pos = chart_pos
         # Pointers to child states (if the given state was generated using
-        # Completer).
-        self.back_pointers = back_pointers
+        # Completer), as a cons list (last child, rest) that shares its tail
+        # with the state the dot was moved from
+        self.back = back
+        # Hash for efficient lookups in the chart entries
+        self.own_hash = hash((crule[0], dot, sent_pos))
 
     def __eq__(self, other):
         if isinstance(other, State):
-            return self.rule == other.rule and self.dot == other.dot and \
+            return self.crule[0] == other.crule[0] and self.dot == other.dot and \
                 self.sent_pos == other.sent_pos
 
         return False
 
+    def __hash__(self):
+        return self.own_hash
+
     def __len__(self):
-        return len(self.rule)
+        return len(self.crule[2])
+
+    @property
+    def back_pointers(self):
+        """
+        Returns the child states in order, unrolling the cons list.
+        """
+
+        children = []
+        back = self.back
+        while back is not None:
+            children.append(back[0])
+            back = back[1]
+        children.reverse()
+        return children
 
     def __repr__(self):
         return self.__str__()
@@ -168,23 +203,33 @@ class State():
         Return next symbol to parse, i.e. the one after the dot
         """
 
-        if self.dot < len(self):
-            return self.rule[self.dot]
+        if self.dot < len(self.crule[2]):
+            return self.rule.rhs[self.dot]
+
+    def next_id(self):
+        """
+        Return the id of the next symbol to parse, or -1 if the state is complete
+        """
+
+        if self.dot < len(self.crule[2]):
+            return self.crule[2][self.dot]
+        return -1
 
     def is_complete(self):
         """
         Checks whether the given state is complete.
         """
 
-        return len(self) == self.dot
+        return len(self.crule[2]) == self.dot
 
     @staticmethod
-    def init():
+    def init(grammar):
         """
         Returns the state used to initialize the chart in the Earley algorithm.
         """
 
-        return State(Rule(State.GAM, ['S']))
+        rule, crule = grammar.start
+        return State(rule, crule=crule)
 
 
 class ChartEntry():
@@ -195,6 +240,8 @@ class ChartEntry():
     def __init__(self, states):
         # List of Earley states.
         self.states = states
+        # Set of the same states for constant time membership checks
+        self.seen = set(states)
 
     def __iter__(self):
         return iter(self.states)
@@ -213,7 +260,8 @@ class ChartEntry():
         Add the given state (if it hasn't already been added).
         """
 
-        if state not in self.states:
+        if state not in self.seen:
+            self.seen.add(state)
             self.states.append(state)
 
 
@@ -240,13 +288,13 @@ class Chart():
             enumerate(self.entries)])
 
     @staticmethod
-    def init(l):
+    def init(l, grammar):
         """
         Initializes a chart with l entries (Including the dummy start state).
         """
 
         return Chart([(ChartEntry([]) if i > 0 else
-                ChartEntry([State.init()])) for i in range(l)])
+                ChartEntry([State.init(grammar)])) for i in range(l)])
 
 
 class EarleyParse():
@@ -258,17 +306,22 @@ class EarleyParse():
     def __init__(self, sentence, grammar):
         self.words = sentence.split()
         self.grammar = grammar
+        # Integer representation of the grammar for the parsing loops
+        self.compiled = grammar.compile()
+        # Tags that can produce each word
+        self.word_tags = [self.compiled.terminal_tags.get(self.compiled.id(word), frozenset())
+                          for word in self.words]
 
-        self.chart = Chart.init(len(self.words) + 1)
+        self.chart = Chart.init(len(self.words) + 1, self.compiled)
 
     def predictor(self, state, pos):
         """
         Earley Predictor.
         """
 
-        for rule in self.grammar[state.next()]:
-            self.chart[pos].add(State(rule, dot=0,
-                sent_pos=state.chart_pos, chart_pos=state.chart_pos))
+        for crule in self.compiled.rules_of[state.next_id()]:
+            self.chart[pos].add(State(self.compiled.rules[crule[0]], dot=0,
+                sent_pos=state.chart_pos, chart_pos=state.chart_pos, crule=crule))
 
     def scanner(self, state, pos):
         """
@@ -276,24 +329,27 @@ class EarleyParse():
         """
 
         if state.chart_pos < len(self.words):
-            word = self.words[state.chart_pos]
+            tag = state.next_id()
 
-            if any((word in r) for r in self.grammar[state.next()]):
-                self.chart[pos + 1].add(State(Rule(state.next(), [word]),
+            if tag in self.word_tags[state.chart_pos]:
+                rule, crule = self.compiled.preterminal(tag, self.compiled.id(self.words[state.chart_pos]))
+                self.chart[pos + 1].add(State(rule,
                     dot=1, sent_pos=state.chart_pos,
-                    chart_pos=(state.chart_pos + 1)))
+                    chart_pos=(state.chart_pos + 1), crule=crule))
 
     def completer(self, state, pos):
         """
         Earley Completer.
         """
 
+        lhs = state.crule[1]
         for prev_state in self.chart[state.sent_pos]:
-            if prev_state.next() == state.rule.lhs:
+            if prev_state.next_id() == lhs:
                 self.chart[pos].add(State(prev_state.rule,
                     dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
                     chart_pos=pos,
-                    back_pointers=(prev_state.back_pointers + [state])))
+                    back=(state, prev_state.back),
+                    crule=prev_state.crule))
 
     def parse(self):
         """
@@ -301,15 +357,13 @@ class EarleyParse():
         chart.
         """
 
-        # Checks whether the next symbol for the given state is a tag.
-        def is_tag(state):
-            return self.grammar.is_tag(state.next())
+        tag = self.compiled.tag
 
         for i in range(len(self.chart)):
             # print("Chart[" + str(i) + "]")
             for state in self.chart[i]:
                 if not state.is_complete():
-                    if is_tag(state):
+                    if tag[state.next_id()]:
                         self.scanner(state, i)
                     else:
                         self.predictor(state, i)
@@ -336,6 +390,9 @@ class EarleyParse():
         Returns the parse if it exists, otherwise returns None.
         """
 
+        # nltk is only needed to build the parse trees
+        from nltk.tree import Tree
+
         def get_helper(state):
             if self.grammar.is_tag(state.rule.lhs):
                 return Tree(state.rule.lhs, [state.rule.rhs[0]])
@@ -6,16 +6,18 @@ Python Earley Parser.
 
 import argparse
 import re
+import hashlib
 # from ast import parse
-from math import prod
+from os import getpid, replace
+from math import log, exp
 from pathlib import Path
 from copy import deepcopy
 from collections import defaultdict
 import json
-from nltk.tree import Tree
 import pygments
 from pygments.lexers import get_lexer_by_name
 from pygments.token import Text, Name, Number, String, Punctuation, Operator, Keyword
+from compiled_grammar import CompiledGrammar
 
 class Rule():
     """
@@ -27,6 +29,7 @@ class Rule():
         # rhs is a list of non-terminals and terminals.
         self.lhs, self.rhs = lhs, rhs
         self.prob = 1.0
+        self.log_prob = 0.0
 
     def __contains__(self, sym):
         return sym in self.rhs
@@ -51,6 +54,11 @@ class Rule():
 
     def update_prob(self, prob):
         self.prob = prob
+        self.log_prob = log(prob) if prob > 0.0 else float('-inf')
+
+    def update_log_prob(self, log_prob):
+        self.log_prob = log_prob
+        self.prob = exp(log_prob)
 
 
 class Grammar():
@@ -61,6 +69,10 @@ class Grammar():
     def __init__(self):
         # The rules are represented as a dictionary from L.H.S to R.H.S.
         self.rules = defaultdict(list)
+        # Integer representation used by the parser (built on demand)
+        self.compiled = None
+        # Hash of the rules and of the rules usage of the PCFG (see load_probs)
+        self.pcfg_key = None
 
     def add(self, rule):
         """
@@ -68,6 +80,15 @@ class Grammar():
         """
 
         self.rules[rule.lhs].append(rule)
+        self.compiled = None
+
+    def compile(self):
+        """
+        Returns the compiled (integer) representation of the grammar.
+        """
+        if self.compiled is None:
+            self.compiled = CompiledGrammar(self, Rule, Rule(State.GAM, ['S']))
+        return self.compiled
 
     @staticmethod
     def load_grammar(fpath):
@@ -128,6 +149,58 @@ class Grammar():
                     rule.update_prob(rules_count[str(rule)] / count)
                 updated_rules[lhs].append(rule)
         self.rules = updated_rules
+        self.compiled = None
+
+    def log_probs(self):
+        """
+        Returns the log-probabilities of the rules by their compiled rule id,
+        i.e. the compiled PCFG.
+        """
+        return [rule.log_prob for rule in self.compile().rules]
+
+    def update_log_probs(self, log_probs):
+        """
+        Updates the probabilities of the rules from the given log-probabilities
+        by compiled rule id (as returned by log_probs).
+        """
+        for rule, log_prob in zip(self.compile().rules, log_probs):
+            rule.update_log_prob(log_prob)
+
+    def load_probs(self, rules_usage_file, pcfg_file=None):
+        """
+        Updates the probabilities of the rules from the given rules usage
+        (.json). The compiled PCFG is persisted in pcfg_file (if given) and it
+        is loaded from there as long as the grammar and the rules usage have
+        not changed.
+        """
+        with open(rules_usage_file, "rb") as in_file:
+            rules_usage = in_file.read()
+        key = hashlib.sha256(('\n'.join(str(rule) for rule in self.compile().rules) + '\n').encode('utf-8') +
+                             rules_usage).hexdigest()
+        self.pcfg_key = key
+        if pcfg_file is not None and Path(pcfg_file).exists():
+            try:
+                with open(pcfg_file, "r") as in_file:
+                    pcfg = json.load(in_file)
+                if pcfg["key"] == key and len(pcfg["log_probs"]) == len(self.compile().rules):
+                    self.update_log_probs(pcfg["log_probs"])
+                    return
+            except (OSError, ValueError, KeyError, TypeError):
+                # An unreadable or malformed PCFG is rebuilt, like a stale one
+                pass
+        self.update_probs(json.loads(rules_usage))
+        if pcfg_file is not None:
+            # The PCFG is written to a temporary file that replaces pcfg_file,
+            # so that concurrent starts never read a half-written one
+            tmp_file = str(pcfg_file) + '.' + str(getpid()) + '.tmp'
+            try:
+                with open(tmp_file, "w") as out_file:
+                    json.dump({"key": key, "log_probs": self.log_probs()}, out_file)
+                replace(tmp_file, pcfg_file)
+            except OSError:
+                # E.g. a read-only models directory
+                if Path(tmp_file).exists():
+                    Path(tmp_file).unlink()
 
     def is_tag(self, sym):
         """
@@ -148,9 +221,13 @@ class State():
 
     GAM = '<GAM>'
 
-    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, back_pointers=[], prob=0.0):
+    __slots__ = ('rule', 'crule', 'dot', 'sent_pos', 'chart_pos', 'back', 'log_prob', 'own_hash')
+
+    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, back=None, log_prob=None, crule=None):
         # CFG Rule.
         self.rule = rule
+        # Compiled rule, i.e. (rule id, lhs id, rhs ids, error score)
+        self.crule = crule
         # Dot position in the rule.
         self.dot = dot
         # Sentence position.
@@ -158,19 +235,45 @@ class State():
         # Chart index.
         self.chart_pos = chart_pos
         # Pointers to child states (if the given state was generated using
-        # Completer).
-        self.back_pointers = back_pointers
-        self.prob = prob if prob > 0.0 else self.rule.prob * prod([s.prob for s in self.back_pointers])
+        # Completer), as a cons list (last child, rest) that shares its tail
+        # with the state the dot was moved from
+        self.back = back
+        # Log-probability of the rule and the child states (the parser sums
+        # them incrementally)
+        self.log_prob = log_prob if log_prob is not None else self.rule.log_prob + sum(s.log_prob for s in self.back_pointers)
+        # Hash for efficient lookups
+        self.own_hash = hash((crule[0], dot, sent_pos))
 
     def __eq__(self, other):
         if isinstance(other, State):
-            return self.rule == other.rule and self.dot == other.dot and \
+            return self.crule[0] == other.crule[0] and self.dot == other.dot and \
                 self.sent_pos == other.sent_pos
 
         return False
 
+    def __hash__(self):
+        return self.own_hash
+
     def __len__(self):
-        return len(self.rule)
+        return len(self.crule[2])
+
+    @property
+    def prob(self):
+        return exp(self.log_prob)
+
+    @property
+    def back_pointers(self):
+        """
+        Returns the child states in order, unrolling the cons list.
+        """
+
+        children = []
+        back = self.back
+        while back is not None:
+            children.append(back[0])
+            back = back[1]
+        children.reverse()
+        return children
 
     def __repr__(self):
         return self.__str__()
@@ -190,26 +293,36 @@ class State():
         Return next symbol to parse, i.e. the one after the dot
         """
 
-        if self.dot < len(self):
-            return self.rule[self.dot]
+        if self.dot < len(self.crule[2]):
+            return self.rule.rhs[self.dot]
+
+    def next_id(self):
+        """
+        Return the id of the next symbol to parse, or -1 if the state is complete
+        """
+
+        if self.dot < len(self.crule[2]):
+            return self.crule[2][self.dot]
+        return -1
 
     def is_complete(self):
         """
         Checks whether the given state is complete.
         """
 
-        return len(self) == self.dot
+        return len(self.crule[2]) == self.dot
 
     def is_tag(self, grammar):
         return grammar.is_tag(self.rule.lhs)
 
     @staticmethod
-    def init():
+    def init(grammar):
         """
         Returns the state used to initialize the chart in the Earley algorithm.
         """
 
-        return State(Rule(State.GAM, ['S']))
+        rule, crule = grammar.start
+        return State(rule, crule=crule)
 
 
 class ChartEntry():
@@ -217,9 +330,19 @@ class ChartEntry():
     Represents an entry in the chart used by the Earley algorithm.
     """
 
-    def __init__(self, states):
+    def __init__(self, states, tag):
         # List of Earley states.
-        self.states = states
+        self.states = []
+        # Hash index of the states, i.e. by (rule, dot, sent_pos)
+        self.seen = set([])
+        # States by the id of the symbol after their dot, in order
+        self.waiting = defaultdict(list)
+        # Flags of the tags (by symbol id) and the longest non-tag states,
+        # which are tracked while the states are added
+        self.tag = tag
+        self.longest = []
+        for state in states:
+            self.add(state)
 
     def __iter__(self):
         return iter(self.states)
@@ -266,21 +389,39 @@ class ChartEntry():
         return '\n'
 
     def get_all_partial_parses(self, grammar):
-        filtered = list(filter(lambda s: not s.is_tag(grammar), self.states))
-        if filtered:
-            max_len = max(map(lambda s: s.chart_pos - s.sent_pos, filtered))
-            longest = [s for s in filtered if s.chart_pos - s.sent_pos == max_len]
-            high_level = list(filter(lambda s: all(map(lambda s_in: s not in s_in.back_pointers, longest)), longest))
-            most_probable = max(high_level, key=lambda s: s.prob)
+        """
+        Returns the most probable of the longest non-tag states that are not
+        children of another longest state (or None).
+        """
+        if self.longest:
+            children = set(s for s_in in self.longest for s in s_in.back_pointers)
+            high_level = [s for s in self.longest if s not in children]
+            most_probable = max(high_level, key=lambda s: s.log_prob)
             return most_probable
 
+    def waiting_for(self, sym):
+        """
+        Returns the states that wait for the given symbol id, in the same order
+        as iterating over the entry (it grows with the entry).
+        """
+        return self.waiting[sym]
+
     def add(self, state):
         """
         Add the given state (if it hasn't already been added).
         """
 
-        if state not in self.states:
+        if state not in self.seen:
+            self.seen.add(state)
             self.states.append(state)
+            if state.dot < len(state.crule[2]):
+                self.waiting[state.crule[2][state.dot]].append(state)
+            if not self.tag[state.crule[1]]:
+                length = state.chart_pos - state.sent_pos
+                if not self.longest or length > self.longest[0].chart_pos - self.longest[0].sent_pos:
+                    self.longest = [state]
+                elif length == self.longest[0].chart_pos - self.longest[0].sent_pos:
+                    self.longest.append(state)
 
 
 class Chart():
@@ -306,13 +447,79 @@ class Chart():
             enumerate(self.entries)])
 
     @staticmethod
-    def init(l):
+    def init(l, grammar):
         """
         Initializes a chart with l entries (Including the dummy start state).
         """
 
-        return Chart([(ChartEntry([]) if i > 0 else
-                ChartEntry([State.init()])) for i in range(l)])
+        return Chart([(ChartEntry([], grammar.tag) if i > 0 else
+                ChartEntry([State.init(grammar)], grammar.tag)) for i in range(l)])
+
+
+def fenwick_add(tree, pos):
+    pos += 1
+    while pos < len(tree):
+        tree[pos] += 1
+        pos += pos & -pos
+
+
+def fenwick_count(tree, pos):
+    # Number of the added positions that are < pos
+    total = 0
+    while pos > 0:
+        total += tree[pos]
+        pos -= pos & -pos
+    return total
+
+
+def count_crossings(spans, length):
+    """
+    Returns for each (sent_pos, chart_pos) span of the given list (in
+    decreasing chart_pos order) the number of the spans after it that cross its
+    start, i.e. start before it and end inside it, in O(n log n) with Fenwick
+    trees of the starts and the ends of the spans after it.
+    """
+    starts = [0] * (length + 2)
+    ends = [0] * (length + 3)
+    counts = [0] * len(spans)
+    for k in range(len(spans) - 1, -1, -1):
+        sent_pos, chart_pos = spans[k]
+        # The spans that start before sent_pos, except for those that also end at or before it
+        counts[k] = fenwick_count(starts, sent_pos) - fenwick_count(ends, sent_pos + 1)
+        fenwick_add(starts, sent_pos)
+        # An empty span only ends before a span that it starts before
+        fenwick_add(ends, chart_pos if sent_pos < chart_pos else chart_pos + 1)
+    return counts
+
+
+def first_crossings(spans, length):
+    """
+    Returns for each (sent_pos, chart_pos) span of the given list (in
+    decreasing chart_pos order) the index of the first span before it that
+    starts inside it (or -1), using a sparse table of the maximum end of the
+    spans by their start.
+    """
+    ends = [-1] * (length + 1)
+    by_end = dict([])
+    for k, (sent_pos, chart_pos) in enumerate(spans):
+        ends[sent_pos] = max(ends[sent_pos], chart_pos)
+        by_end[chart_pos] = k
+    table = [ends]
+    while 2 ** len(table) <= len(ends):
+        half = 2 ** (len(table) - 1)
+        table.append([max(a, b) for a, b in zip(table[-1], table[-1][half:])])
+    firsts = []
+    for sent_pos, chart_pos in spans:
+        # The spans that start inside this one and end after it are before it,
+        # and the first of them is the one that ends last
+        first = -1
+        if sent_pos + 1 < chart_pos:
+            level = (chart_pos - sent_pos - 1).bit_length() - 1
+            end = max(table[level][sent_pos + 1], table[level][chart_pos - 2 ** level])
+            if end > chart_pos:
+                first = by_end[end]
+        firsts.append(first)
+    return firsts
 
 
 class EarleyParse():
@@ -324,17 +531,21 @@ class EarleyParse():
     def __init__(self, sentence, grammar):
         self.words = sentence.split()
         self.grammar = grammar
+        # Integer representation of the grammar for the parsing loops
+        self.compiled = grammar.compile()
+        # Ids of the words in the grammar
+        self.word_ids = [self.compiled.id(word) for word in self.words]
 
-        self.chart = Chart.init(len(self.words) + 1)
+        self.chart = Chart.init(len(self.words) + 1, self.compiled)
 
     def predictor(self, state, pos):
         """
         Earley Predictor.
         """
 
-        for rule in self.grammar[state.next()]:
-            self.chart[pos].add(State(rule, dot=0,
-                sent_pos=state.chart_pos, chart_pos=state.chart_pos))
+        for crule in self.compiled.rules_of[state.next_id()]:
+            self.chart[pos].add(State(self.compiled.rules[crule[0]], dot=0,
+                sent_pos=state.chart_pos, chart_pos=state.chart_pos, crule=crule))
 
     def scanner(self, state, pos):
         """
@@ -342,26 +553,29 @@ class EarleyParse():
         """
 
         if state.chart_pos < len(self.words):
-            word = self.words[state.chart_pos]
+            word = self.word_ids[state.chart_pos]
+            tag = state.next_id()
 
-            for r in self.grammar[state.next()]:
-                if word in r:
-                    self.chart[pos + 1].add(State(Rule(state.next(), [word]),
+            for crule in self.compiled.rules_of[tag]:
+                if word in crule[2]:
+                    rule, pre_crule = self.compiled.preterminal(tag, word)
+                    self.chart[pos + 1].add(State(rule,
                         dot=1, sent_pos=state.chart_pos,
                         chart_pos=(state.chart_pos + 1),
-                        prob=r.prob))
+                        log_prob=self.compiled.rules[crule[0]].log_prob, crule=pre_crule))
 
     def completer(self, state, pos):
         """
         Earley Completer.
         """
 
-        for prev_state in self.chart[state.sent_pos]:
-            if prev_state.next() == state.rule.lhs:
-                self.chart[pos].add(State(prev_state.rule,
-                    dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
-                    chart_pos=pos,
-                    back_pointers=(prev_state.back_pointers + [state])))
+        for prev_state in self.chart[state.sent_pos].waiting_for(state.crule[1]):
+            self.chart[pos].add(State(prev_state.rule,
+                dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
+                chart_pos=pos,
+                back=(state, prev_state.back),
+                log_prob=(prev_state.log_prob + state.log_prob),
+                crule=prev_state.crule))
 
     def parse(self):
         """
@@ -369,15 +583,13 @@ class EarleyParse():
         chart.
         """
 
-        # Checks whether the next symbol for the given state is a tag.
-        def is_tag(state):
-            return self.grammar.is_tag(state.next())
+        tag = self.compiled.tag
 
         for i in range(len(self.chart)):
             # print("Chart[" + str(i) + "]")
             for state in self.chart[i]:
                 if not state.is_complete():
-                    if is_tag(state):
+                    if tag[state.next_id()]:
                         self.scanner(state, i)
                     else:
                         self.predictor(state, i)
@@ -409,6 +621,9 @@ class EarleyParse():
         Returns the parse if it exists, otherwise returns None.
         """
 
+        # nltk is only needed to build the parse trees
+        from nltk.tree import Tree
+
         def get_helper(state):
             if self.grammar.is_tag(state.rule.lhs):
                 return Tree(state.rule.lhs, [state.rule.rhs[0]])
@@ -479,36 +694,35 @@ class EarleyParse():
         # print("-" * 42)
 
         partial_parses = list(reversed(partial_parses))
-        to_delete = []
+        length = len(self.words)
+        # Drop the partial parses that are nested in a previous (not skipped)
+        # one, i.e. that start at or after its start (and inside it). Each
+        # (not skipped) partial parse skips as many of the next ones as the
+        # ones after it that cross its start.
+        crossings = count_crossings([(pp.sent_pos, pp.chart_pos) for pp in partial_parses], length)
+        kept = []
         to_skip = 0
-        for i, pp in enumerate(partial_parses):
+        min_start = None
+        for pp, num in zip(partial_parses, crossings):
+            if min_start is None or min_start > pp.sent_pos or min_start >= pp.chart_pos:
+                kept.append(pp)
             if to_skip > 0:
                 to_skip -= 1
             else:
-                for j, pp2 in enumerate(partial_parses[i + 1:]):
-                    if pp.sent_pos >= pp2.chart_pos:
-                        break
-                    elif pp2.sent_pos < pp.sent_pos < pp2.chart_pos:
-                        to_skip += 1
-                    elif pp.sent_pos <= pp2.sent_pos:
-                        if i + j + 1 not in to_delete:
-                            to_delete.append(i + j + 1)
-        to_delete = sorted(to_delete, reverse=True)
-        # print(to_delete)
-        for i in to_delete:
-            # print("----", len(partial_parses))
-            del partial_parses[i]
+                to_skip += num
+                min_start = pp.sent_pos if min_start is None else min(min_start, pp.sent_pos)
+        partial_parses = kept
 
+        # The partial parses that cross another one are ambiguous, in the
+        # order of their first crossing
+        spans = [(pp.sent_pos, pp.chart_pos) for pp in partial_parses]
         ambiguous = []
-        for i, pp in enumerate(partial_parses):
-            for j, pp2 in enumerate(partial_parses[i + 1:]):
-                if pp.sent_pos >= pp2.chart_pos:
-                    break
-                elif pp2.sent_pos < pp.sent_pos < pp2.chart_pos:
-                    if i not in ambiguous:
-                        ambiguous.append(i)
-                    if i + j + 1 not in ambiguous:
-                        ambiguous.append(i + j + 1)
+        for k, (first, num) in enumerate(zip(first_crossings(spans, length), count_crossings(spans, length))):
+            if first >= 0:
+                ambiguous.append((first, 1, k))
+            elif num > 0:
+                ambiguous.append((k, 0, k))
+        ambiguous = [k for _, _, k in sorted(ambiguous)]
         if ambiguous == []:
             ambiguous = [0]
         # print(ambiguous)
@@ -516,14 +730,24 @@ class EarleyParse():
         # partial_parses = list(reversed(partial_parses))
 
         if partial_parses:
-            list_of_parses = []
-            for amb in ambiguous:
-                stack = [partial_parses[amb]]
-                for pp in partial_parses[amb + 1:]:
-                    last_st = stack[-1]
-                    if last_st.sent_pos == pp.chart_pos:
-                        stack.append(pp)
-                list_of_parses.append(stack)
+            # Each stack chains the partial parses that end where the last one
+            # starts, so the log-probability of the stack from each partial
+            # parse is its own plus the one of the stack from the next one
+            by_end = dict((pp.chart_pos, k) for k, pp in enumerate(partial_parses))
+            nexts = [by_end.get(pp.sent_pos, -1) for pp in partial_parses]
+            nexts = [nxt if nxt > k else -1 for k, nxt in enumerate(nexts)]
+            scores = [0.0] * len(partial_parses)
+            for k in range(len(partial_parses) - 1, -1, -1):
+                scores[k] = partial_parses[k].log_prob + (scores[nexts[k]] if nexts[k] >= 0 else 0.0)
+            # The most probable stack (the first one on ties)
+            best = ambiguous[0]
+            for amb in ambiguous[1:]:
+                if scores[amb] > scores[best]:
+                    best = amb
+            pr = [partial_parses[best]]
+            while nexts[best] >= 0:
+                best = nexts[best]
+                pr.append(partial_parses[best])
 
         # Failed attempt starting from top-level to bottom parse trees
         # if partial_parses:
@@ -575,7 +799,6 @@ class EarleyParse():
         # print(list_of_parses[-1])
         # print(" ".join(self.words))
         # print(self.get_reduced_seq())
-            pr = max(list_of_parses, key=lambda pr: prod([s.prob for s in pr]))
             # for lps in list_of_parses:
             #     print(prod([s.prob for s in lps]) * 100, ": ", lps, "\n")
             if pr:
@@ -9,10 +9,10 @@ import re
 # from ast import parse
 from pathlib import Path
 from collections import defaultdict
-from nltk.tree import Tree
 import pygments
 from pygments.lexers import get_lexer_by_name
 from pygments.token import Text, Name, Number, String, Punctuation, Operator, Keyword
+from compiled_grammar import CompiledGrammar
 
 
 class Rule():
@@ -65,6 +65,8 @@ class Grammar():
     def __init__(self):
         # The rules are represented as a dictionary from L.H.S to R.H.S.
         self.rules = defaultdict(list)
+        # Integer representation used by the parser (built on demand)
+        self.compiled = None
 
     def add(self, rule):
         """
@@ -72,6 +74,15 @@ class Grammar():
         """
         if rule not in self.rules[rule.lhs]:
             self.rules[rule.lhs].append(rule)
+            self.compiled = None
+
+    def compile(self):
+        """
+        Returns the compiled (integer) representation of the grammar.
+        """
+        if self.compiled is None:
+            self.compiled = CompiledGrammar(self, Rule, Rule(State.GAM, ["S'"]))
+        return self.compiled
 
     def get_alphabet(self):
         symbols = set([])
@@ -263,9 +274,13 @@ class State():
 
     GAM = '<GAM>'
 
-    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back_pointers=[]):
+    __slots__ = ('rule', 'crule', 'dot', 'sent_pos', 'chart_pos', 'error_count', 'back', 'own_hash')
+
+    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back=None, crule=None):
         # CFG Rule.
         self.rule = rule
+        # Compiled rule, i.e. (rule id, lhs id, rhs ids, error score)
+        self.crule = crule
         # Dot position in the rule.
         self.dot = dot
         # Sentence position.
@@ -275,18 +290,38 @@ class State():
         # Error counter
         self.error_count = error_count
         # Pointers to child states (if the given state was generated using
-        # Completer).
-        self.back_pointers = back_pointers
+        # Completer), as a cons list (last child, rest) that shares its tail
+        # with the state the dot was moved from
+        self.back = back
+        # Hash for efficient lookups
+        self.own_hash = hash((crule[0], dot, sent_pos))
 
     def __eq__(self, other):
         if isinstance(other, State):
-            return self.rule == other.rule and self.dot == other.dot and \
+            return self.crule[0] == other.crule[0] and self.dot == other.dot and \
                 self.sent_pos == other.sent_pos
 
         return False
 
+    def __hash__(self):
+        return self.own_hash
+
     def __len__(self):
-        return len(self.rule)
+        return len(self.crule[2])
+
+    @property
+    def back_pointers(self):
+        """
+        Returns the child states in order, unrolling the cons list.
+        """
+
+        children = []
+        back = self.back
+        while back is not None:
+            children.append(back[0])
+            back = back[1]
+        children.reverse()
+        return children
 
     def __repr__(self):
         return self.__str__()
@@ -306,23 +341,33 @@ class State():
         Return next symbol to parse, i.e. the one after the dot
         """
 
-        if self.dot < len(self):
-            return self.rule[self.dot]
+        if self.dot < len(self.crule[2]):
+            return self.rule.rhs[self.dot]
+
+    def next_id(self):
+        """
+        Return the id of the next symbol to parse, or -1 if the state is complete
+        """
+
+        if self.dot < len(self.crule[2]):
+            return self.crule[2][self.dot]
+        return -1
 
     def is_complete(self):
         """
         Checks whether the given state is complete.
         """
 
-        return len(self) == self.dot
+        return len(self.crule[2]) == self.dot
 
     @staticmethod
-    def init():
+    def init(grammar):
         """
         Returns the state used to initialize the chart in the Earley algorithm.
         """
 
-        return State(Rule(State.GAM, ["S'"]))
+        rule, crule = grammar.start
+        return State(rule, crule=crule)
 
 
 class ChartEntry():
@@ -441,13 +486,13 @@ class Chart():
             enumerate(self.entries)])
 
     @staticmethod
-    def init(l):
+    def init(l, grammar):
         """
         Initializes a chart with l entries (Including the dummy start state).
         """
 
         return Chart([(ChartEntry([]) if i > 0 else
-                ChartEntry([State.init()])) for i in range(l)])
+                ChartEntry([State.init(grammar)])) for i in range(l)])
 
 
 class ErrorEarleyParse():
@@ -459,7 +504,13 @@ class ErrorEarleyParse():
     def __init__(self, sentence, grammar):
         self.words = sentence.split()
         self.grammar = grammar
-        self.chart = Chart.init(len(self.words) + 1)
+        # Integer representation of the grammar for the parsing loops
+        self.compiled = grammar.compile()
+        # Tags that can produce each word
+        self.word_tags = [self.compiled.terminal_tags.get(self.compiled.id(word), frozenset())
+                          for word in self.words]
+        self.err_tag = self.compiled.id('Err_Tag')
+        self.chart = Chart.init(len(self.words) + 1, self.compiled)
         # Maximum number of error correcting rules to use
         self.max_cost = 8
 
@@ -469,10 +520,10 @@ class ErrorEarleyParse():
         """
 
         # runs = 0
-        for rule in self.grammar[state.next()]:
+        for crule in self.compiled.rules_of[state.next_id()]:
             # This is my optimization to avoid using that many ErrorRules
-            self.chart[pos].add(State(rule, dot=0,
-                sent_pos=state.chart_pos, chart_pos=state.chart_pos))
+            self.chart[pos].add(State(self.compiled.rules[crule[0]], dot=0,
+                sent_pos=state.chart_pos, chart_pos=state.chart_pos, crule=crule))
             # runs += 1
         # print("===================")
         # print("<<Predictor>>")
@@ -488,15 +539,16 @@ class ErrorEarleyParse():
         """
         # runs = 1
         if state.chart_pos < len(self.words):
-            word = self.words[state.chart_pos]
+            tag = state.next_id()
             # runs = ([(word in r) for r in self.grammar[state.next()]] + [True]).index(True)
-            if any((word in r) for r in self.grammar[state.next()]):
-                new_cost = 1 if state.next().startswith('Err_') or state.next() == 'InsertErr' else 0
+            if tag in self.word_tags[state.chart_pos]:
+                new_cost = 1 if self.compiled.error[tag] else 0
                 if new_cost <= self.max_cost:
-                    self.chart[pos + 1].add(State(Rule(state.next(), [word]),
+                    rule, crule = self.compiled.preterminal(tag, self.compiled.id(self.words[state.chart_pos]))
+                    self.chart[pos + 1].add(State(rule,
                         dot=1, sent_pos=state.chart_pos,
                         chart_pos=(state.chart_pos + 1),
-                        error_count=new_cost))
+                        error_count=new_cost, crule=crule))
             # print("===================")
             # print("<<Scanner>>")
             # print("Chart[" + str(pos+1) + "]")
@@ -510,18 +562,20 @@ class ErrorEarleyParse():
         Error-correcting Earley Completer.
         """
         # runs = 0
+        _, lhs, rhs, error_score = state.crule
         for prev_state in self.chart[state.sent_pos]:
-            if prev_state.next() == state.rule.lhs:
-                new_cost = prev_state.error_count + state.error_count + state.rule.error_score()
-                if state.rule.lhs == 'Err_Tag':
-                    if any((state.rule.rhs[0] in r) for r in self.grammar[prev_state.rule.lhs.replace('Err_', '')]):
+            if prev_state.next_id() == lhs:
+                new_cost = prev_state.error_count + state.error_count + error_score
+                if lhs == self.err_tag:
+                    base = self.compiled.error_base[prev_state.crule[1]]
+                    if base >= 0 and rhs[0] in self.compiled.rhs_symbols[base]:
                         new_cost = prev_state.error_count
                 if new_cost <= self.max_cost:
                     self.chart[pos].add(State(prev_state.rule,
                         dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
                         chart_pos=pos,
-                        back_pointers=(prev_state.back_pointers + [state]),
-                        error_count=new_cost))
+                        back=(state, prev_state.back),
+                        error_count=new_cost, crule=prev_state.crule))
             # runs += 1
         # print("===================")
         # print("<<Completer>>")
@@ -537,9 +591,7 @@ class ErrorEarleyParse():
         chart.
         """
 
-        # Checks whether the next symbol for the given state is a tag.
-        def is_tag(state):
-            return self.grammar.is_tag(state.next())
+        tag = self.compiled.tag
 
         for cost in range(self.max_cost + 1):
             for i in range(len(self.chart)):
@@ -553,7 +605,7 @@ class ErrorEarleyParse():
                     # print("===================")
                     # jj += 1
                     if not state.is_complete():
-                        if is_tag(state):
+                        if tag[state.next_id()]:
                             self.scanner(state, i)
                             self.chart[i].add_other_states(state)
                         else:
@@ -595,6 +647,9 @@ class ErrorEarleyParse():
         Returns the minimum error parse if it exists, otherwise returns None.
         """
 
+        # nltk is only needed to build the parse trees
+        from nltk.tree import Tree
+
         def get_helper(state):
             # print(state)
             if self.grammar.is_tag(state.rule.lhs):
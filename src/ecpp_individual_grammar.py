@@ -6,15 +6,19 @@ Error Correcting Python Earley Parser.
 
 import argparse
 import re
+import hashlib
 # from ast import parse
 from pathlib import Path
-from collections import defaultdict, deque
-from itertools import product
-from nltk.tree import Tree
+from collections import defaultdict, deque, OrderedDict
+from itertools import product, chain, count
+from heapq import heappush, heappop
 from functools import partial
+from threading import Lock
 import pygments
 from pygments.lexers import get_lexer_by_name
 from pygments.token import Text, Name, Number, String, Punctuation, Operator, Keyword
+from compiled_grammar import CompiledGrammar
+import instrumentation
 
 
 class Rule():
@@ -70,6 +74,8 @@ class Grammar():
     def __init__(self):
         # The rules are represented as a dictionary from L.H.S to R.H.S.
         self.rules = defaultdict(list)
+        # Integer representation used by the parser (built on demand)
+        self.compiled = None
 
     def add(self, rule):
         """
@@ -77,6 +83,15 @@ class Grammar():
         """
         if rule not in self.rules[rule.lhs]:
             self.rules[rule.lhs].append(rule)
+            self.compiled = None
+
+    def compile(self):
+        """
+        Returns the compiled (integer) representation of the grammar.
+        """
+        if self.compiled is None:
+            self.compiled = CompiledGrammar(self, Rule, Rule(State.GAM, ["S'"]))
+        return self.compiled
 
     def get_alphabet(self):
         symbols = set([])
@@ -124,6 +139,13 @@ class Grammar():
 
         return grammar
 
+    def digest(self):
+        """
+        Returns a hash of the rules of the grammar, i.e. the version of what is
+        computed with it (e.g. the cached repairs).
+        """
+        return hashlib.sha256(str(self).encode('utf-8')).hexdigest()
+
     def __repr__(self):
         return self.__str__()
 
@@ -138,16 +160,17 @@ class Grammar():
 
         return '\n'.join(s)
 
-    # Returns the rules for a given Non-terminal.
+    # Returns the rules for a given Non-terminal (without adding it to the rules).
     def __getitem__(self, nt):
-        return self.rules[nt]
+        return self.rules.get(nt, [])
 
     def is_terminal(self, sym):
         """
-        Checks is the given symbol is terminal.
+        Checks is the given symbol is terminal, i.e. it has no rules, without
+        adding an empty entry for it to the rules.
         """
 
-        return len(self.rules[sym]) == 0
+        return len(self.rules.get(sym, [])) == 0
 
     def is_tag(self, sym):
         """
@@ -172,6 +195,19 @@ class Grammar():
 
 
 class ErrorGrammar(Grammar):
+    """
+    Represents a CFG that can be extended with error rules.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Base rules that can get error rules, with the positions of their
+        # tags, and their indices by tag (see prepare_error_rules)
+        self.candidates = None
+        self.candidates_of = None
+        # Memo of the error rules of each candidate, by its important tags
+        self.expansions = dict([])
+
     @staticmethod
     def load_grammar(fpath):
         """
@@ -266,6 +302,9 @@ class ErrorGrammar(Grammar):
         # print(self)
         # print(len(str(self).split('\n')))
 
+        # The grammar is final, so compile it (and its nullable closure) once
+        self.compile()
+
         error_rules = [r for k in self.rules for r in self.rules[k]]
         error_rules = list(filter(lambda er: er.lhs.startswith('Err_') or er.lhs == 'InsertErr', error_rules))
 
@@ -315,27 +354,129 @@ class ErrorGrammar(Grammar):
                 new_rules.append(Rule(rule.lhs, list(rule_rhs)))
         return new_rules
 
-    def update_error_grammar_with_erules(self, erules):
-        # print(len(str(self).split('\n')))
-        alphabet = self.get_alphabet()
-        tags = self.get_tags()
-        alphabet.remove('_ENDMARKER_')
-
-        # Maybe remove "Tfpdef -> Vfpdef Err_Colon Test" typed definitions in the future
-
-        #second step
+    @staticmethod
+    def parse_erules(erules):
+        """
+        Returns the rules of the given error rules (e.g. 'Err_Colon -> ') and
+        the tags X of their Err_X non-terminals.
+        """
+        rules = []
         all_important_tags = []
         for erl in erules:
             entries = erl.split('->')
             lhs = entries[0].strip()
             if 'H ' in entries[1]:
-                self.add(Rule(lhs, entries[1].strip().split()))
+                rules.append(Rule(lhs, entries[1].strip().split()))
             else:
-                self.add(ErrorRule(lhs, entries[1].strip().split()))
+                rules.append(ErrorRule(lhs, entries[1].strip().split()))
             if lhs.startswith('Err_'):
                 sym = lhs.replace('Err_', '')
                 all_important_tags.append(sym)
-        all_important_tags = list(set(all_important_tags))
+        return rules, list(set(all_important_tags))
+
+    def add_erules(self, erules):
+        """
+        Adds the given error rules (e.g. 'Err_Colon -> ') and returns the tags
+        X of their Err_X non-terminals.
+        """
+        rules, all_important_tags = ErrorGrammar.parse_erules(erules)
+        for rule in rules:
+            self.add(rule)
+        return all_important_tags
+
+    @staticmethod
+    def error_start_rules():
+        """
+        Returns the start and error-insertion rules of the error grammar.
+        """
+        return [Rule("S'", ["S"]), Rule("S'", ["S", "InsertErr"]), Rule("H", ["H", "InsertErr"]), Rule("H", ["InsertErr"])]
+
+    def add_error_start_rules(self):
+        """
+        Adds the start and error-insertion rules of the error grammar.
+        """
+        for rule in ErrorGrammar.error_start_rules():
+            self.add(rule)
+
+    def overlay(self, rules):
+        """
+        Returns the grammar with the given rules added to the rules of this one
+        (skipping the ones that it has), compiled by extending the compiled
+        grammar of this one. The rule lists of the non-terminals that get no
+        rules are shared with this grammar, so the overlay is not to be added to.
+        """
+        grammar = ErrorGrammar()
+        grammar.rules = defaultdict(list, self.rules)
+        new_rules = []
+        for rule in rules:
+            rule_list = grammar.rules[rule.lhs]
+            if rule not in rule_list:
+                if rule_list is self.rules.get(rule.lhs):
+                    rule_list = grammar.rules[rule.lhs] = list(rule_list)
+                rule_list.append(rule)
+                new_rules.append(rule)
+        grammar.compiled = self.compile().extend(new_rules)
+        return grammar
+
+    def prepare_error_rules(self):
+        """
+        Precomputes, once for the base grammar, the rules that error_rule_0
+        expands and the positions of their tags, indexed by tag, so that
+        with_erules only visits the rules of the predicted tags.
+        """
+        candidates = []
+        candidates_of = defaultdict(list)
+        for key in self.rules:
+            if not key.startswith('Err_') and not key.startswith('InsertErr'):
+                for rule in self.rules[key]:
+                    if rule.error_score() < 1 and rule.lhs not in ['Annotated_Assign'] and \
+                        not self.is_tag(rule.lhs):
+                        tag_positions = [i for i, sym in enumerate(rule.rhs) if self.is_tag(sym)]
+                        if tag_positions:
+                            for sym in set(rule.rhs[i] for i in tag_positions):
+                                candidates_of[sym].append(len(candidates))
+                            candidates.append((rule, tag_positions))
+        self.candidates_of = candidates_of
+        self.candidates = candidates
+
+    def expand_candidate(self, idx, itags):
+        """
+        Returns the error rules of error_rule_0 for the given candidate rule,
+        memoized by the important tags that it contains.
+        """
+        rule, tag_positions = self.candidates[idx]
+        active = tuple(i for i in tag_positions if rule.rhs[i] in itags)
+        key = (idx, active)
+        if key not in self.expansions:
+            new_rules_rhs = [["Err_" + sym, sym] if i in active else [sym] for i, sym in enumerate(rule.rhs)]
+            self.expansions[key] = [Rule(rule.lhs, list(rule_rhs)) for rule_rhs in product(*new_rules_rhs)
+                                    if list(rule_rhs) != rule.rhs]
+        return self.expansions[key]
+
+    def with_erules(self, erules):
+        """
+        Returns the error grammar that update_error_grammar_with_erules would
+        build for the given error rules, as an overlay of this (base) grammar,
+        i.e. sharing its rules and compiled tables (compiled once), and only
+        adding the error rules, their expansions and the start rules to them.
+        """
+        if self.candidates is None:
+            self.prepare_error_rules()
+        rules, all_important_tags = ErrorGrammar.parse_erules(erules)
+        for idx in sorted(set(i for sym in all_important_tags for i in self.candidates_of[sym])):
+            rules.extend(self.expand_candidate(idx, all_important_tags))
+        return self.overlay(rules + ErrorGrammar.error_start_rules())
+
+    def update_error_grammar_with_erules(self, erules):
+        # print(len(str(self).split('\n')))
+        alphabet = self.get_alphabet()
+        tags = self.get_tags()
+        alphabet.remove('_ENDMARKER_')
+
+        # Maybe remove "Tfpdef -> Vfpdef Err_Colon Test" typed definitions in the future
+
+        #second step
+        all_important_tags = self.add_erules(erules)
 
         #first step in Algorithm 1 in AHO's paper
         added_rules_1 = []
@@ -360,13 +501,82 @@ class ErrorGrammar(Grammar):
         # print('++++++++++++++++++++++++++')
 
         #third step
-        self.add(Rule("S'", ["S"]))
-        self.add(Rule("S'", ["S", "InsertErr"]))
-        self.add(Rule("H", ["H", "InsertErr"]))
-        self.add(Rule("H", ["InsertErr"]))
+        self.add_error_start_rules()
         # print(self)
         # print(len(str(self).split('\n')))
 
+        # The grammar is final, so compile it (and its nullable closure) once
+        self.compile()
+
+
+class ErrorGrammarCache():
+    """
+    LRU cache of the (compiled) error grammars of a base grammar, keyed by the
+    set of error rules, bounded by the number of grammars and their estimated
+    memory.
+    """
+
+    # Memory of a cached grammar per compiled rule (its copies of the tables of
+    # the base grammar, and its error rules and their compiled entries), as
+    # measured with tracemalloc by the grammar benchmark of run_benchmarks.py
+    # (120-350 bytes for 0-201 error rules on Python 3.11)
+    BYTES_PER_RULE = 384
+
+    def __init__(self, grammar, max_size=64, max_bytes=128 * 1024 * 1024):
+        self.grammar = grammar
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.grammars = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.grammars)
+
+    def __getstate__(self):
+        # Only the base grammar and the bounds are sent to other processes
+        return (self.grammar, self.max_size, self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def get(self, erules):
+        """
+        Returns the error grammar for the given error rules, building it (with
+        ErrorGrammar.with_erules) only if it is not cached.
+        """
+        key = frozenset(erules)
+        with self.lock:
+            if key in self.grammars:
+                self.grammars.move_to_end(key)
+                self.hits += 1
+                instrumentation.count('error_grammar_hits')
+                return self.grammars[key][0]
+            self.misses += 1
+        with instrumentation.stage('error_grammar'):
+            grammar = self.grammar.with_erules(erules)
+        num_bytes = len(grammar.compiled.crules) * self.BYTES_PER_RULE
+        with self.lock:
+            if key not in self.grammars:
+                self.grammars[key] = (grammar, num_bytes)
+                self.num_bytes += num_bytes
+                while len(self.grammars) > 1 and \
+                    (len(self.grammars) > self.max_size or self.num_bytes > self.max_bytes):
+                    _, (_, old_bytes) = self.grammars.popitem(last=False)
+                    self.num_bytes -= old_bytes
+                    self.evictions += 1
+        return grammar
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        return {"size": len(self.grammars), "bytes": self.num_bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
 
 class State():
     """
@@ -375,9 +585,13 @@ class State():
 
     GAM = '<GAM>'
 
-    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back_pointers=[]):
+    __slots__ = ('rule', 'crule', 'dot', 'sent_pos', 'chart_pos', 'error_count', 'back', 'own_hash')
+
+    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back=None, crule=None):
         # CFG Rule.
         self.rule = rule
+        # Compiled rule, i.e. (rule id, lhs id, rhs ids, error score)
+        self.crule = crule
         # Dot position in the rule.
         self.dot = dot
         # Sentence position.
@@ -387,14 +601,15 @@ class State():
         # Error counter
         self.error_count = error_count
         # Pointers to child states (if the given state was generated using
-        # Completer).
-        self.back_pointers = back_pointers
-        # Hash for the back_pointers for efficient usage
-        self.own_hash = hash((self.rule, self.dot, self.sent_pos))
+        # Completer), as a cons list (last child, rest) that shares its tail
+        # with the state the dot was moved from
+        self.back = back
+        # Hash for efficient lookups
+        self.own_hash = hash((crule[0], self.dot, self.sent_pos))
 
     def __eq__(self, other):
         if isinstance(other, State):
-            return self.rule == other.rule and self.dot == other.dot and \
+            return self.crule[0] == other.crule[0] and self.dot == other.dot and \
                 self.sent_pos == other.sent_pos
 
         return False
@@ -403,7 +618,21 @@ class State():
         return self.own_hash
 
     def __len__(self):
-        return len(self.rule)
+        return len(self.crule[2])
+
+    @property
+    def back_pointers(self):
+        """
+        Returns the child states in order, unrolling the cons list.
+        """
+
+        children = []
+        back = self.back
+        while back is not None:
+            children.append(back[0])
+            back = back[1]
+        children.reverse()
+        return children
 
     def __repr__(self):
         return self.__str__()
@@ -423,23 +652,33 @@ class State():
         Return next symbol to parse, i.e. the one after the dot
         """
 
-        if self.dot < len(self):
-            return self.rule[self.dot]
+        if self.dot < len(self.crule[2]):
+            return self.rule.rhs[self.dot]
+
+    def next_id(self):
+        """
+        Return the id of the next symbol to parse, or -1 if the state is complete
+        """
+
+        if self.dot < len(self.crule[2]):
+            return self.crule[2][self.dot]
+        return -1
 
     def is_complete(self):
         """
         Checks whether the given state is complete.
         """
 
-        return len(self) == self.dot
+        return len(self.crule[2]) == self.dot
 
     @staticmethod
-    def init():
+    def init(grammar):
         """
         Returns the state used to initialize the chart in the Earley algorithm.
         """
 
-        return State(Rule(State.GAM, ["S'"]))
+        rule, crule = grammar.start
+        return State(rule, crule=crule)
 
 
 class ChartEntry():
@@ -465,6 +704,13 @@ class ChartEntry():
     def __str__(self):
         return '\n'.join(str(s) for s in ['<<<<Seen>>>>'] + list(self.seen.keys()) + ['<<<<Not seen states>>>>'] + list(self.states) + ['<<<<Not seen other states>>>>'] + list(self.other_states))
 
+    def waiting_for(self, sym):
+        """
+        Returns the states that wait for the given symbol, i.e. have it after
+        their dot.
+        """
+        return [state for state in self if state.next_id() == sym]
+
     def switch_states(self):
         # print(len(self.states), len(self.other_states))
         self.other_states.extend(self.states)
@@ -485,7 +731,7 @@ class ChartEntry():
                 if state not in self.seen:
                     self.seen[state] = state.error_count
                 return state
-            if state.is_complete() and grammar.is_nullable(state.rule.lhs):
+            if state.is_complete() and grammar.nullable[state.crule[1]]:
                 self.other_states.append(state)
             else:
                 self.other_states.appendleft(state)
@@ -494,7 +740,7 @@ class ChartEntry():
     def add_other_states(self, grammar, state):
         in_other_states = state in self.other_states
         if not in_other_states:
-            if state.is_complete() and grammar.is_nullable(state.rule.lhs):
+            if state.is_complete() and grammar.nullable[state.crule[1]]:
                 self.other_states.append(state)
             else:
                 self.other_states.appendleft(state)
@@ -513,7 +759,7 @@ class ChartEntry():
         # print('>>>', state)
         # print('have_not_seen', have_not_seen)
         if not in_states and not in_other_states and have_not_seen:
-            if state.is_complete() and grammar.is_nullable(state.rule.lhs):
+            if state.is_complete() and grammar.nullable[state.crule[1]]:
                 self.states.append(state)
             else:
                 self.states.appendleft(state)
@@ -524,12 +770,294 @@ class ChartEntry():
                     self.states.remove(same_state)
                 if in_other_states:
                     self.other_states.remove(same_state)
-                if state.is_complete() and grammar.is_nullable(state.rule.lhs):
+                if state.is_complete() and grammar.nullable[state.crule[1]]:
                     self.states.append(state)
                 else:
                     self.states.appendleft(state)
 
 
+class StateDeque():
+    """
+    A deque of Earley states with a hash index from each state, i.e. its
+    (rule, dot, sent_pos), to its entries in the deque. Membership tests,
+    lookups and removals are O(1) amortized instead of linear scans. States are
+    also indexed by their next symbol, so the completer only visits the states
+    that wait for the completed non-terminal.
+    """
+
+    def __init__(self, states=None):
+        # Entries are [position, state, alive] cells. Positions decrease to the
+        # left and increase to the right, so they follow the deque order.
+        self.cells = deque([])
+        # Alive cells of each state, in deque order
+        self.index = dict([])
+        # Cells of incomplete states by the symbol after their dot, in deque order
+        self.waiting = defaultdict(deque)
+        self.left = 0
+        self.right = 0
+        self.size = 0
+        if states is not None:
+            self.extend(states)
+
+    def __iter__(self):
+        return (cell[1] for cell in self.cells if cell[2])
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, state):
+        return state in self.index
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return '\n'.join(str(s) for s in self)
+
+    def _insert(self, state, pos, left=False):
+        cell = [pos, state, True]
+        if state in self.index:
+            if left:
+                self.index[state].appendleft(cell)
+            else:
+                self.index[state].append(cell)
+        else:
+            self.index[state] = deque([cell])
+        self.size += 1
+        return cell
+
+    def _unlink_first(self, state):
+        # Only the first cell of a state is ever removed (by popleft or
+        # remove), so it is popped from the front of its cells
+        cells = self.index[state]
+        cell = cells.popleft()
+        if not cells:
+            del self.index[state]
+        cell[2] = False
+        self.size -= 1
+
+    def append(self, state):
+        cell = self._insert(state, self.right)
+        self.cells.append(cell)
+        if not state.is_complete():
+            self.waiting[state.next_id()].append(cell)
+        self.right += 1
+
+    def appendleft(self, state):
+        self.left -= 1
+        cell = self._insert(state, self.left, left=True)
+        self.cells.appendleft(cell)
+        if not state.is_complete():
+            self.waiting[state.next_id()].appendleft(cell)
+
+    def extend(self, states):
+        for state in states:
+            self.append(state)
+
+    def popleft(self):
+        while self.cells:
+            cell = self.cells.popleft()
+            if cell[2]:
+                # The front alive cell is the first one of its state
+                self._unlink_first(cell[1])
+                if not cell[1].is_complete():
+                    # All cells before it in the waiting deque are dead
+                    waiting = self.waiting[cell[1].next_id()]
+                    while waiting.popleft() is not cell:
+                        pass
+                return cell[1]
+        raise IndexError('pop from an empty StateDeque')
+
+    def waiting_for(self, sym):
+        """
+        Returns the states that wait for the given symbol, in deque order.
+        """
+        if sym not in self.waiting:
+            return []
+        return [cell[1] for cell in self.waiting[sym] if cell[2]]
+
+    def first(self, state):
+        """
+        Returns the cell of the first state in the deque that is equal to the
+        given one.
+        """
+        return self.index[state][0]
+
+    def find(self, state):
+        """
+        Returns the first state in the deque that is equal to the given one.
+        """
+        return self.first(state)[1]
+
+    def remove(self, state):
+        """
+        Lazily removes the first state in the deque that is equal to the given
+        one. The cell is skipped when it reaches the front of the deque.
+        """
+        self._unlink_first(state)
+
+
+class IndexedChartEntry(ChartEntry):
+    """
+    Chart entry that keeps the states of ChartEntry in indexed deques, so
+    duplicate detection and cost-lowering replacement of states do not need to
+    scan the whole entry. The order of states (and thus the parse) is the same.
+    """
+
+    def __init__(self, states):
+        # List of Earley states.
+        self.states = StateDeque(states)
+        self.other_states = StateDeque([])
+        self.seen = dict([])
+        # Seen states by the symbol after their dot, in seen order
+        self.seen_waiting = defaultdict(list)
+
+    def __iter__(self):
+        return chain(self.seen, self.states, self.other_states)
+
+    def waiting_for(self, sym):
+        """
+        Returns the states that wait for the given symbol, in the same order as
+        iterating over the entry.
+        """
+        return self.seen_waiting.get(sym, []) + self.states.waiting_for(sym) + \
+            self.other_states.waiting_for(sym)
+
+    def switch_states(self):
+        self.other_states.extend(self.states)
+        self.states = self.other_states
+        self.other_states = StateDeque([])
+
+    def pop_state(self, grammar, cost):
+        """
+        Return the next unseen state
+        """
+        while len(self.states) > 0:
+            state = self.states.popleft()
+            if state.error_count <= cost:
+                if state not in self.seen:
+                    self.seen[state] = state.error_count
+                    if not state.is_complete():
+                        self.seen_waiting[state.next_id()].append(state)
+                return state
+            if state.is_complete() and grammar.nullable[state.crule[1]]:
+                self.other_states.append(state)
+            else:
+                self.other_states.appendleft(state)
+        return None
+
+    def add(self, grammar, state):
+        """
+        Add the given state (if it hasn't already been added) or replace the
+        existing one if the given state has a lower error count.
+        """
+        in_states = state in self.states
+        in_other_states = state in self.other_states
+        if in_states:
+            same_cost = self.states.find(state).error_count
+        elif in_other_states:
+            same_cost = self.other_states.find(state).error_count
+        elif state in self.seen:
+            same_cost = self.seen[state]
+        else:
+            same_cost = None
+        if same_cost is None or same_cost > state.error_count:
+            if in_states:
+                self.states.remove(state)
+            if in_other_states:
+                self.other_states.remove(state)
+            if state.is_complete() and grammar.nullable[state.crule[1]]:
+                self.states.append(state)
+            else:
+                self.states.appendleft(state)
+
+
+class Agenda():
+    """
+    Global priority queue of the states of all chart entries, ordered by
+    (error count, chart position), used by the single-pass parsing strategy.
+    """
+
+    def __init__(self):
+        self.heap = []
+        # Tie-breaker that keeps insertion order for equal priorities
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, state):
+        heappush(self.heap, (state.error_count, state.chart_pos, next(self.counter), state))
+
+    def pop(self):
+        return heappop(self.heap)[-1]
+
+
+class AgendaChartEntry():
+    """
+    Chart entry for the agenda strategy. New states are pushed to the shared
+    agenda and the entry only keeps the cheapest version of each state, plus
+    the processed ones indexed for the completer.
+    """
+
+    def __init__(self, agenda):
+        self.agenda = agenda
+        # Cheapest version of each state pushed to the agenda
+        self.best = dict([])
+        # Processed states, mapped to their cheapest processed version
+        self.done = dict([])
+        # Processed incomplete states by the symbol after their dot
+        self.waiting = defaultdict(list)
+        # Processed complete states that start here, by their lhs
+        self.completed = defaultdict(list)
+
+    def __iter__(self):
+        return iter(self.done.values())
+
+    def __len__(self):
+        return len(self.best)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return '\n'.join(str(s) for s in self.best.values())
+
+    def waiting_for(self, sym):
+        """
+        Returns the processed states that wait for the given symbol.
+        """
+        return self.waiting.get(sym, [])
+
+    def completed_by(self, sym):
+        """
+        Returns the processed complete states for the given symbol that start
+        at this entry.
+        """
+        return self.completed.get(sym, [])
+
+    def add(self, grammar, state):
+        """
+        Push the given state to the agenda, unless an equal state with a lower
+        or equal error count has already been pushed.
+        """
+        best = self.best.get(state)
+        if best is None or best.error_count > state.error_count:
+            self.best[state] = state
+            self.agenda.push(state)
+
+    def is_stale(self, state):
+        """
+        Checks whether a cheaper version of the given (popped) state exists or
+        the state has already been processed.
+        """
+        return self.best[state] is not state or state in self.done and \
+            self.done[state].error_count <= state.error_count
+
+    def mark_done(self, state):
+        self.done[state] = state
+
+
 class Chart():
     """
     Represents the chart used in the Earley algorithm.
@@ -553,13 +1081,13 @@ class Chart():
             enumerate(self.entries)])
 
     @staticmethod
-    def init(l):
+    def init(l, grammar, entry_type=IndexedChartEntry):
         """
         Initializes a chart with l entries (Including the dummy start state).
         """
 
-        return Chart([(ChartEntry([]) if i > 0 else
-                ChartEntry([State.init()])) for i in range(l)])
+        return Chart([(entry_type([]) if i > 0 else
+                entry_type([State.init(grammar)])) for i in range(l)])
 
 
 class ErrorEarleyParse():
@@ -568,12 +1096,42 @@ class ErrorEarleyParse():
     given grammar.
     """
 
-    def __init__(self, sentence, grammar, max_cost=5):
+    def __init__(self, sentence, grammar, max_cost=5, chart_entry=IndexedChartEntry, strategy="passes"):
         self.words = sentence.split()
         self.grammar = grammar
-        self.chart = Chart.init(len(self.words) + 1)
+        # Integer representation of the grammar for the parsing loops
+        self.compiled = grammar.compile()
         # Maximum number of error correcting rules to use
         self.max_cost = max_cost
+        # Canonical scanned (pre-terminal) states of each word, by tag
+        self.scans = [self.scanned_states(pos) for pos in range(len(self.words))]
+        self.err_tag = self.compiled.id('Err_Tag')
+        # Parsing strategy, either "passes" (one sweep of the chart per error
+        # cost) or "agenda" (a single pass in order of error cost)
+        if strategy not in ["passes", "agenda"]:
+            raise ValueError("Unknown parsing strategy: " + str(strategy))
+        self.strategy = strategy
+        # Calls of the predictor, scanner and completer and cost levels visited
+        self.calls = (0, 0, 0)
+        self.cost_levels = 0
+        if strategy == "agenda":
+            self.agenda = Agenda()
+            self.chart = Chart([AgendaChartEntry(self.agenda) for _ in range(len(self.words) + 1)])
+            self.chart[0].add(self.compiled, State.init(self.compiled))
+        else:
+            self.chart = Chart.init(len(self.words) + 1, self.compiled, chart_entry)
+
+    def scanned_states(self, pos):
+        """
+        Returns the complete pre-terminal states for the word at the given
+        position, by the tag that produces them.
+        """
+        scans = dict([])
+        for tag, (rule, crule, new_cost) in self.compiled.scan_table.get(self.compiled.id(self.words[pos]), {}).items():
+            if new_cost <= self.max_cost:
+                scans[tag] = State(rule, dot=1, sent_pos=pos, chart_pos=(pos + 1),
+                    error_count=new_cost, crule=crule)
+        return scans
 
     def predictor(self, state, pos):
         """
@@ -581,10 +1139,12 @@ class ErrorEarleyParse():
         """
 
         # runs = 0
-        for rule in self.grammar[state.next()]:
+        next_sym = state.next_id()
+        for crule in self.compiled.rules_of[next_sym]:
             # This is my optimization to avoid using that many ErrorRules
-            self.chart[pos].add(self.grammar, State(rule, dot=0,
-                sent_pos=state.chart_pos, chart_pos=state.chart_pos))
+            new_state = State(self.compiled.rules[crule[0]], dot=0,
+                sent_pos=state.chart_pos, chart_pos=state.chart_pos, crule=crule)
+            self.chart[pos].add(self.compiled, new_state)
             # runs += 1
         # print("===================")
         # print("<<Predictor>>")
@@ -600,15 +1160,10 @@ class ErrorEarleyParse():
         """
         # runs = 1
         if state.chart_pos < len(self.words):
-            word = self.words[state.chart_pos]
             # runs = ([(word in r) for r in self.grammar[state.next()]] + [True]).index(True)
-            if any((word in r) for r in self.grammar[state.next()]):
-                new_cost = 1 if state.next().startswith('Err_') or state.next() == 'InsertErr' else 0
-                if new_cost <= self.max_cost:
-                    self.chart[pos + 1].add(self.grammar, State(Rule(state.next(), [word]),
-                        dot=1, sent_pos=state.chart_pos,
-                        chart_pos=(state.chart_pos + 1),
-                        error_count=new_cost))
+            new_state = self.scans[state.chart_pos].get(state.next_id())
+            if new_state is not None:
+                self.chart[pos + 1].add(self.compiled, new_state)
             # print("===================")
             # print("<<Scanner>>")
             # print("Chart[" + str(pos+1) + "]")
@@ -625,35 +1180,47 @@ class ErrorEarleyParse():
         # print("===================")
         # print("<<Completer>>")
         # print(">>>", state)
-        for prev_state in self.chart[state.sent_pos]:
-            if prev_state.next() == state.rule.lhs:
-                new_cost = prev_state.error_count + state.error_count + state.rule.error_score()
-                if state.rule.lhs == 'Err_Tag':
-                    if state.rule.rhs == []:
-                        new_cost = 1
-                    elif any((state.rule.rhs[0] in r) for r in self.grammar[prev_state.rule.lhs.replace('Err_', '')]):
-                        new_cost = prev_state.error_count
-                if new_cost <= self.max_cost:
-                    self.chart[pos].add(self.grammar, State(prev_state.rule,
-                        dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
-                        chart_pos=pos,
-                        back_pointers=(prev_state.back_pointers + [state]),
-                        error_count=new_cost))
+        # Only the states waiting for the completed non-terminal are visited
+        for prev_state in self.chart[state.sent_pos].waiting_for(state.crule[1]):
+            self.advance(prev_state, state, pos)
             # runs += 1
         # print("Chart[" + str(pos) + "]")
         # print(self.chart[pos])
         # print("===================")
         # return runs
 
+    def advance(self, prev_state, state, pos):
+        """
+        Moves the dot of prev_state over the non-terminal completed by state.
+        """
+        _, lhs, rhs, error_score = state.crule
+        new_cost = prev_state.error_count + state.error_count + error_score
+        if lhs == self.err_tag:
+            if not rhs:
+                new_cost = 1
+            else:
+                base = self.compiled.error_base[prev_state.crule[1]]
+                if base >= 0 and rhs[0] in self.compiled.rhs_symbols[base]:
+                    new_cost = prev_state.error_count
+        if new_cost <= self.max_cost:
+            self.chart[pos].add(self.compiled, State(prev_state.rule,
+                dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
+                chart_pos=pos,
+                back=(state, prev_state.back),
+                error_count=new_cost, crule=prev_state.crule))
+
     def parse(self):
         """
         Parses the sentence by running the Earley algorithm and filling out the
         chart.
         """
 
-        # Checks whether the next symbol for the given state is a tag.
-        def is_tag(state):
-            return self.grammar.is_tag(state.next())
+        if self.strategy == "agenda":
+            return self.parse_agenda()
+
+        tag = self.compiled.tag
+        nullable = self.compiled.nullable
+        predictions = scans = completions = 0
 
         for cost in range(self.max_cost + 1):
             for i in range(len(self.chart)):
@@ -661,17 +1228,20 @@ class ErrorEarleyParse():
                 # print(len(self.chart[i]))
                 # jj = 0
                 # print("===================")
-                state = self.chart[i].pop_state(self.grammar, cost)
+                state = self.chart[i].pop_state(self.compiled, cost)
                 while state is not None:
                     # print(">>>", state)
                     # print("===================")
                     # jj += 1
                     if not state.is_complete():
-                        if is_tag(state) and not self.grammar.is_nullable(state.next()):
+                        next_sym = state.next_id()
+                        if tag[next_sym] and not nullable[next_sym]:
                             self.scanner(state, i)
-                            self.chart[i].add_other_states(self.grammar, state)
+                            scans += 1
+                            self.chart[i].add_other_states(self.compiled, state)
                         else:
                             self.predictor(state, i)
+                            predictions += 1
                             # if state.next().startswith('Err_'):
                             #     print(state)
                             # if self.grammar.is_nullable(state.next()):
@@ -680,8 +1250,9 @@ class ErrorEarleyParse():
                             #     self.chart[i].add_other_states(self.grammar, state)
                     else:
                         self.completer(state, i)
-                        self.chart[i].add_other_states(self.grammar, state)
-                    state = self.chart[i].pop_state(self.grammar, cost)
+                        completions += 1
+                        self.chart[i].add_other_states(self.compiled, state)
+                    state = self.chart[i].pop_state(self.compiled, cost)
                 #     print("YOOO!", state, state == None)
                 # print("HERE", len(self.chart[i].other_states))
                 # print(jj)
@@ -692,6 +1263,8 @@ class ErrorEarleyParse():
             if self.has_parse():
                 # print("Cost =", cost)
                 break
+        self.calls = (predictions, scans, completions)
+        self.cost_levels = cost + 1
         # for i in range(len(self.chart)):
         #     print("Chart[" + str(i) + "]")
         #     # print("===================")
@@ -699,6 +1272,67 @@ class ErrorEarleyParse():
         #     # print(self.chart[i])
         # print("Cost =", cost)
 
+    def parse_agenda(self):
+        """
+        Parses the sentence in a single pass, processing the states of all
+        chart entries in order of (error count, chart position), and stops at
+        the first (i.e. minimum cost) complete parse.
+
+        The repair can differ from the one of the passes strategy. The passes
+        stop after the first cost level that created any complete parse, which
+        is not always the cheapest one, and they pick between equal cost
+        parses by the order of the chart deques, which are re-swept and
+        reshuffled at every level. That order cannot be replayed in a single
+        pass, so the agenda deterministically breaks ties by insertion order
+        instead.
+        """
+
+        tag = self.compiled.tag
+        nullable = self.compiled.nullable
+        goal = self.compiled.id("S'")
+        last = len(self.words)
+        predictions = scans = completions = 0
+        state = None
+
+        while self.agenda:
+            state = self.agenda.pop()
+            i = state.chart_pos
+            entry = self.chart[i]
+            if entry.is_stale(state):
+                continue
+            entry.mark_done(state)
+            if not state.is_complete():
+                next_sym = state.next_id()
+                entry.waiting[next_sym].append(state)
+                if tag[next_sym] and not nullable[next_sym]:
+                    self.scanner(state, i)
+                    scans += 1
+                else:
+                    self.predictor(state, i)
+                    predictions += 1
+                # States may be processed after the completions they need
+                for comp_state in entry.completed_by(next_sym):
+                    self.advance(state, comp_state, comp_state.chart_pos)
+            else:
+                if state.crule[1] == goal and state.sent_pos == 0 and i == last:
+                    break
+                self.chart[state.sent_pos].completed[state.crule[1]].append(state)
+                self.completer(state, i)
+                completions += 1
+        self.calls = (predictions, scans, completions)
+        # The states are processed in order of error count
+        if state is not None:
+            self.cost_levels = state.error_count + 1
+
+    def counters(self):
+        """
+        Returns the counters of the (finished) parse.
+        """
+        sizes = [len(entry) for entry in self.chart]
+        return {"predictor_calls": self.calls[0], "scanner_calls": self.calls[1],
+                "completer_calls": self.calls[2], "cost_levels": self.cost_levels,
+                "states": sum(sizes), "chart_size": len(sizes), "max_chart_entry": max(sizes)}
+
     def has_parse(self):
         """
         Checks whether the sentence has a parse.
@@ -730,6 +1364,9 @@ class ErrorEarleyParse():
         Returns the minimum error parse if it exists, otherwise returns None.
         """
 
+        # nltk is only needed to build the parse trees
+        from nltk.tree import Tree
+
         def get_helper(state):
             # print(state)
             if self.grammar.is_tag(state.rule.lhs):
@@ -763,26 +1400,9 @@ class ErrorEarleyParse():
         Returns the minimum error parse if it exists, otherwise returns None.
         """
 
-        def get_helper(state):
-            # print(state)
-            if self.grammar.is_tag(state.rule.lhs):
-                return [state.rule]
-            result = [state.rule]
-            for s in state.back_pointers:
-                result.extend(get_helper(s))
-            return result
-
-        found_state = None
-        errors = float("inf")
-        for state in self.chart[-1]:
-            if state.is_complete() and state.rule.lhs == "S'" and \
-                state.sent_pos == 0 and state.chart_pos == len(self.words):
-                if state.error_count < errors:
-                    found_state = state
-                    errors = state.error_count
-
+        found_state = self.goal_state()
         if found_state is not None:
-            return get_helper(found_state)
+            return [state.rule for state, _ in self.walk(found_state)]
 
         return None
 
@@ -792,42 +1412,24 @@ class ErrorEarleyParse():
         Returns the minimum error parse if it exists, otherwise returns None.
         """
 
-        def get_helperrr(state):
-            # print(state)
-            if self.grammar.is_tag(state.rule.lhs) or \
-                (self.grammar.is_tag(state.rule.lhs.replace('Err_', '')) and \
-                    (state.rule.rhs == [] or state.rule.rhs[0] != 'H')):
-                if state.rule.rhs != []:
-                    return Tree(state.rule.lhs, [state.rule.rhs[0]])
-                return Tree(state.rule.lhs, [state.rule.lhs.replace('Err_', '')])
-
-
-            return Tree(state.rule.lhs,
-                [get_helperrr(s) for s in state.back_pointers])
-
+        found_state = self.goal_state()
+        if found_state is not None:
+            states = []
+            erules = []
+            for state, is_leaf in self.walk(found_state):
+                if is_leaf:
+                    states.append(state)
+                erules.append(state.rule)
+            return (states, erules, float(found_state.error_count))
 
-        def get_helper(state):
-            if self.grammar.is_tag(state.rule.lhs) or \
-                (self.grammar.is_tag(state.rule.lhs.replace('Err_', '')) and \
-                    (state.rule.rhs == [] or state.rule.rhs[0] != 'H')):
-                return [state]
-            if state.rule.rhs:
-                if state.rule.rhs[0] == 'Err_Tag':
-                    return [state]
-            result = []
-            for s in state.back_pointers:
-                result.extend(get_helper(s))
-            return result
-
-
-        def get_erules(state):
-            if self.grammar.is_tag(state.rule.lhs):
-                return [state.rule]
-            result = [state.rule]
-            for s in state.back_pointers:
-                result.extend(get_erules(s))
-            return result
+        return None
 
+    def goal_state(self):
+        """
+        Returns the minimum error complete S' state that spans the whole
+        sentence, or None if there is no parse. Its cost is returned as a float
+        by get_fixed_seq and get_repair, whichever rules it used.
+        """
 
         found_state = None
         errors = float("inf")
@@ -837,11 +1439,101 @@ class ErrorEarleyParse():
                 if state.error_count < errors:
                     found_state = state
                     errors = state.error_count
+        return found_state
+
+    def walk(self, root):
+        """
+        Walks the parse of the given state in pre-order without recursion,
+        yielding (state, is_leaf) pairs. The leaves are the tags and error tags
+        of the repaired sequence, so they come out in token order.
+        """
+
+        tag = self.compiled.tag
+        error_base = self.compiled.error_base
+        # The cons lists hold the children from last to first, so pushing them
+        # as they come pops them from first to last
+        stack = [(root, False)]
+        while stack:
+            state, in_leaf = stack.pop()
+            lhs = state.crule[1]
+            is_leaf = False
+            if not in_leaf:
+                rhs = state.rule.rhs
+                base = error_base[lhs]
+                is_leaf = tag[lhs] or \
+                    (base >= 0 and tag[base] and (not rhs or rhs[0] != 'H')) or \
+                    (bool(rhs) and rhs[0] == 'Err_Tag')
+            yield state, is_leaf
+            if not tag[lhs]:
+                back = state.back
+                while back is not None:
+                    stack.append((back[0], in_leaf or is_leaf))
+                    back = back[1]
+
+    def iter_repair_ops(self):
+        """
+        Yields the repair operations of the minimum error parse, i.e. the
+        tokens with <<+X+>> for insertions, <<$X$>> for replacements and
+        <<-X->> for deletions, in token order.
+        """
 
+        found_state = self.goal_state()
         if found_state is not None:
-            return (get_helper(found_state), get_erules(found_state), found_state.error_count)
+            for state, is_leaf in self.walk(found_state):
+                if is_leaf:
+                    op = rule_updates_repair_operations(self.grammar, state)
+                    if op:
+                        yield op
 
-        return None
+    def get_repair(self):
+        """
+        Returns the abstract fixed sequence, the fixed sequence, the repair
+        operations, the used rules and the cost of the minimum error parse in
+        a single walk, or None if there is no parse.
+        """
+
+        found_state = self.goal_state()
+        if found_state is None:
+            return None
+        abstract_fixed_seq = []
+        fixed_seq = []
+        fixed_seq_ops = []
+        erules = []
+        for state, is_leaf in self.walk(found_state):
+            if is_leaf:
+                for seq, tok in ((abstract_fixed_seq, rule_updates(state)),
+                                 (fixed_seq, rule_updates_rhs(self.grammar, state)),
+                                 (fixed_seq_ops, rule_updates_repair_operations(self.grammar, state))):
+                    if tok:
+                        seq.append(tok)
+            erules.append(state.rule)
+        return (' '.join(abstract_fixed_seq), ' '.join(fixed_seq), ' '.join(fixed_seq_ops), erules, float(found_state.error_count))
+
+
+# Merges of the (space separated) operators that pygments splits, in the
+# order they are applied by Lexer.final_cleaning
+TOKEN_MERGES = [('* *', "**"), ('= =', "=="), ('< =', "<="), ('> =', ">="), ('! =', "!="), ('< <', "<<"),
+                ("> >", ">>"), ('& &', "&&"), ('| |', "||"), ('/ /', "//"), ('+ =', "+="), ('- =', "-="),
+                ('/ =', "/="), ('* =', "*="), ('>> =', ">>="), ('<< =', "<<="), ('&& =', "&&="), ('!! =', "!!="),
+                ('// =', "//="), ('% =', "%="), ('@', "@ "), ('@ =', "@="), ('| =', "|="), ('& =', "&="),
+                ('^ =', "^="), (". . .", "...")]
+# ... followed by the merges of the abstract (lex) or the actual (clean_with_lex) tokens
+ABSTRACT_TOKEN_MERGES = [("not in", "not_in"), ("is not", "is_not"), ("- >", "_arrow_")]
+ACTUAL_TOKEN_MERGES = [("- >", "->")]
+# Runs of tokens that are collapsed to their last token in a single pass, i.e.
+# consecutive strings, dots before numbers and newlines before closing brackets
+TOKEN_RUNS = re.compile(r"_STRING_(?: _STRING_)+|(?:\. )+_NUMBER_|(?:_NEWLINE_ )+[)\]}]")
+# Starts of the comments and strings (for their stripping)
+QUOTES_AND_COMMENTS = re.compile(r"[#\"\']")
+# Quotes and newlines, which start and end the (single line) strings
+QUOTES_AND_NEWLINES = re.compile(r"[\"\'\n]")
+# Markers of the strings that are recorded while cleaning (by their index),
+# before they are replaced by "__string__", and the quotes that they keep
+# when they are nested in other strings, i.e. of the triple quoted strings
+STRING_MARKER = re.compile("\ue000(\\d+)\ue001")
+NESTED_STRING_MARKER = re.compile("([\ue000\ue002\ue003])(\\d+)\ue001")
+MARKER_QUOTES = {"\ue000": "", "\ue002": "\"\"\"", "\ue003": "\'\'\'"}
+MARKER_CHARS = re.compile("[\ue000-\ue003]")
 
 
 class Lexer():
@@ -849,58 +1541,153 @@ class Lexer():
     Simple lexer for Python programs
     """
 
+    # The pygments lexer keeps no state between lexings, so it is shared
+    PYGMENTS_LEXER = None
+
     def __init__(self, terminals):
-        self.lexer = get_lexer_by_name("python")
+        if Lexer.PYGMENTS_LEXER is None:
+            Lexer.PYGMENTS_LEXER = get_lexer_by_name("python")
+        self.lexer = Lexer.PYGMENTS_LEXER
         self.terminals = terminals
 
     def lex(self, input_program):
-        program = input_program
-        if len(input_program) > 1:
-            if input_program[-1] != '\n':
-                program = input_program + '\n'
-        program = self.remove_comments_and_strings(program)
-        # Some hacks for random errors
-        if "’" in program:
-            program = program.replace("’", "'")
-            program = self.remove_comments_and_strings(program)
-        # Clean tabs
-        all_lines = []
-        for line in program.split('\n'):
-            spaces_so_far = 0
-            if len(line) > 0:
-                if line[0] in [' ', '\t']:
-                    for char in line:
-                        if char == ' ':
-                            spaces_so_far += 1
-                        elif char == '\t':
-                            spaces_so_far = (spaces_so_far // 4 + 1) * 4
-                        else:
-                            break
-            all_lines.append(' ' * spaces_so_far + line.lstrip().replace('\t', '    '))
-        all_lines = list(map(lambda line: list(pygments.lex(line.rstrip(), self.lexer)), all_lines))
-        all_lines = self.update_indents_stack(all_lines)
-        all_lines = self.update_spaces_and_nls(all_lines)
-        all_lines = self.update_tokens(all_lines)
-        tokens = [tok for line in all_lines for tok in line]
+        program = self.clean_program(input_program)
+        tokens = self.line_tokens(program, False)
         tokens = self.final_cleaning(tokens, False)
         return tokens
 
     def clean_with_lex(self, input_program):
+        # print(input_program)
+        # Store strings for later use
+        program, all_strings, all_string_types = self.clean_program_and_strings(input_program)
+        # print(all_strings, all_string_types)
+        tokens = self.line_tokens(program, True)
+        tokens = self.final_cleaning(tokens, True)
+        # Put strings back
+        # print('-' * 42 + '\n' + input_program + '\n' + '=' * 42 + '\n' + tokens.replace('_NEWLINE_ ', '\n') + '\n' + '*' * 42 + '\n')
+        return self.put_strings(tokens, all_strings, all_string_types)
+
+    def clean_program(self, input_program):
+        """
+        Returns the program (ending in a newline) without its comments and
+        with its strings replaced by "__string__".
+        """
+        return self.clean_program_and_strings(input_program)[0]
+
+    def clean_program_and_strings(self, input_program):
+        """
+        Returns the cleaned program (as clean_program), and the strings that
+        were replaced by "__string__" and their quotes, in their order in it.
+        The strings are recorded while they are replaced, so they are not
+        searched for in the program afterwards.
+        """
         program = input_program
-        # print(program)
         if len(input_program) > 1:
             if input_program[-1] != '\n':
                 program = input_program + '\n'
-        program = self.remove_comments_and_strings(program)
+        if MARKER_CHARS.search(program):
+            program = MARKER_CHARS.sub("\ufffd", program)
+        strings = []
+        program = self.remove_comments_and_strings(program, strings)
         # Some hacks for random errors
         if "’" in program:
             program = program.replace("’", "'")
-            program = self.remove_comments_and_strings(program)
-        # Store strings for later use
-        all_strings, all_string_types = self.get_comments_and_strings(input_program, program)
-        # print(all_strings, all_string_types)
-        # Clean tabs
-        all_lines = []
+            program = self.remove_comments_and_strings(program, strings)
+        order = []
+
+        def replace_marker(match):
+            order.append(int(match.group(1)))
+            return "__string__"
+
+        program = STRING_MARKER.sub(replace_marker, program)
+        return program, [strings[idx][0] for idx in order], [strings[idx][1] for idx in order]
+
+    def record_string(self, strings, string, stype):
+        """
+        Records the (cleaned) string with its quotes and returns its index.
+        The escaped quotes and the strings nested in it are put back, so it
+        is recorded as it was in the program.
+        """
+        def put_back_string(match):
+            quotes = MARKER_QUOTES[match.group(1)]
+            return quotes + strings[int(match.group(2))][0] + quotes
+
+        string = string.replace("__double_quote__", "\\\"").replace("__single_quote__", "\\\'")
+        string = string.replace("__inner_double_quote__", "\"").replace("__inner_single_quote__", "\'")
+        if MARKER_CHARS.search(string):
+            string = NESTED_STRING_MARKER.sub(put_back_string, string)
+        strings.append((string, stype))
+        return len(strings) - 1
+
+    def put_strings(self, tokens, all_strings, all_string_types):
+        """
+        Returns the actual tokens with the given strings (and their quotes) in
+        place of the _STRING_ tokens, or with "_some_string_" if they do not
+        match.
+        """
+        if tokens.count("_STRING_") == len(all_strings):
+            # The tokens are split once, instead of replacing each string
+            parts = tokens.split("_STRING_")
+            new_tokens = [parts[0]]
+            for string, stype, part in zip(all_strings, all_string_types, parts[1:]):
+                string = string.replace('\n', '_NEWLINE_').replace(' ', "_white_space_")
+                new_tokens.append(stype + string + stype + part)
+            tokens = "".join(new_tokens)
+        else:
+            tokens = tokens.replace('_STRING_', "\"_some_string_\"")
+        # print('-' * 42 + '\n' + '=' * 42 + '\n' + tokens.replace('_NEWLINE_ ', '\n') + '\n' + '*' * 42 + '\n')
+        return tokens
+
+    def lex_all(self, input_program):
+        """
+        Returns both the abstract (lex) and the actual (clean_with_lex) tokens
+        of the program from a single cleaning and lexing pass.
+        """
+        program, all_strings, all_string_types = self.clean_program_and_strings(input_program)
+        abstract_tokens, actual_tokens = self.aligned_tokens(program)
+        tokens = self.final_cleaning(abstract_tokens, False)
+        actual_tokens = self.final_cleaning(actual_tokens, True)
+        return tokens, self.put_strings(actual_tokens, all_strings, all_string_types)
+
+    def line_tokens(self, program, is_actual):
+        """
+        Returns the tokens of the lines of the (cleaned) program, with their
+        indents, dedents and newlines. The actual (clean_with_lex) tokens are
+        kept as they are, except for strings.
+        """
+        represent = self.choose_actual_represent if is_actual else self.choose_token_represent
+        return [represent(tok) for token_list in self.token_lines(program) for tok in token_list]
+
+    def aligned_tokens(self, program):
+        """
+        Returns the abstract and the actual tokens of the (cleaned) program,
+        i.e. one of each for every token of its lines, before the final
+        cleaning.
+        """
+        abstract_tokens = []
+        actual_tokens = []
+        for token_list in self.token_lines(program):
+            for tok in token_list:
+                abstract_tokens.append(self.choose_token_represent(tok))
+                actual_tokens.append(self.choose_actual_represent(tok))
+        return abstract_tokens, actual_tokens
+
+    def token_lines(self, program):
+        """
+        Yields the pygments tokens of each line of the (cleaned) program, with
+        its indents, dedents and newline. Each line is carried through the
+        indentation and token stages before the next one is lexed.
+        """
+        for token_list in self.stream_indents(self.stream_lines(program)):
+            yield self.merge_imaginary(self.update_spaces_and_nls([token_list])[0])
+
+    def stream_lines(self, program):
+        """
+        Yields the pygments tokens of each (tab cleaned) line of the program.
+        The lines are lexed separately, from the root state of the lexer, since
+        lexing the whole program at once carries the lexer's state across lines
+        (e.g. of unterminated strings), and it is not faster.
+        """
         for line in program.split('\n'):
             spaces_so_far = 0
             if len(line) > 0:
@@ -912,35 +1699,19 @@ class Lexer():
                             spaces_so_far = (spaces_so_far // 4 + 1) * 4
                         else:
                             break
-            all_lines.append(' ' * spaces_so_far + line.lstrip().replace('\t', '    '))
-        all_lines = list(map(lambda line: list(pygments.lex(line.rstrip(), self.lexer)), all_lines))
-        all_lines = self.update_indents_stack(all_lines)
-        all_lines = self.update_spaces_and_nls(all_lines)
-        all_lines = self.update_tokens_with_actual(all_lines)
-        tokens = [tok for line in all_lines for tok in line]
-        tokens = self.final_cleaning(tokens, True)
-        # Put strings back
-        # print('-' * 42 + '\n' + input_program + '\n' + '=' * 42 + '\n' + tokens.replace('_NEWLINE_ ', '\n') + '\n' + '*' * 42 + '\n')
-        if tokens.count("_STRING_") == len(all_strings):
-            # prev_len = len(tokens.split())
-            # new_tokens = tokens
-            for string, stype in zip(all_strings, all_string_types):
-                if ' ' in string:
-                    string = string.replace(' ', "_white_space_")
-                tokens = tokens.replace('_STRING_', stype + string + stype, 1)
-            # print(len(new_tokens.split()), prev_len)
-            # print(new_tokens.split())
-            # print(tokens.split())
-            # if len(new_tokens.split()) == len(tokens.split()):
-            #     tokens = new_tokens
-            # else:
-            #     tokens = tokens.replace('_STRING_', "\"_some_string_\"")
-        else:
-            tokens = tokens.replace('_STRING_', "\"_some_string_\"")
-        # print('-' * 42 + '\n' + '=' * 42 + '\n' + tokens.replace('_NEWLINE_ ', '\n') + '\n' + '*' * 42 + '\n')
-        return tokens
+            line = (' ' * spaces_so_far + line.lstrip().replace('\t', '    ')).rstrip()
+            if '\r' in line or line.startswith('\ufeff'):
+                # Lines that need pygments' preprocessing (of newlines and BOMs)
+                yield list(pygments.lex(line, self.lexer))
+            else:
+                yield [(ttype, value) for _, ttype, value in self.lexer.get_tokens_unprocessed(line + '\n')]
 
-    def remove_comments_and_strings(self, input_prog):
+    def remove_comments_and_strings(self, input_prog, strings):
+        """
+        Returns the program without its comments and with its strings replaced
+        by markers, which are recorded in the given strings (with their quotes)
+        and replaced by "__string__" in clean_program_and_strings.
+        """
         prog = input_prog.replace("\r\n", "\n")
         prog = re.sub(re.compile(r"\\\s*?\n") , "\n" , prog)
         # Temporary replacements
@@ -950,95 +1721,80 @@ class Lexer():
         prog = prog.replace("__temporary__", "\\\\")
         # String and comment replacements
         prog = re.sub(re.compile(r"\n\s*#.*?\n") , "\n\n" , prog)
-        prog = re.sub(re.compile(r"\"\"\".*?\"\"\"", flags=re.DOTALL) , "__triple_dstring__" , prog)
-        prog = re.sub(re.compile(r"\'\'\'.*?\'\'\'", flags=re.DOTALL) , "__triple_sstring__" , prog)
-        in_double_quote = False
-        in_single_quote = False
-        in_comment = False
-        new_prog = ""
-        for char in prog:
-            if not in_comment:
-                if not in_double_quote and not in_single_quote and char == "#":
-                    in_comment = True
-                    new_prog += char
-                elif not in_double_quote and not in_single_quote and char == "\"":
-                    in_double_quote = True
-                    new_prog += char
-                elif not in_double_quote and not in_single_quote and char == "\'":
-                    in_single_quote = True
-                    new_prog += char
-                elif in_double_quote and not in_single_quote and char == "\"":
-                    in_double_quote = False
-                    new_prog += char
-                elif in_double_quote and not in_single_quote and char == "\'":
-                    new_prog += "__single_quote__"
-                elif not in_double_quote and in_single_quote and char == "\'":
-                    in_single_quote = False
-                    new_prog += char
-                elif not in_double_quote and in_single_quote and char == "\"":
-                    new_prog += "__double_quote__"
-                else:
-                    new_prog += char
-            else:
-                if char ==  "\n":
-                    in_comment = False
-                    new_prog += char
-                elif char == "\'":
-                    new_prog += "__single_quote__"
-                elif char == "\"":
-                    new_prog += "__double_quote__"
-                else:
-                    new_prog += char
-        prog = new_prog
-        prog = re.sub(re.compile(r"\"([^(\"|\'|\n)]|\(|\)|\|)*?\"") , "\"__string__\"" , prog)
-        prog = re.sub(re.compile(r"\'([^(\"|\'|\n)]|\(|\)|\|)*?\'") , "\'__string__\'" , prog)
-        prog = prog.replace("__triple_dstring__", "\"__string__\"")
-        prog = prog.replace("__triple_sstring__", "\'__string__\'")
+        prog = re.sub(re.compile(r"\"\"\"(.*?)\"\"\"", flags=re.DOTALL),
+                      lambda match: "\ue002%d\ue001" % self.record_string(strings, match.group(1), "\"\"\""), prog)
+        prog = re.sub(re.compile(r"\'\'\'(.*?)\'\'\'", flags=re.DOTALL),
+                      lambda match: "\ue003%d\ue001" % self.record_string(strings, match.group(1), "\'\'\'"), prog)
+        # Quotes inside strings (of the other type) and comments are escaped,
+        # jumping from each string or comment to its end
+        new_prog = []
+        pos = 0
+        while pos < len(prog):
+            match = QUOTES_AND_COMMENTS.search(prog, pos)
+            if match is None:
+                new_prog.append(prog[pos:])
+                break
+            start = match.start()
+            char = prog[start]
+            end = prog.find("\n" if char == "#" else char, start + 1)
+            end = len(prog) if end < 0 else end
+            inside = prog[start + 1:end]
+            if char != "\'":
+                inside = inside.replace("\'", "__inner_single_quote__")
+            if char != "\"":
+                inside = inside.replace("\"", "__inner_double_quote__")
+            # The string or comment with its start and end (if any)
+            new_prog.append(prog[pos:start + 1] + inside + prog[end:end + 1])
+            pos = end + 1
+        prog = self.mark_strings("".join(new_prog), strings)
+        prog = re.sub("\ue002(\\d+)\ue001", "\"\ue000\\1\ue001\"", prog)
+        prog = re.sub("\ue003(\\d+)\ue001", "\'\ue000\\1\ue001\'", prog)
         prog = re.sub(re.compile(r"#.*?\n" ) , "\n" , prog)
         prog = re.sub(re.compile(r"\n\s+\n" ) , "\n\n" , prog)
         # while prog.find('\n\n') >= 0:
         #     prog = prog.replace('\n\n', '\n')
-        return prog
-
-    def get_comments_and_strings(self, input_prog, prog):
-        strings = []
-        string_types = []
-        clean_input_prog = input_prog.replace("\r\n", "\n")
-        clean_input_prog = clean_input_prog.replace("’", "'")
-        if len(clean_input_prog) > 1:
-            if clean_input_prog[-1] != '\n':
-                clean_input_prog = clean_input_prog + '\n'
-        clean_input_prog = re.sub(re.compile(r"\\\s*?\n") , "" , clean_input_prog)
-        clean_input_prog = re.sub(re.compile(r"\n\s*#.*?\n") , "\n\n" , clean_input_prog)
-        clean_input_prog = re.sub(re.compile(r"#[^\'\"]*?\n" ) , "\n" , clean_input_prog)
-        clean_input_prog = re.sub(re.compile(r"\n\s+\n" ) , "\n\n" , clean_input_prog)
-        # while clean_input_prog.find('\n\n') >= 0:
-        #     clean_input_prog = clean_input_prog.replace('\n\n', '\n')
-        # print("=*" * 42 + "=")
-        # print(clean_input_prog)
-        parts = prog.split("__string__")
-        # print(parts)
-        while parts:
-            part = parts.pop(0)
-            clean_input_prog = clean_input_prog.replace(part, '', 1)
-            if parts == [] or clean_input_prog == "" or clean_input_prog.split(parts[0]) == []:
-                break
-            split_prog = clean_input_prog.split(parts[0])
-            strings.append(split_prog[0].replace('\n', '_NEWLINE_'))
-            clean_input_prog = clean_input_prog.replace(strings[-1], '', 1)
-            if len(clean_input_prog) > 2 and clean_input_prog[:3] == "\"\"\"":
-                string_types.append("\"\"\"")
-            elif len(clean_input_prog) > 2 and clean_input_prog[:3] == "\'\'\'":
-                string_types.append("\'\'\'")
-            elif len(clean_input_prog) > 0 and clean_input_prog[0] == "\"":
-                string_types.append("\"")
-            elif len(clean_input_prog) > 0 and clean_input_prog[0] == "\'":
-                string_types.append("\'")
-            else:
-                string_types.append("\"")
-        return strings, string_types
+        prog = prog.replace("__inner_single_quote__", "__single_quote__")
+        return prog.replace("__inner_double_quote__", "__double_quote__")
 
-    def update_indents_stack(self, all_lines):
+    def mark_strings(self, prog, strings):
+        """
+        Returns the program with its (single line) strings replaced by markers
+        in a single pass, recording them in the given strings. A quote starts
+        a string, which ends at the next quote of the same type, unless a quote
+        of the other type or a newline comes first (the quotes of the other
+        type inside the strings were escaped before).
+        """
+        new_prog = []
+        pos = 0
+        # The start of the open string, if any, and its quote
+        start = None
+        quote = None
+        for match in QUOTES_AND_NEWLINES.finditer(prog):
+            end = match.start()
+            char = prog[end]
+            if start is None or char != quote:
+                start, quote = (None, None) if char == "\n" else (end, char)
+                continue
+            string = prog[start + 1:end]
+            if not STRING_MARKER.fullmatch(string):
+                # The strings that were marked before the retry of
+                # clean_program_and_strings are kept as they are
+                string = "\ue000%d\ue001" % self.record_string(strings, string, quote)
+            new_prog.append(prog[pos:start + 1] + string)
+            pos = end
+            start = None
+            quote = None
+        new_prog.append(prog[pos:])
+        return "".join(new_prog)
+
+    def stream_indents(self, token_lines):
+        """
+        Yields the tokens of the given lines with their indents and dedents,
+        and without the newlines of the lines that are continued (e.g. inside
+        brackets), one line at a time. The last line is kept back until the
+        next one, which may remove its newline (or the whole line) if it
+        continues it.
+        """
         all_line_tokens = []
         lst_token_prev_line = False
         fst_token_this_line = False
@@ -1046,7 +1802,7 @@ class Lexer():
         paren_so_far = 0
         curly_so_far = 0
         square_so_far = 0
-        for token_list in all_lines:
+        for token_list in token_lines:
             fst_token = token_list[0]
             tok_idx = 0
             fst_real_token = token_list[tok_idx]
@@ -1101,31 +1857,32 @@ class Lexer():
                 all_line_tokens.append(token_list)
             if len(token_list) > 1:
                 lst_token = token_list[-2]
+                # The bracket depths in a single scan of the line
                 for tok in token_list:
-                    if tok[0] in Punctuation and tok[1] == '(':
-                        paren_so_far += 1
-                    elif tok[0] in Punctuation and tok[1] == ')':
-                        paren_so_far -= 1
-                for tok in token_list:
-                    if tok[0] in Punctuation and tok[1] == '{':
-                        curly_so_far += 1
-                    elif tok[0] in Punctuation and tok[1] == '}':
-                        curly_so_far -= 1
-                for tok in token_list:
-                    if tok[0] in Punctuation and tok[1] == '[':
-                        square_so_far += 1
-                    elif tok[0] in Punctuation and tok[1] == ']':
-                        square_so_far -= 1
+                    if tok[0] in Punctuation:
+                        if tok[1] == '(':
+                            paren_so_far += 1
+                        elif tok[1] == ')':
+                            paren_so_far -= 1
+                        elif tok[1] == '{':
+                            curly_so_far += 1
+                        elif tok[1] == '}':
+                            curly_so_far -= 1
+                        elif tok[1] == '[':
+                            square_so_far += 1
+                        elif tok[1] == ']':
+                            square_so_far -= 1
                 lst_token_prev_line = lst_token[0] in Punctuation and lst_token[1] in ['\\', '{', '(', '[']
                 lst_token_prev_line |= lst_token[0] in Punctuation and lst_token[1] == ','  and (paren_so_far > 0 or curly_so_far > 0 or square_so_far > 0)
                 lst_token_prev_line |= token_list[-1][0] in Text and token_list[-1][1] == '\\\n'
                 lst_token_prev_line |= lst_token[0] in Punctuation and lst_token[1] == ':' and curly_so_far > 0
                 lst_token_prev_line |= lst_token[0] in Operator and lst_token[1] in ['+', '-', '*', '/', '//', '%', '==', '!=', 'in', 'or', 'and'] and (paren_so_far > 0 or curly_so_far > 0 or square_so_far > 0)
                 lst_token_prev_line |= lst_token[0] in String and (paren_so_far > 0 or curly_so_far > 0 or square_so_far > 0)
+            while len(all_line_tokens) > 1:
+                yield all_line_tokens.pop(0)
         if len(indents) > 0:
             all_line_tokens.append([(Text, '_DEDENT_')] * len(indents))
-        return all_line_tokens
-
+        yield from all_line_tokens
 
     def update_spaces_and_nls(self, all_lines):
         def is_space(token):
@@ -1141,23 +1898,20 @@ class Lexer():
                 all_line_tokens.append(token_list_no_spaces)
         return all_line_tokens
 
-    def update_tokens(self, all_lines):
-        all_line_tokens = []
-        for token_list in all_lines:
-            new_token_list = []
-            prev_num = False
-            for tok in token_list:
-                if tok[0] in Number:
-                    prev_num = True
-                else:
-                    if prev_num and tok[0] in Name and tok[1] == 'j':
-                        prev_tok = new_token_list.pop()
-                        tok = (prev_tok[0], prev_tok[1] + 'j')
-                    prev_num = False
-                new_token_list.append(tok)
-            new_token_list = list(map(self.choose_token_represent, new_token_list))
-            all_line_tokens.append(new_token_list)
-        return all_line_tokens
+    def merge_imaginary(self, token_list):
+        # Numbers followed by a j are (imaginary) numbers
+        new_token_list = []
+        prev_num = False
+        for tok in token_list:
+            if tok[0] in Number:
+                prev_num = True
+            else:
+                if prev_num and tok[0] in Name and tok[1] == 'j':
+                    prev_tok = new_token_list.pop()
+                    tok = (prev_tok[0], prev_tok[1] + 'j')
+                prev_num = False
+            new_token_list.append(tok)
+        return new_token_list
 
     def choose_token_represent(self, token):
         if token[0] in Name and token[1] != '.':
@@ -1168,73 +1922,18 @@ class Lexer():
             return '_STRING_'
         return token[1]
 
-    def update_tokens_with_actual(self, all_lines):
-        all_line_tokens = []
-        for token_list in all_lines:
-            new_token_list = []
-            prev_num = False
-            for tok in token_list:
-                if tok[0] in Number:
-                    prev_num = True
-                else:
-                    if prev_num and tok[0] in Name and tok[1] == 'j':
-                        prev_tok = new_token_list.pop()
-                        tok = (prev_tok[0], prev_tok[1] + 'j')
-                    prev_num = False
-                new_token_list.append(tok)
-            # Abstract String tokens for now. Will insert them back later
-            new_token_list = list(map(lambda x: '_STRING_' if x[0] in String else x[1], new_token_list))
-            all_line_tokens.append(new_token_list)
-        return all_line_tokens
+    def choose_actual_represent(self, token):
+        # Abstract String tokens for now. Will insert them back later
+        return '_STRING_' if token[0] in String else token[1]
 
     def final_cleaning(self, tokens, is_actual):
         tokens.append('_ENDMARKER_')
         tokens = " ".join(tokens)
-        tokens = tokens.replace('* *', "**")
-        tokens = tokens.replace('= =', "==")
-        tokens = tokens.replace('< =', "<=")
-        tokens = tokens.replace('> =', ">=")
-        tokens = tokens.replace('! =', "!=")
-        tokens = tokens.replace('< <', "<<")
-        tokens = tokens.replace("> >", ">>")
-        tokens = tokens.replace('& &', "&&")
-        tokens = tokens.replace('| |', "||")
-        tokens = tokens.replace('/ /', "//")
-        tokens = tokens.replace('+ =', "+=")
-        tokens = tokens.replace('- =', "-=")
-        tokens = tokens.replace('/ =', "/=")
-        tokens = tokens.replace('* =', "*=")
-        tokens = tokens.replace('>> =', ">>=")
-        tokens = tokens.replace('<< =', "<<=")
-        tokens = tokens.replace('&& =', "&&=")
-        tokens = tokens.replace('!! =', "!!=")
-        tokens = tokens.replace('// =', "//=")
-        tokens = tokens.replace('% =', "%=")
-        tokens = tokens.replace('@', "@ ")
-        tokens = tokens.replace('@ =', "@=")
-        tokens = tokens.replace('| =', "|=")
-        tokens = tokens.replace('& =', "&=")
-        tokens = tokens.replace('^ =', "^=")
-        # tokens = tokens.replace(", ;", ";")
-        tokens = tokens.replace(". . .", "...")
-        if not is_actual:
-            tokens = tokens.replace("not in", "not_in")
-            tokens = tokens.replace("is not", "is_not")
-            tokens = tokens.replace("- >", "_arrow_")
-        else:
-            tokens = tokens.replace("- >", "->")
-        while tokens.find('_STRING_ _STRING_') >= 0:
-            tokens = tokens.replace('_STRING_ _STRING_', '_STRING_')
-        # while tokens.find(' : _NEWLINE_ _NEWLINE_ ') >= 0:
-        #     tokens = tokens.replace(' : _NEWLINE_ _NEWLINE_ ', ' : _NEWLINE_ ')
-        while tokens.find('. _NUMBER_') >= 0:
-            tokens = tokens.replace('. _NUMBER_', '_NUMBER_')
-        while tokens.find('_NEWLINE_ )') >= 0:
-            tokens = tokens.replace('_NEWLINE_ )', ')')
-        while tokens.find('_NEWLINE_ ]') >= 0:
-            tokens = tokens.replace('_NEWLINE_ ]', ']')
-        while tokens.find('_NEWLINE_ }') >= 0:
-            tokens = tokens.replace('_NEWLINE_ }', '}')
+        # The merges are applied in order with non-overlapping replacements
+        # (e.g. '= = =' becomes '== ='), so they stay string replacements
+        for old, new in TOKEN_MERGES + (ACTUAL_TOKEN_MERGES if is_actual else ABSTRACT_TOKEN_MERGES):
+            tokens = tokens.replace(old, new)
+        tokens = TOKEN_RUNS.sub(lambda m: m.group(0).rsplit(' ', 1)[-1], tokens)
         # print(tokens.replace('_NEWLINE_ ', '\n'))
         if not is_actual:
             tokens = " ".join(map(lambda t: t if t in self.terminals else '_UNKNOWN_', tokens.split()))
@@ -1371,18 +2070,22 @@ def get_repaired_seq_for_1(rule_sequences, grammar):
     return (' '.join(abstract_fixed_seq), ' '.join(fixed_seq), ' '.join(fixed_seq_ops), rule_sequences[1], rule_sequences[2])
 
 
-def fixed_lexed_prog(lexed_prog, grammar, max_cost):
+def fixed_lexed_prog(lexed_prog, grammar, max_cost, strategy="passes"):
     def run_parse(sentence):
-        parser = ErrorEarleyParse(sentence, grammar, max_cost)
-        parser.parse()
-        return parser.get_fixed_seq(), parser.chart
-
-    parsed, _ = run_parse(lexed_prog)
-    if parsed is None:
+        parser = ErrorEarleyParse(sentence, grammar, max_cost, strategy=strategy)
+        with instrumentation.stage('parse'):
+            parser.parse()
+        with instrumentation.stage('get_fixed_seq'):
+            repair = parser.get_repair()
+        if instrumentation.current() is not None:
+            for name, num in parser.counters().items():
+                instrumentation.count(name, num)
+        return repair
+
+    repair = run_parse(lexed_prog)
+    if repair is None:
         return (None, None, None, None, None)
-    elif not parsed:
-        return (None, None, None, None, None)
-    return get_repaired_seq_for_1(parsed, grammar)
+    return repair
 
 
 def repair_prog(actual_tokens, fix_seq_operations):
@@ -1503,13 +2206,25 @@ def concretize_seq(seq, grammar):
 
 
 def get_token_list(prog, terminals):
-    lexer = Lexer(terminals)
-    return lexer.lex(prog)
+    with instrumentation.stage('lex'):
+        lexer = Lexer(terminals)
+        return lexer.lex(prog)
 
 
 def get_actual_token_list(prog, terminals):
-    lexer = Lexer(terminals)
-    return lexer.clean_with_lex(prog)
+    with instrumentation.stage('clean_with_lex'):
+        lexer = Lexer(terminals)
+        return lexer.clean_with_lex(prog)
+
+
+def get_token_lists(prog, terminals):
+    """
+    Returns both get_token_list and get_actual_token_list of the program, from
+    a single lexing pass.
+    """
+    with instrumentation.stage('lex'):
+        lexer = Lexer(terminals)
+        return lexer.lex_all(prog)
 
 
 def main():
@@ -375,7 +375,7 @@ class State():
 
     GAM = '<GAM>'
 
-    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back_pointers=[]):
+    def __init__(self, rule, dot=0, sent_pos=0, chart_pos=0, error_count=0, back=None):
         # CFG Rule.
         self.rule = rule
         # Dot position in the rule.
@@ -387,11 +387,11 @@ class State():
         # Error counter
         self.error_count = error_count
         # Pointers to child states (if the given state was generated using
-        # Completer).
-        self.back_pointers = back_pointers
-        # Hash for the back_pointers for efficient usage
-        self.own_hash = hash((self.rule, self.dot, self.sent_pos, self.error_count)) + \
-            hash(", ".join(str(hash(s)) for s in back_pointers) if back_pointers else hash("empty"))
+        # Completer), as a cons list (last child, rest) that shares its tail
+        # with the state the dot was moved from
+        self.back = back
+        # Hash for the back pointers (of the child states' hashes) for efficient usage
+        self.own_hash = hash((self.rule, self.dot, self.sent_pos, self.error_count)) + hash(back)
 
     def __eq__(self, other):
         if isinstance(other, State):
@@ -406,6 +406,20 @@ class State():
     def __len__(self):
         return len(self.rule)
 
+    @property
+    def back_pointers(self):
+        """
+        Returns the child states in order, unrolling the cons list.
+        """
+
+        children = []
+        back = self.back
+        while back is not None:
+            children.append(back[0])
+            back = back[1]
+        children.reverse()
+        return children
+
     def __repr__(self):
         return self.__str__()
 
@@ -596,7 +610,7 @@ class ErrorEarleyParse():
                     self.chart[pos].add(self.grammar, State(prev_state.rule,
                         dot=(prev_state.dot + 1), sent_pos=prev_state.sent_pos,
                         chart_pos=pos,
-                        back_pointers=(prev_state.back_pointers + [state]),
+                        back=(state, prev_state.back),
                         error_count=new_cost))
             # runs += 1
         # print("Chart[" + str(pos) + "]")
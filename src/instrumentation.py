@@ -0,0 +1,137 @@
+"""
+Opt-in per-stage timers and counters of the repair pipeline.
+
+A Profile is only collected for the code that runs in a `with profile():`
+block (in the same thread); otherwise the stages and counters of the pipeline
+are no-ops. Histograms aggregates the profiles of many programs, e.g. in the
+evaluation drivers.
+
+@author: Georgios Sakkas
+"""
+
+import timeit
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import local
+
+# The profile of each thread (if any)
+CURRENT = local()
+
+
+class Profile():
+    """
+    Times (in seconds) and counters of the stages of the repair of a program.
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def merge(self, other):
+        """
+        Adds the given profile (or its as_dict) to this one.
+        """
+        if isinstance(other, Profile):
+            other = other.as_dict()
+        for name, ms in other["timings_ms"].items():
+            self.timings[name] += ms / 1000.0
+        for name, num in other["counters"].items():
+            self.counters[name] += num
+
+    def as_dict(self):
+        return {"timings_ms": dict((name, 1000.0 * secs) for name, secs in self.timings.items()),
+                "counters": dict(self.counters)}
+
+
+def current():
+    """
+    Returns the profile of the current thread, or None if it is not profiled.
+    """
+    return getattr(CURRENT, 'profile', None)
+
+
+@contextmanager
+def profile(prof=None, enabled=True):
+    """
+    Collects the stages and counters of the enclosed code in the given (or a
+    new) Profile. Nothing is collected (and None is given) if not enabled.
+    """
+    if not enabled:
+        yield None
+        return
+    if prof is None:
+        prof = Profile()
+    previous = current()
+    CURRENT.profile = prof
+    try:
+        yield prof
+    finally:
+        CURRENT.profile = previous
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed code as the given stage (if profiled).
+    """
+    prof = current()
+    if prof is None:
+        yield
+        return
+    start_time = timeit.default_timer()
+    try:
+        yield
+    finally:
+        prof.timings[name] += timeit.default_timer() - start_time
+
+
+def count(name, num=1):
+    prof = current()
+    if prof is not None:
+        prof.counters[name] += num
+
+
+def add_time(name, secs, prof=None):
+    prof = current() if prof is None else prof
+    if prof is not None:
+        prof.timings[name] += secs
+
+
+class Histograms():
+    """
+    Histograms of the timings (ms) and counters of many profiles, in
+    logarithmic (power of 2) buckets.
+    """
+
+    BUCKETS = [2 ** i for i in range(32)]
+
+    def __init__(self):
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.totals = defaultdict(float)
+        self.profiles = 0
+
+    def add(self, prof):
+        """
+        Adds the given profile (or its as_dict).
+        """
+        if isinstance(prof, Profile):
+            prof = prof.as_dict()
+        self.profiles += 1
+        for kind in ["timings_ms", "counters"]:
+            for name, value in prof[kind].items():
+                name = kind.split('_')[0] + '.' + name
+                bucket = self.BUCKETS[min(bisect_left(self.BUCKETS, value), len(self.BUCKETS) - 1)]
+                self.histograms[name][bucket] += 1
+                self.totals[name] += value
+
+    def report(self):
+        """
+        Returns the histograms as text, with the mean of each value.
+        """
+        lines = []
+        for name in sorted(self.histograms):
+            lines.append(">> " + name + " (mean = " + "{:.2f}".format(self.totals[name] / max(self.profiles, 1)) + ")")
+            for bucket, num in sorted(self.histograms[name].items()):
+                lines.append("   <= {:>10} : {}".format(bucket, num))
+        return '\n'.join(lines)
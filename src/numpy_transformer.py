@@ -0,0 +1,204 @@
+"""
+Pure NumPy (CPU) inference for the transformer classifier of
+transformer_classifier.py, using the weights of a trained Keras model (.h5),
+so that the error rules can be predicted without importing TensorFlow.
+
+@author: Georgios Sakkas
+"""
+
+import re
+import numpy as np
+
+# The (last two parts of the) names of the weights of the Keras layers, in
+# their order, as regular expressions (Keras numbers repeated sub-layers)
+EMBEDDING_WEIGHTS = [r"embedding(_\d+)?/embeddings"] * 2
+BLOCK_WEIGHTS = ["query/kernel", "query/bias", "key/kernel", "key/bias", "value/kernel", "value/bias",
+                 "attention_output/kernel", "attention_output/bias",
+                 r"dense(_\d+)?/kernel", r"dense(_\d+)?/bias", r"dense(_\d+)?/kernel", r"dense(_\d+)?/bias",
+                 r"layer_normalization(_\d+)?/gamma", r"layer_normalization(_\d+)?/beta",
+                 r"layer_normalization(_\d+)?/gamma", r"layer_normalization(_\d+)?/beta"]
+DENSE_WEIGHTS = [r"dense(_\d+)?/kernel", r"dense(_\d+)?/bias"]
+
+
+def pad_sequences(xs, maxlen):
+    """
+    Pads (with 0s) and truncates the given sequences at their start to maxlen,
+    like keras.preprocessing.sequence.pad_sequences with the default options.
+    """
+    padded = np.zeros((len(xs), maxlen), dtype='int32')
+    for i, x in enumerate(xs):
+        x = x[-maxlen:]
+        if len(x) > 0:
+            padded[i, -len(x):] = x
+    return padded
+
+
+def relu(x):
+    return np.maximum(x, 0.0)
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def layer_norm(x, gamma, beta, eps=1e-6):
+    mean = x.mean(axis=-1, keepdims=True)
+    var = ((x - mean) ** 2).mean(axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + eps) * gamma + beta
+
+
+def check_weights(layer_name, weights, patterns):
+    """
+    Raises a ValueError unless the names of the weights of the layer are
+    exactly the given patterns, in order.
+    """
+    names = [n for n, _ in weights]
+    if len(names) != len(patterns) or not all(re.fullmatch(p, n) for p, n in zip(patterns, names)):
+        raise ValueError("Unexpected weights " + str(names) + " of layer " + layer_name)
+
+
+def check_shape(layer_name, weight, shape):
+    if weight.shape != shape:
+        raise ValueError("Unexpected shape " + str(weight.shape) + " (instead of " + str(shape) + ") in layer " + layer_name)
+
+
+def read_weights(weights_file):
+    """
+    Returns the (name, weights) pairs of the layers with weights of the Keras
+    model in the given .h5 file, in the order of the model's layers. The
+    weights of a layer are by their names (e.g. 'query/kernel').
+    """
+    # h5py is only needed to load the weights
+    import h5py
+
+    layers = []
+    with h5py.File(weights_file, 'r') as f:
+        if 'model_weights' in f:
+            f = f['model_weights']
+        for layer_name in f.attrs['layer_names']:
+            layer_name = layer_name.decode('utf8') if isinstance(layer_name, bytes) else layer_name
+            group = f[layer_name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            if weight_names:
+                # Keep the last two parts of the names, i.e. sub-layer/weight
+                layers.append((layer_name, [('/'.join(n.split(':')[0].split('/')[-2:]), np.asarray(group[n], dtype='float32'))
+                                            for n in weight_names]))
+    return layers
+
+
+class NumpyTransformerBlock():
+    """
+    Transformer block (multi-head self-attention, layer norms and feed forward
+    network) of transformer_classifier.TransformerBlock.
+    """
+
+    def __init__(self, weights, layer_name='transformer_block'):
+        check_weights(layer_name, weights, BLOCK_WEIGHTS)
+        attention = dict((n, w) for n, w in weights if n.split('/')[0] in ['query', 'key', 'value', 'attention_output'])
+        # (embed_dim, num_heads, key_dim) for query, key and value, and
+        # (num_heads, key_dim, embed_dim) for the attention output
+        self.query, self.query_bias = attention['query/kernel'], attention['query/bias']
+        self.key, self.key_bias = attention['key/kernel'], attention['key/bias']
+        self.value, self.value_bias = attention['value/kernel'], attention['value/bias']
+        self.attention_output = attention['attention_output/kernel']
+        self.attention_output_bias = attention['attention_output/bias']
+        # The rest of the sub-layers in the order of their weights, i.e. the
+        # feed forward network and the two layer norms
+        rest = [(n, w) for n, w in weights if n not in attention]
+        kernels = [w for n, w in rest if n.endswith('kernel')]
+        biases = [w for n, w in rest if n.endswith('bias')]
+        gammas = [w for n, w in rest if n.endswith('gamma')]
+        betas = [w for n, w in rest if n.endswith('beta')]
+        self.ffn_1, self.ffn_2 = kernels
+        self.ffn_1_bias, self.ffn_2_bias = biases
+        self.layernorm1 = (gammas[0], betas[0])
+        self.layernorm2 = (gammas[1], betas[1])
+        self.num_heads, self.key_dim = self.query.shape[1:]
+        embed_dim = self.query.shape[0]
+        for w, shape in [(self.key, self.query.shape), (self.value, self.query.shape),
+                         (self.attention_output, (self.num_heads, self.key_dim, embed_dim)),
+                         (self.ffn_1, (embed_dim, self.ffn_1.shape[1])), (self.ffn_2, (self.ffn_1.shape[1], embed_dim))] + \
+                        [(w, (embed_dim,)) for w in list(self.layernorm1) + list(self.layernorm2)]:
+            check_shape(layer_name, w, shape)
+        self.scale = np.float32(1.0 / np.sqrt(self.key_dim))
+        # The same projections as (embed_dim, num_heads * key_dim) matrices,
+        # so that they are plain matmuls
+        self.qkv = [(w.reshape(w.shape[0], -1), b.reshape(-1)) for w, b in
+                    [(self.query, self.query_bias), (self.key, self.key_bias), (self.value, self.value_bias)]]
+        self.output = self.attention_output.reshape(-1, self.attention_output.shape[-1])
+
+    def attention(self, x):
+        batch, steps, _ = x.shape
+        # (batch, num_heads, steps, key_dim)
+        query, key, value = [(x @ w + b).reshape(batch, steps, self.num_heads, self.key_dim).transpose(0, 2, 1, 3)
+                             for w, b in self.qkv]
+        scores = softmax((query * self.scale) @ key.transpose(0, 1, 3, 2))
+        attention = (scores @ value).transpose(0, 2, 1, 3).reshape(batch, steps, -1)
+        return attention @ self.output + self.attention_output_bias
+
+    def __call__(self, x):
+        out1 = layer_norm(x + self.attention(x), *self.layernorm1)
+        ffn_output = relu(out1 @ self.ffn_1 + self.ffn_1_bias) @ self.ffn_2 + self.ffn_2_bias
+        return layer_norm(out1 + ffn_output, *self.layernorm2)
+
+
+class NumpyTransformerClassifier():
+    """
+    Inference-only NumPy implementation of
+    transformer_classifier.TransformerClassifier (token and position
+    embeddings, transformer blocks, average pooling and dense layers), with
+    the same predict_fast interface.
+    """
+
+    def __init__(self, weights_file, active='sigmoid'):
+        self.activation = active
+        self.blocks = []
+        self.dense_layers = []
+        # The weights are mapped by their names and order, so any other model
+        # (i.e. other layers or weights than those of TransformerClassifier)
+        # is refused rather than silently computed differently
+        layers = read_weights(weights_file)
+        kinds = ''.join('e' if name.startswith('token_and_position_embedding') else
+                        't' if name.startswith('transformer_block') else
+                        'd' if name.startswith('dense') else '?' for name, _ in layers)
+        if not re.fullmatch('et+d+', kinds):
+            raise ValueError("Unexpected layers " + str([name for name, _ in layers]) + " in " + str(weights_file))
+        for layer_name, weights in layers:
+            if layer_name.startswith('token_and_position_embedding'):
+                check_weights(layer_name, weights, EMBEDDING_WEIGHTS)
+                # The token embedding is created before the position embedding
+                self.token_emb, self.pos_emb = [w for _, w in weights]
+                check_shape(layer_name, self.pos_emb, (self.pos_emb.shape[0], self.token_emb.shape[1]))
+            elif layer_name.startswith('transformer_block'):
+                self.blocks.append(NumpyTransformerBlock(weights, layer_name))
+                check_shape(layer_name, self.blocks[-1].query, (self.token_emb.shape[1],) + self.blocks[-1].query.shape[1:])
+            else:
+                check_weights(layer_name, weights, DENSE_WEIGHTS)
+                kernel, bias = [w for _, w in weights]
+                inputs = self.dense_layers[-1][0].shape[1] if self.dense_layers else self.token_emb.shape[1]
+                check_shape(layer_name, kernel, (inputs, bias.shape[0]))
+                self.dense_layers.append((kernel, bias))
+        self.maxlen = self.pos_emb.shape[0]
+
+    def predict_fast(self, xs):
+        """
+        Returns the label probabilities of the given (padded) token ids.
+        """
+        xs = np.asarray(xs).astype('int64')
+        x = self.token_emb[xs] + self.pos_emb[:xs.shape[-1]]
+        for block in self.blocks:
+            x = block(x)
+        x = x.mean(axis=1)
+        for kernel, bias in self.dense_layers[:-1]:
+            x = relu(x @ kernel + bias)
+        kernel, bias = self.dense_layers[-1]
+        x = x @ kernel + bias
+        return sigmoid(x) if self.activation == 'sigmoid' else softmax(x)
+
+    def predict(self, xs):
+        return self.predict_fast(xs)
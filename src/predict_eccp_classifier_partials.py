@@ -4,17 +4,20 @@ from os.path import join, exists
 from collections import defaultdict
 import json
 import pickle
+import hashlib
 from functools import partial
+import timeit
+from threading import Lock, Thread, Event
+from queue import Queue, Empty
 from pathlib import Path
-from tensorflow import keras
-import tensorflow as tf
 from random import shuffle, seed
-from sklearn.preprocessing import MultiLabelBinarizer
 from statistics import median_high
-from numpy import argsort, array
+from numpy import argsort, array, frombuffer, asarray
 from concurrent.futures import TimeoutError
-from transformer_classifier import TransformerClassifier
+from numpy_transformer import NumpyTransformerClassifier, pad_sequences
 from ecpp_individual_grammar import read_grammar, get_token_list
+from caches import PredictionCache
+import instrumentation
 import earleyparser_interm_repr
 
 
@@ -24,103 +27,320 @@ def read_sample(samp):
     return (samp_1[0], samp_2, int(samp_1[2]), float(samp_1[3]), samp_1[4] == "popular")
 
 
-def predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, sfile, do_sfile=False, max_erules=20):
-    saved_model_file = join(modelsDir, 'transformer-classifier-partial-parses-probs.h5')
-    xs_test = input_prog
-    if sfile or do_sfile:
-        INTERIM_GRAMMAR = earleyparser_interm_repr.read_grammar(grammarFile)
-        rules_used = {}
-        with open(join(modelsDir, "rules_usage.json"), "r") as in_file:
-            rules_used = json.load(in_file)
-        INTERIM_GRAMMAR.update_probs(rules_used)
+# Hyper-parameters of the trained transformer classifier
+VOCAB_SIZE = 182
+X_MAXLEN = 128
+NUM_OF_LABELS = 150
 
-        ERROR_GRAMMAR = read_grammar(grammarFile)
-        terminals = ERROR_GRAMMAR.get_alphabet()
-        if sfile:
-            tokens = get_token_list(input_prog, terminals)
-            upd_tokens, _ = earleyparser_interm_repr.get_updated_seq(tokens, INTERIM_GRAMMAR)
-            xs_test = [upd_tokens]
-        elif do_sfile:
-            xs_test = [earleyparser_interm_repr.get_updated_seq(get_token_list(x, terminals), INTERIM_GRAMMAR)[0] for x in xs_test]
-
-    tokens = dict()
-    reverse_tokens = dict()
-    tokens_file = join(modelsDir, "tokens_ints-partials-probs.json")
-    rev_tokens_file = join(modelsDir, "tokens_rev_ints-partials-probs.json")
-    if exists(saved_model_file):
-        with open(tokens_file, "r") as fin:
-            tokens = json.load(fin)
-        with open(rev_tokens_file, "r") as fin:
-            new_reverse_tokens = json.load(fin)
-        for k in new_reverse_tokens:
-            reverse_tokens[int(k)] = new_reverse_tokens[k]
-    else:
-        sys.exit(-1)
-    xs_test = [list(map(lambda xx: tokens[xx] if xx in tokens else 0, x.split())) for x in xs_test]
-
-    labels = dict()
-    reverse_labels = dict()
-    labels_file = join(modelsDir, "erule_labels-partials-probs.json")
-    rev_labels_file = join(modelsDir, "erule_reverse_labels-partials-probs.json")
-    if exists(saved_model_file):
-        with open(labels_file, "r") as fin:
-            labels = json.load(fin)
-        with open(rev_labels_file, "r") as fin:
-            new_reverse_labels = json.load(fin)
-        for k in new_reverse_labels:
-            reverse_labels[int(k)] = new_reverse_labels[k]
-    else:
-        sys.exit(-1)
 
+def load_classifier(saved_model_file):
+    """
+    Returns the transformer classifier with the trained weights of the given
+    file, for inference only (i.e. not compiled).
+    """
+    # TensorFlow is only imported for the Keras engine
+    from transformer_classifier import TransformerClassifier
+    embed_dim = 128  # Embedding size for each token
+    num_heads = 12  # Number of attention heads
+    ff_dim = 256  # Hidden layer size in feed forward network inside transformer
+    transformer_blks = 6 # Number of transformer blocks
+    dense_dims = [256, 128] # Dense layer sizes in classifier
+
+    transformerClfr = TransformerClassifier(embed_dim, num_heads, ff_dim, transformer_blks, dense_dims, VOCAB_SIZE, X_MAXLEN, NUM_OF_LABELS, 'sigmoid')
+    transformerClfr.load_weights(saved_model_file)
+    return transformerClfr
+
+
+class Seq2ParsePredictor():
+    """
+    Predicts the error rules of erroneous programs with the trained transformer
+    classifier. The grammars, the token and label vocabularies, the label
+    binarizer and the model weights are loaded once, so that a long-lived
+    process only pays for the inference of each program. The classifier runs
+    either on Keras (engine='keras') or on the pure NumPy CPU implementation
+    of numpy_transformer (engine='numpy'), which does not import TensorFlow.
+    Both the abstracted sequences and the label probabilities are cached
+    (PredictionCache), as identical inputs always give identical predictions.
+    """
+
+    def __init__(self, grammarFile, modelsDir, gpuToUse='/device:GPU:0', engine='keras', cache_path=None):
+        saved_model_file = join(modelsDir, 'transformer-classifier-partial-parses-probs.h5')
+        if not exists(saved_model_file):
+            # The caller (e.g. the CLI) decides whether to exit
+            raise FileNotFoundError("No trained classifier at " + saved_model_file)
+        self.gpuToUse = gpuToUse
+        self.engine = engine
+
+        # Grammars for the partial parses (abstracted input sequences)
+        self.interim_grammar = earleyparser_interm_repr.read_grammar(grammarFile)
+        # (with the compiled PCFG, i.e. the log-probabilities of its rules, persisted next to the rules usage)
+        self.interim_grammar.load_probs(join(modelsDir, "rules_usage.json"), join(modelsDir, "rules_usage-pcfg.json"))
+        self.terminals = read_grammar(grammarFile).get_alphabet()
 
-    mlb = MultiLabelBinarizer()
-    with open(join(modelsDir, 'myMultiLabelBinarizer.pkl'), 'rb') as f:
-        mlb = pickle.load(f)
-    vocab_size = 182
-    x_maxlen = 128
-    num_of_labels = 150
+        # Token and error rule label vocabularies
+        with open(join(modelsDir, "tokens_ints-partials-probs.json"), "r") as fin:
+            self.tokens = json.load(fin)
+        with open(join(modelsDir, "tokens_rev_ints-partials-probs.json"), "r") as fin:
+            self.reverse_tokens = dict((int(k), v) for k, v in json.load(fin).items())
+        with open(join(modelsDir, "erule_labels-partials-probs.json"), "r") as fin:
+            self.labels = json.load(fin)
+        with open(join(modelsDir, "erule_reverse_labels-partials-probs.json"), "r") as fin:
+            self.reverse_labels = dict((int(k), v) for k, v in json.load(fin).items())
+        with open(join(modelsDir, 'myMultiLabelBinarizer.pkl'), 'rb') as f:
+            self.mlb = pickle.load(f)
+        # The cached predictions are only valid for this model, vocabularies and PCFG
+        self.cache = PredictionCache(path=cache_path, version=self.digest(modelsDir))
+
+        if self.engine == 'numpy':
+            self.transformerClfr = NumpyTransformerClassifier(saved_model_file)
+        else:
+            import tensorflow as tf
+            with tf.device(self.gpuToUse):
+                self.transformerClfr = load_classifier(saved_model_file)
+
+    def digest(self, modelsDir):
+        """
+        Returns a hash of the model weights, the token and label vocabularies,
+        the label binarizer and the PCFG, i.e. the version of the predictions.
+        """
+        digest = hashlib.sha256(self.interim_grammar.pcfg_key.encode('utf-8'))
+        for model_file in ['transformer-classifier-partial-parses-probs.h5', 'tokens_ints-partials-probs.json',
+                           'tokens_rev_ints-partials-probs.json', 'erule_labels-partials-probs.json',
+                           'erule_reverse_labels-partials-probs.json', 'myMultiLabelBinarizer.pkl']:
+            with open(join(modelsDir, model_file), 'rb') as in_file:
+                for chunk in iter(partial(in_file.read, 1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_updated_seq(self, prog, tokens=None):
+        """
+        Returns the abstracted token sequence (with the partial parses) of the
+        given program, i.e. the input of the classifier. The program is only
+        lexed if its (abstract) tokens are not given.
+        """
+        if tokens is None:
+            tokens = get_token_list(prog, self.terminals)
+        key = self.cache.key(tokens)
+        seq = self.cache.get('seqs', key)
+        if seq is None:
+            with instrumentation.stage('partial_parse'):
+                seq = earleyparser_interm_repr.get_updated_seq(tokens, self.interim_grammar)[0]
+            self.cache.put('seqs', key, seq)
+        else:
+            instrumentation.count('seqs_cache_hits')
+        return seq
 
-    def tokenize(xx):
-        return " ".join(list(map(lambda x: "_UNKNOWN_" if x == 0 else reverse_tokens[x], xx))).strip()
+    def encode(self, seqs):
+        """
+        Returns the padded token ids of the given abstracted token sequences.
+        """
+        xs = [list(map(lambda xx: self.tokens[xx] if xx in self.tokens else 0, x.split())) for x in seqs]
+        return pad_sequences(xs, maxlen=X_MAXLEN)
 
-    def labelize(yy, num_preds):
-        top_preds = [0] * num_of_labels
-        for i in argsort(yy)[::-1][:num_preds]:
+    def predict_probs(self, seqs):
+        """
+        Returns the probabilities of the error rule labels for the given
+        abstracted token sequences. Only the sequences that are not cached go
+        through the classifier.
+        """
+        xs = self.encode(seqs)
+        keys = [self.cache.key(x.tobytes()) for x in xs]
+        y_pred = [self.cache.get('labels', key) for key in keys]
+        misses = [i for i, y in enumerate(y_pred) if y is None]
+        instrumentation.count('labels_cache_hits', len(y_pred) - len(misses))
+        if misses:
+            with instrumentation.stage('inference'):
+                y_misses = self.run_classifier(xs[misses])
+            for i, y in zip(misses, y_misses):
+                y = asarray(y, dtype='float32')
+                self.cache.put('labels', keys[i], y.tobytes())
+                y_pred[i] = y
+        return array([frombuffer(y, dtype='float32') if isinstance(y, bytes) else y for y in y_pred])
+
+    def run_classifier(self, xs):
+        if self.engine == 'numpy':
+            return self.transformerClfr.predict_fast(xs)
+        import tensorflow as tf
+        with tf.device(self.gpuToUse):
+            return self.transformerClfr.predict_fast(xs)
+
+    def labelize(self, y_pred, num_preds):
+        """
+        Returns the num_preds most probable error rules of the given prediction.
+        """
+        top_preds = [0] * NUM_OF_LABELS
+        for i in argsort(y_pred)[::-1][:num_preds]:
             top_preds[i] = 1
-        top_preds = list(mlb.inverse_transform(array(top_preds).reshape(1, num_of_labels))[0])
-        print("top_preds: ", top_preds)
-        return list(map(lambda r: reverse_labels[r], top_preds))
+        top_preds = list(self.mlb.inverse_transform(array(top_preds).reshape(1, NUM_OF_LABELS))[0])
+        return list(map(lambda r: self.reverse_labels[r], top_preds))
+
+    def predict(self, prog, max_erules=20, tokens=None):
+        """
+        Returns the max_erules most probable error rules for the given program
+        (with the given abstract tokens, if already lexed).
+        """
+        return self.predict_batch([prog], max_erules, None if tokens is None else [tokens])[0]
+
+    def predict_batch(self, progs, max_erules=20, tokens=None):
+        """
+        Returns the max_erules most probable error rules for each of the given
+        programs (with the given abstract tokens of each one, if already
+        lexed), predicted in a single batch.
+        """
+        tokens = [None] * len(progs) if tokens is None else tokens
+        y_pred = self.predict_probs([self.get_updated_seq(prog, tokns) for prog, tokns in zip(progs, tokens)])
+        return [self.labelize(y, max_erules) for y in y_pred]
+
 
-    xs_test = keras.preprocessing.sequence.pad_sequences(xs_test, maxlen=x_maxlen)
+class PendingPrediction():
+    """
+    A program waiting in the queue of a BatchingPredictor.
+    """
 
+    __slots__ = ('seq', 'max_erules', 'enqueued', 'done', 'result', 'error', 'profile')
+
+    def __init__(self, seq, max_erules):
+        self.seq = seq
+        self.max_erules = max_erules
+        # The profile of the caller (if any), as the batch runs in another thread
+        self.profile = instrumentation.current()
+        self.enqueued = timeit.default_timer()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingPredictor():
+    """
+    Micro-batching queue in front of a Seq2ParsePredictor. Concurrent requests
+    are collected for up to max_wait_ms milliseconds or max_batch_size
+    programs, run in a single (padded) forward pass and their labels are
+    scattered back to the waiting callers.
+    """
+
+    def __init__(self, predictor, max_batch_size=16, max_wait_ms=5, max_queue_size=256):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = Queue(maxsize=max_queue_size)
+        # Metrics
+        self.lock = Lock()
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = defaultdict(int)
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+        self.total_inference = 0.0
+        self.worker = Thread(target=self.run, name="seq2parse-batcher", daemon=True)
+        self.worker.start()
+
+    def predict(self, prog, max_erules=20, tokens=None):
+        """
+        Returns the max_erules most probable error rules for the given program
+        (with the given abstract tokens, if already lexed), predicted in a
+        batch with the other waiting programs.
+        """
+        # The partial parse is computed in the caller's thread
+        pending = PendingPrediction(self.predictor.get_updated_seq(prog, tokens), max_erules)
+        self.queue.put(pending)
+        with self.lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def predict_batch(self, progs, max_erules=20, tokens=None):
+        return self.predictor.predict_batch(progs, max_erules, tokens)
+
+    def next_batch(self):
+        """
+        Waits for the next program and collects more for up to max_wait or
+        max_batch_size programs.
+        """
+        batch = [self.queue.get()]
+        deadline = timeit.default_timer() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - timeit.default_timer()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start_time = timeit.default_timer()
+            try:
+                y_pred = self.predictor.predict_probs([pending.seq for pending in batch])
+                for pending, y in zip(batch, y_pred):
+                    pending.result = self.predictor.labelize(y, pending.max_erules)
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            end_time = timeit.default_timer()
+            for pending in batch:
+                instrumentation.add_time('batch_wait', start_time - pending.enqueued, pending.profile)
+                instrumentation.add_time('batch_inference', end_time - start_time, pending.profile)
+            with self.lock:
+                self.batches += 1
+                self.batch_sizes[len(batch)] += 1
+                self.total_inference += end_time - start_time
+                for pending in batch:
+                    self.total_wait += start_time - pending.enqueued
+                    self.max_wait_seen = max(self.max_wait_seen, start_time - pending.enqueued)
+            for pending in batch:
+                pending.done.set()
+
+    def metrics(self):
+        """
+        Returns the metrics of the queue (wait and inference times in ms).
+        """
+        with self.lock:
+            return {"queue_depth": self.queue.qsize(),
+                    "max_queue_depth": self.max_queue_depth,
+                    "requests": self.requests,
+                    "batches": self.batches,
+                    "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                    "avg_wait_ms": 1000.0 * self.total_wait / max(sum(k * v for k, v in self.batch_sizes.items()), 1),
+                    "max_wait_ms": 1000.0 * self.max_wait_seen,
+                    "avg_inference_ms": 1000.0 * self.total_inference / max(self.batches, 1),
+                    "cache": self.predictor.cache.stats()}
+
+
+# Process-wide predictors, by grammar, models directory, device, engine and
+# on-disk cache
+PREDICTORS = dict([])
+PREDICTORS_LOCK = Lock()
+
+
+def get_predictor(grammarFile, modelsDir, gpuToUse='/device:GPU:0', engine='keras', cache_path=None):
+    """
+    Returns the process-wide predictor for the given grammar, models directory,
+    device and engine ('keras' or 'numpy'), loading it on first use. Its
+    predictions are also cached in the sqlite file cache_path (if given).
+    """
+    key = (str(grammarFile), str(modelsDir), gpuToUse, engine, cache_path)
+    with PREDICTORS_LOCK:
+        if key not in PREDICTORS:
+            PREDICTORS[key] = Seq2ParsePredictor(grammarFile, modelsDir, gpuToUse, engine, cache_path)
+        return PREDICTORS[key]
+
+
+def predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, sfile, do_sfile=False, max_erules=20, engine='keras'):
     try:
-        # Specify an invalid GPU device
-        with tf.device(gpuToUse):
-            embed_dim = 128  # Embedding size for each token
-            num_heads = 12  # Number of attention heads
-            ff_dim = 256  # Hidden layer size in feed forward network inside transformer
-            transformer_blks = 6 # Number of transformer blocks
-            dense_dims = [256, 128] # Dense layer sizes in classifier
-
-            transformerClfr = TransformerClassifier(embed_dim, num_heads, ff_dim, transformer_blks, dense_dims, vocab_size, x_maxlen, num_of_labels, 'sigmoid')
-
-            transformerClfr.compile(optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=0.0001, beta_2=0.98),
-                                    loss="binary_crossentropy",
-                                    metrics=[keras.metrics.CategoricalAccuracy(name="acc"),
-                                            keras.metrics.TopKCategoricalAccuracy(10, name="top-10-acc")])
-
-            if exists(saved_model_file):
-                transformerClfr.load_weights(saved_model_file)
-            else:
-                sys.exit(-1)
-            y_pred = transformerClfr.predict(xs_test)
-            print("y_pred", y_pred)
-            if sfile:
-                return labelize(y_pred[0], max_erules)
-            elif do_sfile:
-                return [labelize(y, max_erules) for y in y_pred]
-            else:
-                return y_pred
+        predictor = get_predictor(grammarFile, modelsDir, gpuToUse, engine)
+        if sfile:
+            return predictor.predict(input_prog, max_erules)
+        elif do_sfile:
+            return predictor.predict_batch(input_prog, max_erules)
+        else:
+            return predictor.predict_probs(input_prog)
     except RuntimeError as e:
         print(e)
 
@@ -133,12 +353,22 @@ if __name__ == "__main__":
     single_file = True
     if len(sys.argv) > 5:
         single_file = sys.argv[5] == 'true'
+    engine = 'keras'
+    if len(sys.argv) > 6:
+        engine = sys.argv[6]
     environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    # The predictor is loaded once (see get_predictor), so a missing model is
+    # reported before reading the inputs
+    try:
+        get_predictor(grammarFile, modelsDir, gpuToUse, engine)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit(-1)
 
     if single_file:
         input_prog = inputPath.read_text()
 
-        erules = predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, True)
+        erules = predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, True, engine=engine)
         print(erules)
     else:
         dataset = []
@@ -158,7 +388,6 @@ if __name__ == "__main__":
             sys.exit(-1)
         ys_test = [list(filter(lambda xx: xx != 0, map(lambda yy: labels[yy] if yy in labels else 0, y))) for y in ys_test]
 
-        mlb = MultiLabelBinarizer()
         with open(join(modelsDir, 'myMultiLabelBinarizer.pkl'), 'rb') as f:
             mlb = pickle.load(f)
 
@@ -180,7 +409,7 @@ if __name__ == "__main__":
         progs_best_one_not_pop = 0
         avg_num_of_preds = 0
         all_best_preds_lens = []
-        for y_pred, y_true, popular in zip(predict_error_rules(grammarFile, modelsDir, gpuToUse, xs_test, False), ys_test, popularities):
+        for y_pred, y_true, popular in zip(predict_error_rules(grammarFile, modelsDir, gpuToUse, xs_test, False, engine=engine), ys_test, popularities):
             print("y_pred", y_pred)
             print("y_true", y_true)
 
@@ -0,0 +1,318 @@
+"""
+Repairs in a bounded pool of worker processes, with a deadline per request,
+for the Seq2Parse service.
+
+@author: Georgios Sakkas
+"""
+
+import json
+import timeit
+import multiprocessing
+from collections import deque
+from threading import Lock
+from concurrent.futures import TimeoutError, CancelledError
+from pebble import ProcessPool
+from ecpp_individual_grammar import get_token_lists, ErrorGrammarCache
+from seq2parse import repair, get_result
+import instrumentation
+
+
+# Caches of the error grammars and the repairs of each worker (set by init_worker)
+ERROR_GRAMMARS = None
+REPAIRS = None
+TERMINALS = None
+
+
+def init_worker(egrammars, repairs=None):
+    # Each worker keeps its own caches across its tasks (the on-disk tier of
+    # the repairs is shared)
+    global ERROR_GRAMMARS, REPAIRS, TERMINALS
+    ERROR_GRAMMARS = egrammars
+    REPAIRS = repairs
+    TERMINALS = egrammars.grammar.get_alphabet()
+
+
+def repair_worker(input_prog, error_rules, max_cost, profiled=False, tokens=None):
+    # The workers return their profile (if profiled) with their result. The
+    # program is only lexed if its token lists are not given
+    with instrumentation.profile(enabled=profiled) as prof:
+        prog_tokens, actual_tokens = get_token_lists(input_prog, TERMINALS) if tokens is None else tokens
+        repaired_prog = repair(ERROR_GRAMMARS, max_cost, prog_tokens, error_rules, actual_tokens, REPAIRS)
+    return repaired_prog, prof.as_dict() if prof is not None else None
+
+
+def repair_result_worker(input_prog, error_rules, max_cost, profiled=False, tokens=None):
+    with instrumentation.profile(enabled=profiled) as prof:
+        result = repair_result(input_prog, error_rules, max_cost, tokens)
+    return result, prof.as_dict() if prof is not None else None
+
+
+def repair_result(input_prog, error_rules, max_cost, tokens=None):
+    # The errors (changes) are also computed in the worker
+    prog_tokens, actual_tokens = get_token_lists(input_prog, TERMINALS) if tokens is None else tokens
+    repaired_prog = repair(ERROR_GRAMMARS, max_cost, prog_tokens, error_rules, actual_tokens, REPAIRS)
+    if repaired_prog is None:
+        return None
+    repaired_prog = repaired_prog.replace('_white_space_', ' ').replace('_NEWLINE_', '\n').replace("\\n", '\n')
+    try:
+        result = get_result(input_prog, actual_tokens, repaired_prog, TERMINALS)
+    except (IndexError, AttributeError):
+        # The changes could not be mapped back to the lines of the program
+        result = {"status": "unknown", "errors": [], "types": {}}
+    result["repaired"] = repaired_prog[:-3]
+    return result
+
+
+def read_batch_line(num, line):
+    """
+    Returns the id and the program of the given JSONL line, i.e. either an
+    object with a "program" (and optionally an "id", by default the line
+    number) or just the program as a JSON string.
+    """
+    sample = json.loads(line)
+    if isinstance(sample, str):
+        return num, sample
+    return sample.get("id", num), sample["program"]
+
+
+def batch_result(prog_id, status, result=None, prof=None):
+    """
+    Returns the JSONL result of a program of a batch. Programs that were not
+    repaired (or timed out) have an unknown status and no errors.
+    """
+    if result is None:
+        result = {"status": "unknown", "errors": [], "types": {}, "repaired": None}
+    result = dict([("id", prog_id), ("repair", status)] + list(result.items()))
+    if prof is not None:
+        result["profile"] = prof.as_dict()
+    return result
+
+
+class RepairService():
+    """
+    Runs the repairs of the (already predicted) error rules in a pool of
+    max_workers processes. At most max_pending repairs are queued or running,
+    and each one has a deadline of timeout seconds from its submission, after
+    which it is cancelled (i.e. its worker is terminated and replaced) and the
+    caller gets a best-effort result, i.e. no repair. The repairs of the
+    batches have their own budget of max_batch_pending (by default half of
+    max_pending) of these repairs, so that they cannot starve single requests.
+    The workers get a copy of the given RepairCache (if any).
+
+    The workers are started with start_method, by default from a forkserver
+    (that only imports this module), since the callers are multithreaded
+    (e.g. the server and the predictor) and a worker forked from them could
+    inherit a lock held by another thread. The workers also import the main
+    module (as __mp_main__), so it must not start a service when imported.
+    """
+
+    def __init__(self, grammar, max_workers=4, max_pending=64, timeout=10.0, max_tasks=0, repairs=None,
+                 start_method='forkserver', max_batch_pending=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_batch_pending = max(max_pending // 2, 1) if max_batch_pending is None else min(max_batch_pending, max_pending)
+        self.timeout = timeout
+        # The programs of the batches are lexed once, for the predictor and the workers
+        self.terminals = grammar.get_alphabet()
+        context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            context.set_forkserver_preload(['repair_service'])
+        self.pool = ProcessPool(max_workers=max_workers, max_tasks=max_tasks,
+                                initializer=init_worker, initargs=(ErrorGrammarCache(grammar), repairs),
+                                context=context)
+        # Futures that are queued or running (and those of them of batches)
+        self.pending = set()
+        self.batch_pending = set()
+        # Metrics
+        self.lock = Lock()
+        self.requests = 0
+        self.repaired = 0
+        self.not_repaired = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def repair(self, input_prog, error_rules, max_cost=5, timeout=None, tokens=None):
+        """
+        Returns the repaired program (or None) and the status of the repair,
+        i.e. 'repaired', 'not_repaired', 'timeout', 'failed' or 'rejected'
+        (when max_pending repairs are already in the pool). The abstract and
+        actual tokens of the program (get_token_lists) can be given if it has
+        already been lexed.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start_time = timeit.default_timer()
+        with self.lock:
+            self.requests += 1
+            if len(self.pending) >= self.max_pending:
+                self.rejected += 1
+                return None, 'rejected'
+            # The worker's own time limit also covers a (killed) stuck worker
+            future = self.pool.schedule(repair_worker, args=(input_prog, error_rules, max_cost), timeout=timeout,
+                                        kwargs={"profiled": instrumentation.current() is not None, "tokens": tokens})
+            self.pending.add(future)
+        # The deadline counts from the submission, so it includes the time in the queue
+        return self.wait(future, start_time, timeout)
+
+    def wait(self, future, start_time, timeout=None):
+        """
+        Waits for the given repair (for up to timeout seconds) and returns its
+        result and status. The profile of the worker (if any) is added to the
+        current one. A repair that raised, or whose worker died, has failed.
+        """
+        repaired_prog = None
+        try:
+            repaired_prog, prof = future.result(timeout=timeout)
+            if prof is not None and instrumentation.current() is not None:
+                instrumentation.current().merge(prof)
+            status = 'repaired' if repaired_prog is not None else 'not_repaired'
+        except (TimeoutError, CancelledError):
+            status = 'timeout'
+        except Exception:
+            # The repair raised, or the worker died (ProcessExpired, e.g. it
+            # was killed or ran out of memory). Either way the future is
+            # released below, so it does not hold on to the budget
+            status = 'failed'
+        finally:
+            # Cancelling a running future terminates its worker
+            future.cancel()
+        elapsed = timeit.default_timer() - start_time
+        with self.lock:
+            self.pending.discard(future)
+            self.batch_pending.discard(future)
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            if status == 'repaired':
+                self.repaired += 1
+            elif status == 'not_repaired':
+                self.not_repaired += 1
+            elif status == 'timeout':
+                self.timeouts += 1
+            else:
+                self.failures += 1
+        return repaired_prog, status
+
+    def repair_batch(self, predictor, lines, max_cost=5, batch_size=16, max_erules=20, profiled=False):
+        """
+        Repairs the programs of the given JSONL lines and yields their results
+        in the input order. The error rules of batch_size programs at a time
+        are predicted in a single batch and their repairs are fanned out to
+        the pool, while the results of the previous batch are streamed. Each
+        repair has a time limit of timeout seconds (of running time). If
+        profiled, each result also has the profile of its repair. If the
+        results are not consumed to the end (e.g. the client disconnected),
+        the remaining repairs are cancelled when the generator is closed.
+        """
+        # (id, future or status, start time), in the input order
+        running = deque()
+        batch = []
+        try:
+            for num, line in enumerate(lines):
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(read_batch_line(num, line))
+                except (ValueError, KeyError, AttributeError):
+                    batch.append((num, None))
+                if len(batch) == batch_size:
+                    # Predict (and schedule) the next batch before the results of
+                    # the previous one, some of which may be needed for room in
+                    # the budget of the batches
+                    previous = len(running)
+                    for result in self.schedule_batch(predictor, batch, max_cost, max_erules, running, profiled):
+                        previous -= 1
+                        yield result
+                    batch = []
+                    for _ in range(previous):
+                        yield self.batch_result(*running.popleft())
+            if batch:
+                yield from self.schedule_batch(predictor, batch, max_cost, max_erules, running, profiled)
+            while running:
+                yield self.batch_result(*running.popleft())
+        finally:
+            self.cancel_batch(running)
+
+    def schedule_batch(self, predictor, batch, max_cost, max_erules, running, profiled=False):
+        """
+        Predicts the error rules of the batch and schedules their repairs.
+        While the batches have max_batch_pending repairs in the pool, the
+        results of the oldest ones are yielded first, or, if none of them are
+        of this batch, the repair is rejected.
+        """
+        # Invalid lines have no program
+        progs = [prog for _, prog in batch if prog is not None]
+        try:
+            all_tokens = [get_token_lists(prog, self.terminals) for prog in progs]
+            all_error_rules = iter(predictor.predict_batch(progs, max_erules, [tokens[0] for tokens in all_tokens])) if progs else iter([])
+            all_tokens = iter(all_tokens)
+        except Exception:
+            running.extend((prog_id, 'failed' if prog is not None else 'invalid', None) for prog_id, prog in batch)
+            return
+        with self.lock:
+            self.requests += len(progs)
+        for prog_id, prog in batch:
+            if prog is None:
+                running.append((prog_id, 'invalid', None))
+                continue
+            error_rules = next(all_error_rules)
+            tokens = next(all_tokens)
+            while len(self.batch_pending) >= self.max_batch_pending and any(not isinstance(r[1], str) for r in running):
+                yield self.batch_result(*running.popleft())
+            with self.lock:
+                if len(self.batch_pending) >= self.max_batch_pending or len(self.pending) >= self.max_pending:
+                    self.rejected += 1
+                    running.append((prog_id, 'rejected', None))
+                    continue
+                future = self.pool.schedule(repair_result_worker, args=(prog, error_rules, max_cost), timeout=self.timeout,
+                                            kwargs={"profiled": profiled, "tokens": tokens})
+                self.pending.add(future)
+                self.batch_pending.add(future)
+            running.append((prog_id, future, timeit.default_timer(), profiled))
+
+    def cancel_batch(self, running):
+        # Cancelling a running future terminates its worker
+        for _, future, *_ in running:
+            if not isinstance(future, str):
+                future.cancel()
+                with self.lock:
+                    self.pending.discard(future)
+                    self.batch_pending.discard(future)
+        running.clear()
+
+    def batch_result(self, prog_id, future, start_time, profiled=False):
+        if isinstance(future, str):
+            return batch_result(prog_id, future)
+        if not profiled:
+            result, status = self.wait(future, start_time)
+            return batch_result(prog_id, status, result)
+        with instrumentation.profile() as prof:
+            result, status = self.wait(future, start_time)
+        return batch_result(prog_id, status, result, prof)
+
+    def metrics(self):
+        """
+        Returns the metrics of the pool (times in ms).
+        """
+        with self.lock:
+            in_flight = sum(1 for future in self.pending if future.running())
+            completed = self.repaired + self.not_repaired + self.timeouts + self.failures
+            return {"queue_depth": len(self.pending) - in_flight,
+                    "in_flight": in_flight,
+                    "batch_pending": len(self.batch_pending),
+                    "max_workers": self.max_workers,
+                    "max_pending": self.max_pending,
+                    "max_batch_pending": self.max_batch_pending,
+                    "requests": self.requests,
+                    "repaired": self.repaired,
+                    "not_repaired": self.not_repaired,
+                    "timeouts": self.timeouts,
+                    "failures": self.failures,
+                    "rejected": self.rejected,
+                    "avg_time_ms": 1000.0 * self.total_time / max(completed, 1),
+                    "max_time_ms": 1000.0 * self.max_time}
+
+    def close(self):
+        self.pool.stop()
+        self.pool.join()
@@ -0,0 +1,463 @@
+"""
+Micro-benchmarks for the Seq2Parse repair pipeline.
+
+Example:
+>>> python run_benchmarks.py chart-entry python-grammar.txt top-erules.txt repairs/orig_*.py
+>>> python run_benchmarks.py strategy python-grammar.txt top-erules.txt repairs/orig_*.py
+>>> python run_benchmarks.py scanner python-grammar.txt top-erules.txt repairs/orig_*.py
+>>> python run_benchmarks.py grammar python-grammar.txt top-erules.txt
+>>> python run_benchmarks.py lexer python-grammar.txt repairs/*.py
+>>> python run_benchmarks.py partial-parse python-grammar.txt models/rules_usage.json repairs/orig_*.py tests/*.py
+>>> python run_benchmarks.py classifier models/transformer-classifier-partial-parses-probs.h5
+>>> python run_benchmarks.py imports
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+import timeit
+import gc
+import tracemalloc
+from copy import deepcopy
+from pathlib import Path
+from statistics import median
+from ecpp_individual_grammar import read_grammar, get_token_list, ErrorEarleyParse, ErrorGrammarCache, ChartEntry, IndexedChartEntry, get_repaired_seq_for_1, Rule, State, Lexer
+import earleyparser_interm_repr
+
+
+def read_erules(erules_file, top_n):
+    with open(erules_file, "r") as in_file:
+        return [line.rstrip('\n') for line in in_file if line.strip()][:top_n]
+
+
+def time_it(fun, repeats):
+    times = []
+    result = None
+    for _ in range(repeats):
+        start_time = timeit.default_timer()
+        result = fun()
+        times.append(timeit.default_timer() - start_time)
+    return median(times), result
+
+
+def bench_chart_entry(args):
+    grammar = read_grammar(args.grammar_file)
+    terminals = grammar.get_alphabet()
+    grammar.update_error_grammar_with_erules(read_erules(args.erules_file, args.top_n))
+
+    def run_parse(tokens, entry_type):
+        parser = ErrorEarleyParse(tokens, grammar, args.max_cost, chart_entry=entry_type)
+        parser.parse()
+        fixed = parser.get_fixed_seq()
+        return get_repaired_seq_for_1(fixed, grammar)[2] if fixed else None, sum(map(len, parser.chart))
+
+    total_old, total_new = 0.0, 0.0
+    print("{:<45} {:>7} {:>8} {:>10} {:>10} {:>8}".format("program", "tokens", "states", "ChartEntry", "Indexed", "speedup"))
+    for prog_path in args.programs:
+        tokens = get_token_list(Path(prog_path).read_text(), terminals)
+        time_old, (repair_old, size) = time_it(lambda: run_parse(tokens, ChartEntry), args.repeats)
+        time_new, (repair_new, _) = time_it(lambda: run_parse(tokens, IndexedChartEntry), args.repeats)
+        if repair_old != repair_new:
+            print("Different repairs for", prog_path, ":", repair_old, "!=", repair_new)
+            sys.exit(1)
+        total_old += time_old
+        total_new += time_new
+        print("{:<45} {:>7} {:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format(prog_path, len(tokens.split()), size, time_old, time_new, time_old / time_new))
+    print("{:<45} {:>7} {:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format("total", "", "", total_old, total_new, total_old / total_new))
+
+
+def bench_strategy(args):
+    grammar = read_grammar(args.grammar_file)
+    terminals = grammar.get_alphabet()
+    grammar.update_error_grammar_with_erules(read_erules(args.erules_file, args.top_n))
+    # Grammar without error rules, to check that the repairs parse
+    plain_grammar = read_grammar(args.grammar_file)
+    plain_grammar.update_error_grammar_with_erules([])
+
+    def run_parse(tokens, strategy):
+        parser = ErrorEarleyParse(tokens, grammar, args.max_cost, strategy=strategy)
+        parser.parse()
+        repair = parser.get_repair()
+        return repair if repair else (None, None, None, None, None), sum(map(len, parser.chart))
+
+    def is_valid(fixed_seq):
+        parser = ErrorEarleyParse(fixed_seq, plain_grammar, 0)
+        parser.parse()
+        return parser.has_parse()
+
+    total_old, total_new, same_ops = 0.0, 0.0, 0
+    print("{:<45} {:>7} {:>6} {:>6} {:>4} {:>8} {:>8} {:>10} {:>10} {:>8}".format("program", "tokens", "passes", "agenda", "ops", "states", "agenda", "passes", "agenda", "speedup"))
+    for prog_path in args.programs:
+        tokens = get_token_list(Path(prog_path).read_text(), terminals)
+        time_old, (repair_old, size_old) = time_it(lambda: run_parse(tokens, "passes"), args.repeats)
+        time_new, (repair_new, size_new) = time_it(lambda: run_parse(tokens, "agenda"), args.repeats)
+        # The passes do not always stop at the cheapest parse, and both
+        # strategies break ties differently (see parse_agenda), so the agenda
+        # must find a valid repair that is not more expensive
+        cost_old, cost_new = repair_old[4], repair_new[4]
+        if (cost_old is None) != (cost_new is None) or cost_old is not None and \
+            (cost_new > cost_old or not is_valid(repair_new[1])):
+            print("Worse agenda repair for", prog_path, ":", cost_old, "<", cost_new)
+            sys.exit(1)
+        same_ops += repair_old[2] == repair_new[2]
+        total_old += time_old
+        total_new += time_new
+        print("{:<45} {:>7} {:>6} {:>6} {:>4} {:>8} {:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format(prog_path, len(tokens.split()), str(cost_old), str(cost_new), "=" if repair_old[2] == repair_new[2] else "!=", size_old, size_new, time_old, time_new, time_old / time_new))
+    print("{:<45} {:>7} {:>6} {:>6} {:>4} {:>8} {:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format("total", "", "", "", same_ops, "", "", total_old, total_new, total_old / total_new))
+
+
+def bench_scanner(args):
+    grammar = read_grammar(args.grammar_file)
+    terminals = grammar.get_alphabet()
+    grammar.update_error_grammar_with_erules(read_erules(args.erules_file, args.top_n))
+
+    def record_scans(tokens):
+        parser = ErrorEarleyParse(tokens, grammar, args.max_cost)
+        scans = []
+        scanner = parser.scanner
+        def recording_scanner(state, pos):
+            scans.append((state, pos))
+            scanner(state, pos)
+        parser.scanner = recording_scanner
+        parser.parse()
+        return scans
+
+    def table_scans(tokens, scans):
+        # Replays the scanner calls of a parse on a fresh chart
+        parser = ErrorEarleyParse(tokens, grammar, args.max_cost)
+        for state, pos in scans:
+            parser.scanner(state, pos)
+
+    def rule_scans(tokens, scans):
+        # The same lookups by scanning the rules of each tag and allocating
+        # a new pre-terminal rule and state every time
+        words = tokens.split()
+        for state, pos in scans:
+            if state.chart_pos < len(words):
+                word = words[state.chart_pos]
+                if any((word in r) for r in grammar[state.next()]):
+                    new_cost = 1 if state.next().startswith('Err_') or state.next() == 'InsertErr' else 0
+                    if new_cost <= args.max_cost:
+                        State(Rule(state.next(), [word]), dot=1, sent_pos=state.chart_pos,
+                            chart_pos=(state.chart_pos + 1), error_count=new_cost, crule=state.crule)
+
+    total_toks, total_scans, total_rules, total_table = 0, 0, 0.0, 0.0
+    print("{:<45} {:>7} {:>8} {:>14} {:>14} {:>14}".format("program", "tokens", "scans", "rules scans/s", "table scans/s", "table tokens/s"))
+    for prog_path in args.programs:
+        tokens = get_token_list(Path(prog_path).read_text(), terminals)
+        num_of_tokens = len(tokens.split())
+        scans = record_scans(tokens)
+        time_rules, _ = time_it(lambda: rule_scans(tokens, scans), args.repeats)
+        time_table, _ = time_it(lambda: table_scans(tokens, scans), args.repeats)
+        total_toks += num_of_tokens
+        total_scans += len(scans)
+        total_rules += time_rules
+        total_table += time_table
+        print("{:<45} {:>7} {:>8} {:>14.0f} {:>14.0f} {:>14.0f}".format(prog_path, num_of_tokens, len(scans), len(scans) / time_rules, len(scans) / time_table, num_of_tokens / time_table))
+    print("{:<45} {:>7} {:>8} {:>14.0f} {:>14.0f} {:>14.0f}".format("total", total_toks, total_scans, total_scans / total_rules, total_scans / total_table, total_toks / total_table))
+
+
+def bench_partial_parse(args):
+    grammar = earleyparser_interm_repr.read_grammar(args.grammar_file)
+    with open(args.rules_usage, "r") as in_file:
+        grammar.update_probs(json.load(in_file))
+    terminals = read_grammar(args.grammar_file).get_alphabet()
+
+    def run_parse(tokens):
+        parser = earleyparser_interm_repr.EarleyParse(tokens, grammar)
+        parser.parse()
+        return parser
+
+    total_toks, total_parse, total_stitch = 0, 0.0, 0.0
+    print("{:<45} {:>7} {:>8} {:>10} {:>10}".format("program", "tokens", "states", "parse ms", "stitch ms"))
+    for prog_path in args.programs:
+        try:
+            tokens = get_token_list(Path(prog_path).read_text(), terminals)
+        except Exception:
+            # Programs that cannot even be lexed
+            continue
+        time_parse, parser = time_it(lambda: run_parse(tokens), args.repeats)
+        time_stitch, _ = time_it(parser.get_reduced_seq_probs, args.repeats)
+        total_toks += len(tokens.split())
+        total_parse += time_parse
+        total_stitch += time_stitch
+        print("{:<45} {:>7} {:>8} {:>10.2f} {:>10.2f}".format(prog_path, len(tokens.split()), sum(map(len, parser.chart)), 1000 * time_parse, 1000 * time_stitch))
+    print("{:<45} {:>7} {:>8} {:>10.2f} {:>10.2f}".format("total", total_toks, "", 1000 * total_parse, 1000 * total_stitch))
+
+
+def bench_lexer(args):
+    terminals = read_grammar(args.grammar_file).get_alphabet()
+
+    def run_lex(prog):
+        # A lexer per program, like get_token_list and get_actual_token_list
+        try:
+            return Lexer(terminals).lex(prog), Lexer(terminals).clean_with_lex(prog)
+        except Exception as e:
+            return type(e)
+
+    def run_lex_all(prog):
+        # Both token lists from a single pass, like get_token_lists
+        try:
+            return Lexer(terminals).lex_all(prog)
+        except Exception as e:
+            return type(e)
+
+    total_toks, total_old, total_new, mismatches = 0, 0.0, 0.0, 0
+    print("{:<45} {:>7} {:>10} {:>10} {:>8}".format("program", "tokens", "Two ms", "Single ms", "speedup"))
+    for prog_path in args.programs:
+        prog = Path(prog_path).read_text()
+        time_old, tokens_old = time_it(lambda: run_lex(prog), args.repeats)
+        time_new, tokens_new = time_it(lambda: run_lex_all(prog), args.repeats)
+        if tokens_old != tokens_new:
+            mismatches += 1
+        num_of_tokens = len(tokens_old[0].split()) if isinstance(tokens_old, tuple) else 0
+        total_toks += num_of_tokens
+        total_old += time_old
+        total_new += time_new
+        print("{:<45} {:>7} {:>10.2f} {:>10.2f} {:>7.2f}x".format(prog_path, num_of_tokens, 1000 * time_old, 1000 * time_new, time_old / time_new))
+    print("{:<45} {:>7} {:>10.2f} {:>10.2f} {:>7.2f}x".format("total", total_toks, 1000 * total_old, 1000 * total_new, total_old / total_new))
+    print("mismatches:", mismatches)
+    if mismatches:
+        sys.exit(1)
+
+
+def symbolic_rules(compiled):
+    """
+    Returns the compiled rules of each symbol and the tags of each terminal in
+    the scanner table, by their symbols (the ids of the symbols of an overlay
+    differ from the ids of the same grammar compiled as a whole).
+    """
+    rules = dict((sym, [str(compiled.rules[crule[0]]) for crule in compiled.rules_of[sym_id]])
+                 for sym_id, sym in enumerate(compiled.symbols))
+    scan_table = dict((compiled.symbols[t], [compiled.symbols[tag] for tag in tags])
+                      for t, tags in compiled.scan_table.items())
+    return rules, scan_table
+
+
+def bench_grammar(args):
+    grammar = read_grammar(args.grammar_file)
+    grammar.get_alphabet()
+    erules = read_erules(args.erules_file, len(open(args.erules_file).readlines()))
+    start_time = timeit.default_timer()
+    grammar.prepare_error_rules()
+    print("prepare_error_rules: {:.3f}s".format(timeit.default_timer() - start_time))
+
+    def deepcopy_grammar(eruls):
+        upd_grammar = deepcopy(grammar)
+        upd_grammar.update_error_grammar_with_erules(eruls)
+        return upd_grammar
+
+    def overlay_bytes(eruls):
+        # Memory kept alive by an error grammar (what ErrorGrammarCache holds)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        upd_grammar = grammar.with_erules(eruls)
+        gc.collect()
+        num_bytes = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return num_bytes / len(upd_grammar.compiled.crules)
+
+    print("{:>7} {:>10} {:>10} {:>8} {:>10}".format("erules", "deepcopy", "overlay", "speedup", "bytes/rule"))
+    max_bytes_per_rule = 0
+    for top_n in args.top_n:
+        eruls = erules[:top_n]
+        time_old, old_grammar = time_it(lambda: deepcopy_grammar(eruls), args.repeats)
+        time_new, new_grammar = time_it(lambda: grammar.with_erules(eruls), args.repeats)
+        if symbolic_rules(old_grammar.compiled) != symbolic_rules(new_grammar.compiled):
+            print("Different grammars for", top_n, "error rules")
+            sys.exit(1)
+        bytes_per_rule = overlay_bytes(eruls)
+        max_bytes_per_rule = max(max_bytes_per_rule, bytes_per_rule)
+        print("{:>7} {:>9.2f}ms {:>9.2f}ms {:>7.1f}x {:>10.0f}".format(len(eruls), time_old * 1000, time_new * 1000, time_old / time_new, bytes_per_rule))
+    print("ErrorGrammarCache.BYTES_PER_RULE: {} (measured at most {:.0f})".format(ErrorGrammarCache.BYTES_PER_RULE, max_bytes_per_rule))
+
+
+def bench_classifier(args):
+    # TensorFlow is only needed for this benchmark
+    import numpy as np
+    import tensorflow as tf
+    from predict_eccp_classifier_partials import load_classifier, VOCAB_SIZE, X_MAXLEN
+
+    def percentiles(times):
+        return np.percentile(times, 50) * 1000, np.percentile(times, 99) * 1000
+
+    rng = np.random.default_rng(42)
+    with tf.device(args.device):
+        transformerClfr = load_classifier(args.model_file)
+        print("{:>6} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}".format("batch", "predict p50", "predict p99", "fast p50", "fast p99", "identical", "max diff"))
+        max_diff = 0.0
+        for batch_size in args.batch_sizes:
+            xs = rng.integers(0, VOCAB_SIZE, size=(batch_size, X_MAXLEN)).astype('int32')
+            # Warm up (tracing) before timing
+            y_old = transformerClfr.model.predict(xs, verbose=0)
+            y_new = transformerClfr.predict_fast(xs)
+            times_old, times_new = [], []
+            for _ in range(args.repeats):
+                start_time = timeit.default_timer()
+                transformerClfr.model.predict(xs, verbose=0)
+                times_old.append(timeit.default_timer() - start_time)
+                start_time = timeit.default_timer()
+                transformerClfr.predict_fast(xs)
+                times_new.append(timeit.default_timer() - start_time)
+            max_diff = max(max_diff, float(np.abs(y_old - y_new).max()))
+            print("{:>6} {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10} {:>10.2e}".format(batch_size, *percentiles(times_old), *percentiles(times_new), str(np.array_equal(y_old, y_new)), np.abs(y_old - y_new).max()))
+    # The graph may fuse operations differently than predict, so the outputs
+    # can differ in their last bits
+    if max_diff > args.tolerance:
+        print("predict_fast differs from predict by", max_diff, "(tolerance", str(args.tolerance) + ")")
+        sys.exit(1)
+
+
+def bench_numpy_classifier(args):
+    # TensorFlow is only needed for the Keras side of this benchmark
+    import numpy as np
+    import tensorflow as tf
+    from numpy_transformer import NumpyTransformerClassifier
+    from predict_eccp_classifier_partials import load_classifier, VOCAB_SIZE, X_MAXLEN
+
+    def percentiles(times):
+        return np.percentile(times, 50) * 1000, np.percentile(times, 99) * 1000
+
+    rng = np.random.default_rng(42)
+    numpyClfr = NumpyTransformerClassifier(args.model_file)
+    with tf.device(args.device):
+        transformerClfr = load_classifier(args.model_file)
+        print("{:>6} {:>12} {:>12} {:>12} {:>12} {:>10} {:>9}".format("batch", "keras p50", "keras p99", "numpy p50", "numpy p99", "max diff", "top-20"))
+        max_diff = 0.0
+        for batch_size in args.batch_sizes:
+            xs = rng.integers(0, VOCAB_SIZE, size=(batch_size, X_MAXLEN)).astype('int32')
+            # Warm up (tracing) before timing
+            y_keras = transformerClfr.predict_fast(xs)
+            y_numpy = numpyClfr.predict_fast(xs)
+            times_keras, times_numpy = [], []
+            for _ in range(args.repeats):
+                start_time = timeit.default_timer()
+                transformerClfr.predict_fast(xs)
+                times_keras.append(timeit.default_timer() - start_time)
+                start_time = timeit.default_timer()
+                numpyClfr.predict_fast(xs)
+                times_numpy.append(timeit.default_timer() - start_time)
+            diff = float(np.abs(y_keras - y_numpy).max())
+            max_diff = max(max_diff, diff)
+            # The error rules are picked by rank, so also compare the top 20
+            same_top = all(set(np.argsort(a)[::-1][:20]) == set(np.argsort(b)[::-1][:20]) for a, b in zip(y_keras, y_numpy))
+            print("{:>6} {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10.2e} {:>9}".format(batch_size, *percentiles(times_keras), *percentiles(times_numpy), diff, str(same_top)))
+    if max_diff > args.tolerance:
+        print("NumPy engine differs from Keras by", max_diff, "(tolerance", str(args.tolerance) + ")")
+        sys.exit(1)
+
+
+def bench_imports(args):
+    # Each module is imported in a fresh interpreter, with python -X importtime
+    print("{:>36} {:>10}  {}".format("module", "import", "heavy imports"))
+    failed = False
+    for module in args.modules:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                cwd=Path(__file__).parent, capture_output=True, text=True)
+        if result.returncode != 0:
+            print("{:>36} {:>10}  {}".format(module, "failed", result.stderr.strip().split('\n')[-1]))
+            failed = True
+            continue
+        # Lines of "import time: self [us] | cumulative | imported package"
+        imported = dict([])
+        for line in result.stderr.split('\n'):
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative)
+        heavy = sorted(set(name.split('.')[0] for name in imported if name.split('.')[0] in args.heavy))
+        import_ms = imported.get(module, 0) / 1000.0
+        print("{:>36} {:>8.1f}ms  {}".format(module, import_ms, ', '.join(heavy) if heavy else '-'))
+        if heavy or (args.max_ms is not None and import_ms > args.max_ms):
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    """
+    Main.
+    """
+
+    parser = argparse.ArgumentParser(description="Runs micro-benchmarks for Seq2Parse.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    chart_entry = subparsers.add_parser('chart-entry', help="Compares ChartEntry against IndexedChartEntry")
+    chart_entry.add_argument('grammar_file', help="Filepath to grammer file")
+    chart_entry.add_argument('erules_file', help="File with one error rule per line")
+    chart_entry.add_argument('programs', nargs='+', help="The input programs to repair")
+    chart_entry.add_argument('--top-n', type=int, default=20)
+    chart_entry.add_argument('--max-cost', type=int, default=5)
+    chart_entry.add_argument('--repeats', type=int, default=3)
+    chart_entry.set_defaults(run=bench_chart_entry)
+
+    strategy = subparsers.add_parser('strategy', help="Compares the passes against the agenda parsing strategy")
+    strategy.add_argument('grammar_file', help="Filepath to grammer file")
+    strategy.add_argument('erules_file', help="File with one error rule per line")
+    strategy.add_argument('programs', nargs='+', help="The input programs to repair")
+    strategy.add_argument('--top-n', type=int, default=20)
+    strategy.add_argument('--max-cost', type=int, default=5)
+    strategy.add_argument('--repeats', type=int, default=3)
+    strategy.set_defaults(run=bench_strategy)
+
+    scanner = subparsers.add_parser('scanner', help="Measures the throughput of the scanner")
+    scanner.add_argument('grammar_file', help="Filepath to grammer file")
+    scanner.add_argument('erules_file', help="File with one error rule per line")
+    scanner.add_argument('programs', nargs='+', help="The input programs to repair")
+    scanner.add_argument('--top-n', type=int, default=20)
+    scanner.add_argument('--max-cost', type=int, default=5)
+    scanner.add_argument('--repeats', type=int, default=3)
+    scanner.set_defaults(run=bench_scanner)
+
+    partial_parse = subparsers.add_parser('partial-parse', help="Measures the partial parses (abstraction) of the classifier's input")
+    partial_parse.add_argument('grammar_file', help="Filepath to grammer file")
+    partial_parse.add_argument('rules_usage', help="The rules usage (probabilities) of the grammar (.json)")
+    partial_parse.add_argument('programs', nargs='+', help="The input programs to abstract")
+    partial_parse.add_argument('--repeats', type=int, default=3)
+    partial_parse.set_defaults(run=bench_partial_parse)
+
+    lexer = subparsers.add_parser('lexer', help="Compares lexing the two token lists separately against lexing them in a single pass")
+    lexer.add_argument('grammar_file', help="Filepath to grammer file")
+    lexer.add_argument('programs', nargs='+', help="The input programs to lex")
+    lexer.add_argument('--repeats', type=int, default=5)
+    lexer.set_defaults(run=bench_lexer)
+
+    egrammar = subparsers.add_parser('grammar', help="Compares deepcopying the grammar against error grammar overlays (and measures their memory)")
+    egrammar.add_argument('grammar_file', help="Filepath to grammer file")
+    egrammar.add_argument('erules_file', help="File with one error rule per line")
+    egrammar.add_argument('--top-n', type=int, nargs='+', default=[0, 5, 10, 20, 50])
+    egrammar.add_argument('--repeats', type=int, default=5)
+    egrammar.set_defaults(run=bench_grammar)
+
+    classifier = subparsers.add_parser('classifier', help="Compares keras' predict against predict_fast of the error rule classifier")
+    classifier.add_argument('model_file', help="Filepath to the trained weights (.h5)")
+    classifier.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 64])
+    classifier.add_argument('--repeats', type=int, default=100)
+    classifier.add_argument('--device', default='/device:CPU:0')
+    classifier.add_argument('--tolerance', type=float, default=1e-6)
+    classifier.set_defaults(run=bench_classifier)
+
+    numpy_classifier = subparsers.add_parser('numpy-classifier', help="Compares the Keras against the NumPy engine of the error rule classifier")
+    numpy_classifier.add_argument('model_file', help="Filepath to the trained weights (.h5)")
+    numpy_classifier.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 64])
+    numpy_classifier.add_argument('--repeats', type=int, default=100)
+    numpy_classifier.add_argument('--device', default='/device:CPU:0')
+    numpy_classifier.add_argument('--tolerance', type=float, default=1e-4)
+    numpy_classifier.set_defaults(run=bench_numpy_classifier)
+
+    imports = subparsers.add_parser('imports', help="Checks that the parser modules do not import the heavy (ML) packages")
+    imports.add_argument('modules', nargs='*', default=['ecpp_individual_grammar', 'earleyparser_interm_repr', 'compiled_grammar',
+                                                        'seq2parse', 'predict_eccp_classifier_partials', 'numpy_transformer',
+                                                        'earleyparser', 'ecpp_dist'])
+    imports.add_argument('--heavy', nargs='+', default=['tensorflow', 'keras', 'sklearn', 'nltk', 'h5py', 'torch'])
+    imports.add_argument('--max-ms', type=float, default=None, help="Fail if a module takes longer to import")
+    imports.set_defaults(run=bench_imports)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,18 @@
 import sys
 from collections import defaultdict
-from copy import deepcopy
 import resource
 import timeit
 from statistics import median_high, median_low, mean
 # import multiprocessing.pool
 # from multiprocessing import TimeoutError
 from os.path import join, exists
-from functools import partial
 from pathlib import Path
 # import signal
 # from contextlib import contextmanager
 from concurrent.futures import TimeoutError
 from pebble import ProcessPool, ProcessExpired
 # import tqdm
-from ecpp_individual_grammar import read_grammar, lexed_prog_has_parse, fixed_lexed_prog
+from ecpp_individual_grammar import read_grammar, lexed_prog_has_parse, fixed_lexed_prog, ErrorGrammarCache
 
 # @contextmanager
 # def time_limit(seconds):
@@ -28,6 +26,10 @@ from ecpp_individual_grammar import read_grammar, lexed_prog_has_parse, fixed_le
 #         signal.alarm(0)
 
 
+# Cache of the error grammars of each worker (set by init_worker)
+ERROR_GRAMMARS = None
+
+
 def limit_memory():
     soft, hard = resource.getrlimit(resource.RLIMIT_AS)
     if soft < 0:
@@ -79,11 +81,16 @@ def print_results(fails, succs, bads, avg_time, parse_times, tpsize, time_gs, ou
             dataset_file.write(str(dt) + " sec: Parse accuracy = " + str(rates[dt]) + "\n")
 
 
-def has_parse(egrammar, tup):
+def init_worker(egrammars):
+    # Each worker keeps its own cache of the error grammars across its tasks
+    global ERROR_GRAMMARS
+    ERROR_GRAMMARS = egrammars
+
+
+def has_parse(tup):
     start_time = timeit.default_timer()
     tokns, eruls, user_time = tup
-    upd_grammar = deepcopy(egrammar)
-    upd_grammar.update_error_grammar_with_erules(eruls)
+    upd_grammar = ERROR_GRAMMARS.get(eruls)
     error_rules = fixed_lexed_prog(tokns, upd_grammar)
     if error_rules is None:
         bparse = False
@@ -105,6 +112,9 @@ def read_sample(samp):
 def do_all_test(grammar_file, data_dir, out_dir, results_file):
     ERROR_GRAMMAR = read_grammar(grammar_file)
     terminals = ERROR_GRAMMAR.get_alphabet()
+    # Precompute the error rules once, before the grammar is sent to the workers
+    ERROR_GRAMMAR.prepare_error_rules()
+    ERROR_GRAMMARS = ErrorGrammarCache(ERROR_GRAMMAR)
     TIMEOUT = 60 * 25 + 5
     parses_bad = 0
     done = 0
@@ -114,7 +124,7 @@ def do_all_test(grammar_file, data_dir, out_dir, results_file):
     total_size = 0
     parsed_progs_times = []
     time_gains = []
-    with ProcessPool(max_workers=1, max_tasks=5) as pool:
+    with ProcessPool(max_workers=1, max_tasks=5, initializer=init_worker, initargs=(ERROR_GRAMMARS,)) as pool:
         with open(join(out_dir, "parts-order.txt"), "w") as out_file:
             for partPath in list(data_dir.glob('part_*')):
                 out_file.write(partPath.name + '\n')
@@ -125,8 +135,7 @@ def do_all_test(grammar_file, data_dir, out_dir, results_file):
                 with open(dataset_part_file, "r") as inFile:
                     dataset = list(map(read_sample, inFile.read().split('\n')[:5]))
             print("# Syntax Errors to repair:", len(dataset))
-            new_has_parse = partial(has_parse, ERROR_GRAMMAR)
-            future = pool.map(new_has_parse, dataset, chunksize=1, timeout=TIMEOUT)
+            future = pool.map(has_parse, dataset, chunksize=1, timeout=TIMEOUT)
             it = future.result()
             while True:
                 try:
@@ -1,6 +1,5 @@
 import sys
 from collections import defaultdict
-from copy import deepcopy
 import json
 import resource
 import timeit
@@ -11,6 +10,7 @@ import re
 import subprocess
 # import multiprocessing.pool
 # from multiprocessing import TimeoutError
+from os import environ
 from os.path import join, exists
 from functools import partial
 from pathlib import Path
@@ -19,7 +19,8 @@ from pathlib import Path
 from concurrent.futures import TimeoutError
 from pebble import ProcessPool, ProcessExpired
 # import tqdm
-from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_list, get_actual_token_list, repair_prog
+from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_list, get_actual_token_list, repair_prog, ErrorGrammarCache
+import instrumentation
 
 # @contextmanager
 # def time_limit(seconds):
@@ -33,6 +34,12 @@ from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_li
 #         signal.alarm(0)
 
 
+# Cache of the error grammars of each worker (set by init_worker)
+ERROR_GRAMMARS = None
+# Profile the stages of the repairs (and write their histograms)
+PROFILE = environ.get('SEQ2PARSE_PROFILE') == '1'
+
+
 def limit_memory():
     soft, hard = resource.getrlimit(resource.RLIMIT_AS)
     if soft < 0:
@@ -202,29 +209,37 @@ def return_all_changes(bad, fix):
     return changes
 
 
-def has_parse(egrammar, max_cost, tup):
+def init_worker(egrammars):
+    # Each worker keeps its own cache of the error grammars across its tasks
+    global ERROR_GRAMMARS
+    ERROR_GRAMMARS = egrammars
+
+
+def has_parse(max_cost, tup, strategy="passes"):
     tokns, eruls, tok_chgs, user_time, fixed_tokns, popul, orig_prg, orig_fix, actual_tokns = tup
     # print('=' * 42 + '\n')
     # print(orig_prg.replace("\\n", '\n'))
     # print(orig_fix.replace("\\n", '\n'))
     # print(eruls)
     # print('=' * 42 + '\n')
-    upd_grammar_empty = deepcopy(egrammar)
-    upd_grammar_empty.update_error_grammar_with_erules([])
+    upd_grammar_empty = ERROR_GRAMMARS.get([])
     abstr_orig_fixed_seq, orig_fixed_seq, _, _, _  = fixed_lexed_prog(fixed_tokns, upd_grammar_empty, max_cost)
 
     start_time = timeit.default_timer()
-    upd_grammar = deepcopy(egrammar)
     # if 'Err_Colon -> Err_Tag' in eruls:
     #     eruls.remove('Err_Colon -> Err_Tag')
-    upd_grammar.update_error_grammar_with_erules(eruls)
-    abstr_fixed_seq, fixed_seq, fixed_seq_ops, used_erules, repair_cost = fixed_lexed_prog(tokns, upd_grammar, max_cost)
-    repaired_prog = None
-    if fixed_seq is None:
-        bparse = False
-    else:
-        repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
-        bparse = True
+    # The stages of the repair are profiled with SEQ2PARSE_PROFILE=1
+    with instrumentation.profile(enabled=PROFILE) as prof:
+        upd_grammar = ERROR_GRAMMARS.get(eruls)
+        abstr_fixed_seq, fixed_seq, fixed_seq_ops, used_erules, repair_cost = fixed_lexed_prog(tokns, upd_grammar, max_cost, strategy)
+        repaired_prog = None
+        if fixed_seq is None:
+            bparse = False
+        else:
+            with instrumentation.stage('repair_prog'):
+                repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
+            bparse = True
+    prof = prof.as_dict() if prof is not None else None
     # debug_out = '=' * 42 + '\n'
     # debug_out += tokns.replace('_NEWLINE_ ', '\n')
     # debug_out += '\n' + '*' * 42 + '\n'
@@ -251,9 +266,9 @@ def has_parse(egrammar, max_cost, tup):
         any_correct_lines = any(map(lambda l: l in orig_fixed_lines, our_fixed_lines)) if our_fixed_lines else True
     dt = user_time - run_time
     if bparse:
-        return (bparse, run_time, dt, tok_chgs, prog_size, abstr_orig_fixed_seq == abstr_fixed_seq, all_correct_lines, any_correct_lines, popul, {"orig": orig_prg, "repaired": repaired_prog, "fix": orig_fix}, repair_cost, used_erules)
+        return (bparse, run_time, dt, tok_chgs, prog_size, abstr_orig_fixed_seq == abstr_fixed_seq, all_correct_lines, any_correct_lines, popul, {"orig": orig_prg, "repaired": repaired_prog, "fix": orig_fix}, repair_cost, used_erules, prof)
     else:
-        return (bparse, run_time, dt, tok_chgs, prog_size, False, False, False, popul, None, -1, None)
+        return (bparse, run_time, dt, tok_chgs, prog_size, False, False, False, popul, None, -1, None, prof)
 
 
 def read_sample(samp):
@@ -262,8 +277,11 @@ def read_sample(samp):
     return (samp_1[0], samp_2, int(samp_1[2]), float(samp_1[3]), samp_1[4], samp_1[5] == "popular", samp_1[6], samp_1[7], samp_1[8])
 
 
-def do_all_test(grammar_file, data_dir, out_dir, top_rules_num, ecpp_max_cost, results_file, in_file):
+def do_all_test(grammar_file, data_dir, out_dir, top_rules_num, ecpp_max_cost, results_file, in_file, strategy="passes"):
     ERROR_GRAMMAR = read_grammar(grammar_file)
+    # Precompute the error rules once, before the grammar is sent to the workers
+    ERROR_GRAMMAR.prepare_error_rules()
+    ERROR_GRAMMARS = ErrorGrammarCache(ERROR_GRAMMAR)
     TIMEOUT = 60 * 5
     parses_bad = 0
     finds_all_lines = 0
@@ -285,7 +303,9 @@ def do_all_test(grammar_file, data_dir, out_dir, top_rules_num, ecpp_max_cost, r
     all_used_erules = defaultdict(int)
     max_used_erules = []
     accs_per_changes = defaultdict(lambda : (0, 0))
-    with ProcessPool(max_workers=28, max_tasks=5) as pool:
+    # Histograms of the stages of the repairs (with SEQ2PARSE_PROFILE=1)
+    histograms = instrumentation.Histograms()
+    with ProcessPool(max_workers=28, max_tasks=5, initializer=init_worker, initargs=(ERROR_GRAMMARS,)) as pool:
         dataset_part_file = join(data_dir, in_file)
         if exists(dataset_part_file):
             with open(dataset_part_file, "r") as inFile:
@@ -297,14 +317,16 @@ def do_all_test(grammar_file, data_dir, out_dir, top_rules_num, ecpp_max_cost, r
             if not popul:
                 all_not_populars += 1
         print("# Syntax Errors to repair:", len(dataset))
-        new_has_parse = partial(has_parse, ERROR_GRAMMAR, ecpp_max_cost)
+        new_has_parse = partial(has_parse, ecpp_max_cost, strategy=strategy)
         future = pool.map(new_has_parse, dataset, chunksize=1, timeout=TIMEOUT)
         it = future.result()
         while True:
             try:
                 bruh = next(it)
                 if bruh:
-                    parse_bad, run_time, dt, tok_chgs, size, user_same, all_lines, any_lines, popular, tupla, repair_cst, used_erls = bruh
+                    parse_bad, run_time, dt, tok_chgs, size, user_same, all_lines, any_lines, popular, tupla, repair_cst, used_erls, prof = bruh
+                    if prof is not None:
+                        histograms.add(prof)
                     if parse_bad:
                         parses_bad += 1
                         if all_lines:
@@ -350,6 +372,9 @@ def do_all_test(grammar_file, data_dir, out_dir, top_rules_num, ecpp_max_cost, r
                 if (failed + done) % 50 == 0:
                     print_results(failed, done, parses_bad, not_popular_parses, all_not_populars, accs_per_changes, all_tok_chngs, avg_run_time, parsed_progs_times, total_size, all_times_sizes, time_gains, same_as_users, finds_all_lines, finds_any_lines, out_dir, results_file, all_tuplas, repair_costs, all_used_erules, max_used_erules, max_time=TIMEOUT+5)
         print_results(failed, done, parses_bad, not_popular_parses, all_not_populars, accs_per_changes, all_tok_chngs, avg_run_time, parsed_progs_times, total_size, all_times_sizes, time_gains, same_as_users, finds_all_lines, finds_any_lines, out_dir, results_file, all_tuplas, repair_costs, all_used_erules, max_used_erules, max_time=TIMEOUT+5)
+        if PROFILE:
+            with open(join(out_dir, "stage-histograms.txt"), "w") as out_file:
+                out_file.write(histograms.report() + '\n')
 
 
 if __name__ == "__main__":
@@ -359,9 +384,12 @@ if __name__ == "__main__":
     input_file = sys.argv[4]
     num_of_tops = int(sys.argv[5])
     max_cost = int(sys.argv[6])
+    # Parsing strategy of the error-correcting parser ("passes" or "agenda")
+    parse_strategy = sys.argv[7] if len(sys.argv) > 7 else "passes"
+    strategy_suffix = "-" + parse_strategy if parse_strategy != "passes" else ""
 
     limit_memory()
-    do_all_test(grammarFile, dataDir, outDir, num_of_tops, max_cost, "ECPP-runtime-clean-test-top-1-repair-" + str(num_of_tops) + "-popular-cost-" + str(max_cost) + ".txt", input_file)
+    do_all_test(grammarFile, dataDir, outDir, num_of_tops, max_cost, "ECPP-runtime-clean-test-top-1-repair-" + str(num_of_tops) + "-popular-cost-" + str(max_cost) + strategy_suffix + ".txt", input_file, parse_strategy)
 
     # # For individual testing using:
     # # >>> time python run_parse_test_time_top_n_all_states.py python-grammar.txt repairs/orig_0.py repairs/fix_0.py test-set-top-20-partials-probs.txt 20
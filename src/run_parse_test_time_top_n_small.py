@@ -1,6 +1,5 @@
 import sys
 from collections import defaultdict
-from copy import deepcopy
 import timeit
 from statistics import median_high, median_low, mean
 import difflib as df
@@ -9,10 +8,15 @@ from os import environ
 from os.path import join
 from pathlib import Path
 import tqdm
-from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_list, get_actual_token_list, repair_prog
+import instrumentation
+from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_list, get_token_lists, repair_prog, ErrorGrammarCache
 from predict_eccp_classifier_partials import predict_error_rules
 
 
+# Profile the stages of the repairs (and print their histograms)
+PROFILE = environ.get('SEQ2PARSE_PROFILE') == '1'
+
+
 def rate(secs, times):
     in_set = list(filter(lambda x: x <= secs, times))
     return len(in_set) * 100.0 / len(times)
@@ -90,23 +94,25 @@ def return_all_changes(bad, fix):
     return changes
 
 
-def has_parse(egrammar, max_cost, tup):
+def has_parse(egrammars, max_cost, tup):
     tokns, eruls, user_time, fixed_tokns, orig_prg, orig_fix, actual_tokns = tup
 
-    upd_grammar_empty = deepcopy(egrammar)
-    upd_grammar_empty.update_error_grammar_with_erules([])
+    upd_grammar_empty = egrammars.get([])
     abstr_orig_fixed_seq, orig_fixed_seq, _, _, _  = fixed_lexed_prog(fixed_tokns, upd_grammar_empty, max_cost)
 
     start_time = timeit.default_timer()
-    upd_grammar = deepcopy(egrammar)
-    upd_grammar.update_error_grammar_with_erules(eruls)
-    abstr_fixed_seq, fixed_seq, fixed_seq_ops, _, _ = fixed_lexed_prog(tokns, upd_grammar, max_cost)
-    repaired_prog = None
-    if fixed_seq is None:
-        bparse = False
-    else:
-        repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
-        bparse = True
+    # The stages of the repair are profiled with SEQ2PARSE_PROFILE=1
+    with instrumentation.profile(enabled=PROFILE) as prof:
+        upd_grammar = egrammars.get(eruls)
+        abstr_fixed_seq, fixed_seq, fixed_seq_ops, _, _ = fixed_lexed_prog(tokns, upd_grammar, max_cost)
+        repaired_prog = None
+        if fixed_seq is None:
+            bparse = False
+        else:
+            with instrumentation.stage('repair_prog'):
+                repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
+            bparse = True
+    prof = prof.as_dict() if prof is not None else None
     # debug_out = '=' * 42 + '\n'
     # debug_out += tokns.replace('_NEWLINE_ ', '\n')
     # debug_out += '\n' + '*' * 42 + '\n'
@@ -134,14 +140,16 @@ def has_parse(egrammar, max_cost, tup):
         any_correct_lines = any(map(lambda l: l in orig_fixed_lines, our_fixed_lines)) if our_fixed_lines else True
     dt = user_time - run_time
     if bparse:
-        return (bparse, run_time, dt, abstr_orig_fixed_seq == abstr_fixed_seq, all_correct_lines, any_correct_lines, {"orig": orig_prg, "repaired": repaired_prog, "fix": orig_fix})
+        return (bparse, run_time, dt, abstr_orig_fixed_seq == abstr_fixed_seq, all_correct_lines, any_correct_lines, {"orig": orig_prg, "repaired": repaired_prog, "fix": orig_fix}, prof)
     else:
-        return (bparse, run_time, dt, False, False, False, None)
+        return (bparse, run_time, dt, False, False, False, None, prof)
 
 
 def do_all_test(grammar_file, data_dir, models_dir, top_rules_num, ecpp_max_cost, do_predict):
     ERROR_GRAMMAR = read_grammar(grammar_file)
     terminals = ERROR_GRAMMAR.get_alphabet()
+    ERROR_GRAMMAR.prepare_error_rules()
+    ERROR_GRAMMARS = ErrorGrammarCache(ERROR_GRAMMAR)
     parses_bad = 0
     finds_all_lines = 0
     finds_any_lines = 0
@@ -173,13 +181,18 @@ def do_all_test(grammar_file, data_dir, models_dir, top_rules_num, ecpp_max_cost
         top_20_erules = ['InsertErr -> (', 'InsertErr -> )', 'Err_Endmarker -> H Endmarker', 'InsertErr -> :', 'Err_Literals -> ', 'Err_Dedent -> ', 'Err_Indent -> ', 'Err_Close_Paren -> H Close_Paren', 'Err_Literals -> H Literals', 'Err_Colon -> ', 'Err_Close_Paren -> ', 'InsertErr -> _INDENT_', 'Err_Comp_Op -> Err_Tag', 'InsertErr -> _DEDENT_', 'InsertErr -> =', 'InsertErr -> _NAME_', 'Err_Open_Paren -> H Open_Paren', 'Err_Newline -> H Newline', 'Err_Open_Paren -> ', 'Err_Tag -> =']
         # top_50_erules = ['InsertErr -> _NUMBER_', 'Err_Endmarker -> H Endmarker', 'Err_Open_Sq_Bracket -> H Open_Sq_Bracket', 'InsertErr -> =', 'Err_Open_Paren -> H Open_Paren', 'Err_Assign_Op -> ', 'InsertErr -> elif', 'Err_Def_Keyword -> ', 'Err_Def_Keyword -> H Def_Keyword', 'InsertErr -> if', 'Err_Colon -> H Colon', 'Err_Colon -> ', 'Err_Close_Paren -> ', 'InsertErr -> :', 'InsertErr -> else', 'Err_Arith_Op -> ', 'InsertErr -> _INDENT_', 'InsertErr -> (', 'InsertErr -> )', 'Err_Newline -> H Newline', 'Err_Return_Keyword -> H Return_Keyword', 'Err_Comp_Op -> ', 'Err_Dedent -> Err_Tag', 'Err_If_Keyword -> ', 'Err_Open_Paren -> ', 'Err_Indent -> Err_Tag', 'InsertErr -> def', 'Err_If_Keyword -> H If_Keyword', 'Err_Close_Sq_Bracket -> ', 'Err_Literals -> H Literals', 'Err_Tag -> _INDENT_', 'InsertErr -> _UNKNOWN_', 'InsertErr -> _DEDENT_', 'InsertErr -> [', 'Err_Literals -> ', 'Err_Dedent -> H Dedent', 'Err_Dedent -> ', 'InsertErr -> _NAME_', 'Err_Tag -> _NAME_', 'Err_Tag -> =', 'Err_Comp_Op -> H Comp_Op', 'InsertErr -> for', 'Err_Close_Paren -> H Close_Paren', 'Err_For_Keyword -> H For_Keyword', 'Err_Tag -> _UNKNOWN_', 'Err_Comp_Op -> Err_Tag', 'Err_Close_Paren -> Err_Tag', 'InsertErr -> _STRING_', 'Err_Comma -> ', 'Err_Indent -> ']
         all_error_rules = [top_20_erules for _ in dataset]
-    dataset = [(get_token_list(prog, terminals), erules, user_time, get_token_list(user_fix, terminals), prog, user_fix, get_actual_token_list(prog, terminals))
-                for prog, erules, user_time, user_fix in zip(dataset, all_error_rules, user_times, user_fixes)]
+    dataset = [(prog_tokens, erules, user_time, get_token_list(user_fix, terminals), prog, user_fix, actual_tokens)
+                for prog, erules, user_time, user_fix in zip(dataset, all_error_rules, user_times, user_fixes)
+                    for prog_tokens, actual_tokens in [get_token_lists(prog, terminals)]]
     print("Programs to repair:", len(dataset))
+    # Histograms of the stages of the repairs (with SEQ2PARSE_PROFILE=1)
+    histograms = instrumentation.Histograms()
     i = 0
     for sample in tqdm.tqdm(dataset):
         i += 1
-        parse_bad, run_time, dt, user_same, all_lines, any_lines, _ = has_parse(ERROR_GRAMMAR, ecpp_max_cost, sample)
+        parse_bad, run_time, dt, user_same, all_lines, any_lines, _, prof = has_parse(ERROR_GRAMMARS, ecpp_max_cost, sample)
+        if prof is not None:
+            histograms.add(prof)
         if parse_bad:
             parses_bad += 1
             if all_lines:
@@ -193,6 +206,9 @@ def do_all_test(grammar_file, data_dir, models_dir, top_rules_num, ecpp_max_cost
         time_gains.append(dt)
         done += 1
     print_results(done, parses_bad, avg_run_time, parsed_progs_times, time_gains, same_as_users, finds_all_lines, finds_any_lines)
+    print("Error grammar cache:", ERROR_GRAMMARS.stats())
+    if PROFILE:
+        print(histograms.report())
 
 
 if __name__ == "__main__":
@@ -1,23 +1,35 @@
 import sys
 import re
-from copy import deepcopy
-from os import mkdir, environ
+from os import mkdir, environ, cpu_count
 from os.path import join, exists
 from pathlib import Path
 import difflib as df
 import json
-import tensorflow as tf
-from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_list, get_actual_token_list, repair_prog
-from predict_eccp_classifier_partials import predict_error_rules
-
-
-def repair(egrammar, max_cost, tokns, eruls, actual_tokns):
-    upd_grammar = deepcopy(egrammar)
-    upd_grammar.update_error_grammar_with_erules(eruls)
-    _, fixed_seq, fixed_seq_ops, _, _ = fixed_lexed_prog(tokns, upd_grammar, max_cost)
+import instrumentation
+from ecpp_individual_grammar import read_grammar, fixed_lexed_prog, get_token_lists, get_actual_token_list, repair_prog, ErrorGrammarCache
+from caches import RepairCache
+
+
+def repair(egrammars, max_cost, tokns, eruls, actual_tokns, repairs=None, strategy="passes"):
+    # The repairs of already seen programs (RepairCache) only need repair_prog
+    if repairs is not None:
+        key = repairs.key(tokns, eruls, max_cost, strategy)
+        found, fixed_seq_ops = repairs.get(key)
+        if found:
+            instrumentation.count('repair_cache_hits')
+            if fixed_seq_ops is None:
+                return None
+            with instrumentation.stage('repair_prog'):
+                return repair_prog(actual_tokns, fixed_seq_ops)
+    # The error grammars are cached by the set of error rules (ErrorGrammarCache)
+    upd_grammar = egrammars.get(eruls)
+    _, fixed_seq, fixed_seq_ops, _, _ = fixed_lexed_prog(tokns, upd_grammar, max_cost, strategy)
+    if repairs is not None:
+        repairs.put(key, fixed_seq_ops if fixed_seq is not None else None)
     repaired_prog = None
     if fixed_seq is not None:
-        repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
+        with instrumentation.stage('repair_prog'):
+            repaired_prog = repair_prog(actual_tokns, fixed_seq_ops)
     return repaired_prog
 
 
@@ -70,36 +82,11 @@ def get_line_location(orig_line, parsed_line, token_num, option):
     return column
 
 
-if __name__ == "__main__":
-    # For single (erroneous) file:
-    # >>> python seq2parse.py python-grammar.txt ./models 0 input_prog.py
-    grammarFile = sys.argv[1]
-    modelsDir = Path(sys.argv[2])
-    gpuToUse = '/device:GPU:' + sys.argv[3]
-    inputPath = Path(sys.argv[4])
-
-    max_cost = 5
-    environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-    input_prog = inputPath.read_text()
-    # print('*' * 42)
-    # print(input_prog)
-    # print('*' * 42)
-    ERROR_GRAMMAR = read_grammar(grammarFile)
-    terminals = ERROR_GRAMMAR.get_alphabet()
-
-    prog_tokens = get_token_list(input_prog, terminals)
-    error_rules = predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, True)
-    actual_tokens = get_actual_token_list(input_prog, terminals)
-
-    repaired_prog = repair(ERROR_GRAMMAR, max_cost, prog_tokens, error_rules, actual_tokens).replace('_white_space_', ' ').replace('_NEWLINE_', '\n').replace("\\n", '\n')
-
-    print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-    print("-------------Original Buggy Program---------------")
-    print(input_prog)
-    print("-----------------Repaired Program-----------------")
-    print(repaired_prog[:-3])
-    print("<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<")
-
+def get_result(input_prog, actual_tokens, repaired_prog, terminals):
+    """
+    Returns the result of the repair of the given program, i.e. its status and
+    the errors (changes) of the repaired program.
+    """
     diff_lines = df.ndiff(actual_tokens.split('_NEWLINE_'), get_actual_token_list(repaired_prog, terminals).split('_NEWLINE_'))
     line_changes = [(ch_type, line_num + 1, get_line_location(input_prog.split('\n')[line_num], prev_line.replace('_INDENT_', ''), token_num, ch_type) + 1, len(input_prog.split('\n')[line_num]), (prev, change), ch_line.replace('_INDENT_', ''))
                     for _, line_num, prev_line, ch_line in get_changes(list(diff_lines))
@@ -130,6 +117,74 @@ if __name__ == "__main__":
                                     , "start"  : {"line": line_num, "column": column}
                                     , "stop"   : {"line": line_num, "column": column + length if column + length > 1 else 20}
                                     })
+    return result
+
+
+if __name__ == "__main__":
+    # For single (erroneous) file:
+    # >>> python seq2parse.py python-grammar.txt ./models 0 input_prog.py
+    # For a batch of programs (JSONL of {"id": ..., "program": ...}), with the
+    # results (JSONL, in the same order) in the standard output:
+    # >>> python seq2parse.py python-grammar.txt ./models 0 --batch programs.jsonl [num_of_workers]
+    grammarFile = sys.argv[1]
+    modelsDir = Path(sys.argv[2])
+    gpuToUse = '/device:GPU:' + sys.argv[3]
+
+    max_cost = 5
+    environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    if sys.argv[4] == '--batch':
+        from predict_eccp_classifier_partials import get_predictor
+        from repair_service import RepairService
+        num_of_workers = int(sys.argv[6]) if len(sys.argv) > 6 else cpu_count()
+        try:
+            predictor = get_predictor(grammarFile, modelsDir, gpuToUse, cache_path=environ.get('SEQ2PARSE_PREDICTION_CACHE'))
+        except FileNotFoundError as e:
+            print(e, file=sys.stderr)
+            sys.exit(-1)
+        ERROR_GRAMMAR = read_grammar(grammarFile)
+        # There are only batches, so they have all of the pool's budget
+        service = RepairService(ERROR_GRAMMAR, max_workers=num_of_workers,
+                                max_pending=max(64, 2 * num_of_workers), max_batch_pending=max(64, 2 * num_of_workers),
+                                timeout=float(environ.get('SEQ2PARSE_TIMEOUT', 60)),
+                                repairs=RepairCache(path=environ.get('SEQ2PARSE_REPAIR_CACHE'), version=ERROR_GRAMMAR.digest()))
+        with (sys.stdin if sys.argv[5] == '-' else open(sys.argv[5], "r")) as in_file:
+            for result in service.repair_batch(predictor, in_file, max_cost):
+                print(json.dumps(result), flush=True)
+        service.close()
+        sys.exit(0)
+
+    inputPath = Path(sys.argv[4])
+    input_prog = inputPath.read_text()
+    # print('*' * 42)
+    # print(input_prog)
+    # print('*' * 42)
+    ERROR_GRAMMAR = read_grammar(grammarFile)
+    terminals = ERROR_GRAMMAR.get_alphabet()
+
+    # The abstract and actual tokens come from a single lexing pass, shared by
+    # the predictor and the parser
+    prog_tokens, actual_tokens = get_token_lists(input_prog, terminals)
+    # The classifier (and TensorFlow) is only imported when a prediction is needed
+    from predict_eccp_classifier_partials import get_predictor
+    try:
+        predictor = get_predictor(grammarFile, modelsDir, gpuToUse, cache_path=environ.get('SEQ2PARSE_PREDICTION_CACHE'))
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit(-1)
+    error_rules = predictor.predict(input_prog, tokens=prog_tokens)
+
+    # Repairs are cached on disk with SEQ2PARSE_REPAIR_CACHE=<sqlite file>
+    repairs = RepairCache(path=environ.get('SEQ2PARSE_REPAIR_CACHE'), version=ERROR_GRAMMAR.digest())
+    repaired_prog = repair(ErrorGrammarCache(ERROR_GRAMMAR), max_cost, prog_tokens, error_rules, actual_tokens, repairs).replace('_white_space_', ' ').replace('_NEWLINE_', '\n').replace("\\n", '\n')
+
+    print(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+    print("-------------Original Buggy Program---------------")
+    print(input_prog)
+    print("-----------------Repaired Program-----------------")
+    print(repaired_prog[:-3])
+    print("<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<")
+
+    result = get_result(input_prog, actual_tokens, repaired_prog, terminals)
     tmpDir = join(inputPath.parent.absolute(), ".seq2parse")
     if not exists(tmpDir):
         mkdir(tmpDir)
@@ -1,52 +1,131 @@
+import json
 import urllib.parse
 from os import environ
 
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 
-from ecpp_individual_grammar import read_grammar, get_token_list, get_actual_token_list
-from predict_eccp_classifier_partials import predict_error_rules
+from ecpp_individual_grammar import read_grammar, get_token_lists, ErrorGrammarCache
+from caches import RepairCache
+from predict_eccp_classifier_partials import get_predictor, BatchingPredictor
 from seq2parse import repair
+from repair_service import RepairService
+import instrumentation
 
 app = Flask(__name__)
 
+# The HTTP status of the repairs of the pool that did not finish, i.e. the
+# pool was full, the deadline passed or the worker died. The original program
+# is returned with them
+STATUS_CODES = {'rejected': 503, 'timeout': 504, 'failed': 500}
+
+# The repair workers (started from a forkserver) import this module as
+# __mp_main__, so the grammar, caches, model and pool are only set up by the app
+if __name__ != '__mp_main__':
+    ERROR_GRAMMAR = read_grammar("python-grammar.txt")
+    TERMINALS = ERROR_GRAMMAR.get_alphabet()
+    # Error grammars of the predicted error rules, shared by all requests
+    ERROR_GRAMMARS = ErrorGrammarCache(ERROR_GRAMMAR)
+    # Repairs of already seen programs, in memory and (optionally) in the sqlite
+    # file SEQ2PARSE_REPAIR_CACHE
+    REPAIR_CACHE = RepairCache(max_size=int(environ.get('SEQ2PARSE_REPAIR_CACHE_SIZE', 4096)),
+                               path=environ.get('SEQ2PARSE_REPAIR_CACHE'), version=ERROR_GRAMMAR.digest())
+    # The model and its vocabularies are loaded once, when the app starts, and
+    # concurrent requests are batched (up to SEQ2PARSE_MAX_BATCH programs or
+    # SEQ2PARSE_MAX_WAIT_MS milliseconds). Predictions are cached in memory and
+    # (optionally) in the sqlite file SEQ2PARSE_PREDICTION_CACHE
+    environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    PREDICTOR = BatchingPredictor(get_predictor("python-grammar.txt", "./models", '/device:GPU:0',
+                                                cache_path=environ.get('SEQ2PARSE_PREDICTION_CACHE')),
+                                  max_batch_size=int(environ.get('SEQ2PARSE_MAX_BATCH', 16)),
+                                  max_wait_ms=float(environ.get('SEQ2PARSE_MAX_WAIT_MS', 5)),
+                                  max_queue_size=int(environ.get('SEQ2PARSE_MAX_QUEUE', 256)))
+    # With SEQ2PARSE_WORKERS > 0, the repairs run in a pool of worker processes
+    # with a deadline of SEQ2PARSE_TIMEOUT seconds per request (and at most
+    # SEQ2PARSE_MAX_PENDING repairs in the pool, SEQ2PARSE_MAX_BATCH_PENDING of
+    # them of batches), instead of in the request thread
+    REPAIRS = None
+    if int(environ.get('SEQ2PARSE_WORKERS', 0)) > 0:
+        REPAIRS = RepairService(ERROR_GRAMMAR,
+                                max_workers=int(environ.get('SEQ2PARSE_WORKERS')),
+                                max_pending=int(environ.get('SEQ2PARSE_MAX_PENDING', 64)),
+                                max_batch_pending=int(environ['SEQ2PARSE_MAX_BATCH_PENDING']) if 'SEQ2PARSE_MAX_BATCH_PENDING' in environ else None,
+                                timeout=float(environ.get('SEQ2PARSE_TIMEOUT', 10)),
+                                repairs=REPAIR_CACHE)
+    # With SEQ2PARSE_PROFILE=1 (or ?profile=1), the timings and counters of the
+    # stages of each repair are returned in the X-Seq2Parse-Profile header (and
+    # in the results of the batches)
+    PROFILE = environ.get('SEQ2PARSE_PROFILE') == '1'
+
 
 @app.route('/api/text', methods=['GET'])
 def get_text():
     url = request.args.get('seq2parse')
     decoded_url = urllib.parse.unquote(url)  # Decode the URL
 
-    # For single (erroneous) file:
-    # >>> python seq2parse.py python-grammar.txt ./models 0 input_prog.py
-    grammarFile = "python-grammar.txt"
-    modelsDir = "./models"
-    gpuToUse = '/device:GPU:0'
-
     max_cost = 5
-    environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
     input_prog = decoded_url
     print(input_prog)
     # print('*' * 42)
     # print(input_prog)
     # print('*' * 42)
-    ERROR_GRAMMAR = read_grammar(grammarFile)
-    terminals = ERROR_GRAMMAR.get_alphabet()
-
-    prog_tokens = get_token_list(input_prog, terminals)
-    error_rules = predict_error_rules(grammarFile, modelsDir, gpuToUse, input_prog, True)
-    actual_tokens = get_actual_token_list(input_prog, terminals)
-
-    repaired_prog = repair(ERROR_GRAMMAR, max_cost, prog_tokens, error_rules, actual_tokens)
+    status = None
+    with instrumentation.profile(enabled=PROFILE or request.args.get('profile') == '1') as prof:
+        with instrumentation.stage('total'):
+            # The program is lexed once, for both the predictor and the parser
+            prog_tokens, actual_tokens = get_token_lists(input_prog, TERMINALS)
+            error_rules = PREDICTOR.predict(input_prog, tokens=prog_tokens)
+            if REPAIRS is not None:
+                repaired_prog, status = REPAIRS.repair(input_prog, error_rules, max_cost, tokens=(prog_tokens, actual_tokens))
+            else:
+                repaired_prog = repair(ERROR_GRAMMARS, max_cost, prog_tokens, error_rules, actual_tokens, REPAIR_CACHE)
     if repaired_prog is not None:
         repaired_prog = repaired_prog.replace('_white_space_', ' ').replace('_NEWLINE_', '\n').replace("\\n", '\n')
+        fix = repaired_prog[:-3]
     else:
-        repaired_prog = input_prog
+        # Not repaired (or timed out, etc.), so the original program is returned
+        fix = input_prog
 
     # Here, you can implement code to retrieve the text from the provided URL
     # and process it as needed. For simplicity, we'll just return the decoded URL.
 
-    fix = repaired_prog[:-3]
     print(fix)
-    return fix
+    headers = dict([])
+    if status is not None:
+        headers['X-Seq2Parse-Status'] = status
+    if prof is not None:
+        headers['X-Seq2Parse-Profile'] = json.dumps(prof.as_dict())
+    if not headers:
+        return fix
+    return fix, STATUS_CODES.get(status, 200), headers
+
+
+@app.route('/api/batch', methods=['POST'])
+def post_batch():
+    # JSONL of {"id": ..., "program": ...}, repaired in the worker pool and
+    # streamed back (JSONL) in the same order
+    if REPAIRS is None:
+        return "Batch repairs need SEQ2PARSE_WORKERS > 0\n", 400
+    lines = request.get_data(as_text=True).splitlines()
+    results = REPAIRS.repair_batch(PREDICTOR, lines, max_cost=5, batch_size=int(environ.get('SEQ2PARSE_MAX_BATCH', 16)),
+                                   profiled=PROFILE or request.args.get('profile') == '1')
+
+    def stream():
+        # The remaining repairs are cancelled if the client disconnects
+        try:
+            for result in results:
+                yield json.dumps(result) + '\n'
+        finally:
+            results.close()
+    return Response(stream(), mimetype='application/x-ndjson')
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    # The repairs of the worker pool are cached by the workers (and not counted here)
+    stats = {"error_grammars": ERROR_GRAMMARS.stats(), "repair_cache": REPAIR_CACHE.stats(), "predictor": PREDICTOR.metrics()}
+    if REPAIRS is not None:
+        stats["repairs"] = REPAIRS.metrics()
+    return jsonify(stats)
 
 
 if __name__ == '__main__':
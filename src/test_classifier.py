@@ -0,0 +1,90 @@
+"""
+Checks that the inference paths of the error rule classifier agree with
+Keras' predict. The NumPy engine is checked against the stored Keras outputs
+of a small classifier (golden/transformer-classifier-small*), which are
+written by running this file with TensorFlow.
+"""
+
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+
+GOLDEN_DIR = Path(__file__).parent / "golden"
+SMALL_MODEL = GOLDEN_DIR / "transformer-classifier-small.h5"
+SMALL_OUTPUTS = GOLDEN_DIR / "transformer-classifier-small-outputs.npz"
+
+
+def small_classifier(seed=42):
+    """
+    Returns a small classifier with the same vocabularies, sequence length and
+    labels as the trained one, with random weights.
+    """
+    import tensorflow as tf
+    from transformer_classifier import TransformerClassifier
+    from predict_eccp_classifier_partials import VOCAB_SIZE, X_MAXLEN, NUM_OF_LABELS
+
+    tf.random.set_seed(seed)
+    transformerClfr = TransformerClassifier(16, 2, 32, 2, [32, 16], VOCAB_SIZE, X_MAXLEN, NUM_OF_LABELS, 'sigmoid')
+    # The biases and the layer norms start at 0s and 1s, so they are perturbed too
+    rng = np.random.default_rng(seed)
+    transformerClfr.model.set_weights([w + rng.normal(0, 0.3, w.shape).astype('float32')
+                                       for w in transformerClfr.model.get_weights()])
+    return transformerClfr
+
+
+def write_small_model():
+    from numpy_transformer import pad_sequences
+    from predict_eccp_classifier_partials import VOCAB_SIZE, X_MAXLEN
+
+    transformerClfr = small_classifier()
+    transformerClfr.save_weights(str(SMALL_MODEL))
+    # Padded and truncated programs of different lengths
+    rng = np.random.default_rng(42)
+    xs = pad_sequences([list(rng.integers(1, VOCAB_SIZE, size=n)) for n in [1, 5, 17, 40, 64, 100, 128, 200]], X_MAXLEN)
+    np.savez_compressed(SMALL_OUTPUTS, xs=xs, ys=transformerClfr.model.predict(xs, verbose=0))
+
+
+def top_labels(ys, cut_offs=(10, 20, 50)):
+    """
+    Returns the sets of the top 10, 20 and 50 labels of each prediction, i.e.
+    the error rules picked by Seq2ParsePredictor.labelize (the order within
+    them does not matter, as the label binarizer returns them sorted).
+    """
+    return [[set(np.argsort(y)[::-1][:top_k]) for top_k in cut_offs] for y in ys]
+
+
+def test_predict_fast_matches_predict():
+    pytest.importorskip("tensorflow")
+    transformerClfr = small_classifier()
+    xs = np.load(SMALL_OUTPUTS)["xs"]
+    y_pred = transformerClfr.model.predict(xs, verbose=0)
+    y_fast = transformerClfr.predict_fast(xs)
+    assert y_fast.shape == y_pred.shape
+    # The graph may fuse operations differently, i.e. differ in the last bits,
+    # but the error rules are picked by rank, so the ranks must be the same
+    np.testing.assert_allclose(y_fast, y_pred, rtol=0, atol=1e-6)
+    assert top_labels(y_fast) == top_labels(y_pred)
+
+
+def test_numpy_engine_matches_keras():
+    pytest.importorskip("h5py")
+    from numpy_transformer import NumpyTransformerClassifier
+
+    outputs = np.load(SMALL_OUTPUTS)
+    y_numpy = NumpyTransformerClassifier(SMALL_MODEL).predict_fast(outputs["xs"])
+    assert y_numpy.shape == outputs["ys"].shape
+    np.testing.assert_allclose(y_numpy, outputs["ys"], rtol=0, atol=1e-5)
+    # The error rules are picked by rank
+    assert top_labels(y_numpy) == top_labels(outputs["ys"])
+
+
+def test_missing_model(tmp_path):
+    # The callers decide whether to exit (e.g. the CLI does)
+    from predict_eccp_classifier_partials import Seq2ParsePredictor
+    with pytest.raises(FileNotFoundError):
+        Seq2ParsePredictor(Path(__file__).parent / "python-grammar.txt", tmp_path, engine='numpy')
+
+
+if __name__ == '__main__':
+    write_small_model()
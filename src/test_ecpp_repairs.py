@@ -0,0 +1,103 @@
+"""
+Checks that the error correcting Earley parser finds the same repairs as the
+original (baseline) implementation, which were recorded in golden/, also with
+the error grammar overlays of ErrorGrammar.with_erules, and that the agenda
+strategy keeps finding the same valid repairs.
+"""
+
+import json
+from pathlib import Path
+import pytest
+from ecpp_individual_grammar import read_grammar, get_token_list, get_token_lists, fixed_lexed_prog, repair_prog, \
+    ErrorEarleyParse, ErrorGrammarCache
+from caches import RepairCache
+from seq2parse import repair
+
+SRC_DIR = Path(__file__).parent
+GOLDEN = json.loads((SRC_DIR / "golden" / "repairs-top-20-erules.json").read_text())
+
+
+@pytest.fixture(scope="module")
+def grammar():
+    grammar = read_grammar(SRC_DIR / GOLDEN["grammar"])
+    terminals = grammar.get_alphabet()
+    with open(SRC_DIR / GOLDEN["erules"], "r") as in_file:
+        erules = [line.rstrip('\n') for line in in_file if line.strip()][:GOLDEN["top_n"]]
+    grammar.update_error_grammar_with_erules(erules)
+    return grammar, terminals
+
+
+@pytest.fixture(scope="module")
+def overlay_grammar():
+    # The error grammar as the repairs get it from ErrorGrammarCache
+    grammar = read_grammar(SRC_DIR / GOLDEN["grammar"])
+    terminals = grammar.get_alphabet()
+    with open(SRC_DIR / GOLDEN["erules"], "r") as in_file:
+        erules = [line.rstrip('\n') for line in in_file if line.strip()][:GOLDEN["top_n"]]
+    return grammar.with_erules(erules), terminals
+
+
+@pytest.fixture(scope="module")
+def plain_grammar():
+    grammar = read_grammar(SRC_DIR / GOLDEN["grammar"])
+    grammar.update_error_grammar_with_erules([])
+    return grammar
+
+
+@pytest.mark.parametrize("prog_path", sorted(GOLDEN["repairs"]))
+def test_same_repairs_as_baseline(grammar, prog_path):
+    grammar, terminals = grammar
+    tokens = get_token_list((SRC_DIR / prog_path).read_text(), terminals)
+    _, _, fixed_seq_ops, _, cost = fixed_lexed_prog(tokens, grammar, GOLDEN["max_cost"])
+    expected = GOLDEN["repairs"][prog_path]
+    assert fixed_seq_ops == expected["ops"]
+    assert cost == expected["cost"]
+    assert cost is None or isinstance(cost, float)
+
+
+@pytest.mark.parametrize("prog_path", sorted(GOLDEN["repairs"]))
+def test_same_repairs_with_overlay(overlay_grammar, prog_path):
+    grammar, terminals = overlay_grammar
+    tokens = get_token_list((SRC_DIR / prog_path).read_text(), terminals)
+    _, _, fixed_seq_ops, _, cost = fixed_lexed_prog(tokens, grammar, GOLDEN["max_cost"])
+    expected = GOLDEN["repairs"][prog_path]
+    assert fixed_seq_ops == expected["ops"]
+    assert cost == expected["cost"]
+
+
+@pytest.mark.parametrize("prog_path", sorted(GOLDEN["agenda_repairs"]))
+def test_agenda_repairs(grammar, plain_grammar, prog_path):
+    # The agenda breaks ties differently than the passes (see parse_agenda),
+    # so its repairs are checked against their own recorded ones
+    grammar, terminals = grammar
+    tokens = get_token_list((SRC_DIR / prog_path).read_text(), terminals)
+    _, fixed_seq, fixed_seq_ops, _, cost = fixed_lexed_prog(tokens, grammar, GOLDEN["max_cost"], strategy="agenda")
+    expected = GOLDEN["agenda_repairs"][prog_path]
+    assert fixed_seq_ops == expected["ops"]
+    assert cost == expected["cost"]
+    passes_cost = GOLDEN["repairs"][prog_path]["cost"]
+    if passes_cost is None:
+        assert cost is None
+    else:
+        assert isinstance(cost, float)
+        assert cost <= passes_cost
+        parser = ErrorEarleyParse(fixed_seq, plain_grammar, 0)
+        parser.parse()
+        assert parser.has_parse()
+
+
+def test_repair_cache_strategy():
+    # The passes and the agenda repair orig_0 differently, so a repair cached
+    # by one strategy must not be returned for the other one
+    egrammars = ErrorGrammarCache(read_grammar(SRC_DIR / GOLDEN["grammar"]))
+    terminals = egrammars.grammar.get_alphabet()
+    with open(SRC_DIR / GOLDEN["erules"], "r") as in_file:
+        erules = [line.rstrip('\n') for line in in_file if line.strip()][:GOLDEN["top_n"]]
+    prog_path = "repairs/orig_0.py"
+    tokens, actual_tokens = get_token_lists((SRC_DIR / prog_path).read_text(), terminals)
+    repairs = RepairCache()
+    for strategy in ["passes", "agenda", "passes", "agenda"]:
+        expected = GOLDEN["repairs" if strategy == "passes" else "agenda_repairs"][prog_path]["ops"]
+        repaired_prog = repair(egrammars, GOLDEN["max_cost"], tokens, erules, actual_tokens, repairs, strategy)
+        assert repaired_prog == repair_prog(actual_tokens, expected)
+    assert repairs.stats()["hits"] == 2
@@ -0,0 +1,76 @@
+"""
+Checks that looking up symbols does not change the rules of the grammars, that
+the compiled grammars agree with the symbol checks of Grammar, and that the
+error grammar overlays are compiled as the whole error grammars.
+"""
+
+from copy import deepcopy
+from pathlib import Path
+import pytest
+from ecpp_individual_grammar import read_grammar
+
+SRC_DIR = Path(__file__).parent
+
+
+@pytest.fixture(scope="module")
+def erules():
+    with open(SRC_DIR / "top-erules.txt", "r") as in_file:
+        return [line.rstrip('\n') for line in in_file if line.strip()][:20]
+
+
+def test_lookups_do_not_add_rules(erules):
+    grammar = read_grammar(SRC_DIR / "python-grammar.txt")
+    keys = list(grammar.rules)
+    alphabet = grammar.get_alphabet()
+    grammar.get_tags()
+    grammar.prepare_error_rules()
+    grammar.with_erules(erules)
+    assert list(grammar.rules) == keys
+    assert alphabet.isdisjoint(keys)
+    assert all(grammar.is_terminal(sym) for sym in alphabet)
+    assert grammar["_NAME_"] == []
+
+
+@pytest.mark.parametrize("top_n", [0, 20])
+def test_compiled_symbols(erules, top_n):
+    grammar = read_grammar(SRC_DIR / "python-grammar.txt").with_erules(erules[:top_n])
+    keys = list(grammar.rules)
+    compiled = grammar.compiled
+    for sym_id, sym in enumerate(compiled.symbols):
+        assert compiled.terminal[sym_id] == grammar.is_terminal(sym), sym
+        assert compiled.tag[sym_id] == grammar.is_tag(sym), sym
+    assert list(grammar.rules) == keys
+
+
+def symbolic_tables(compiled):
+    """
+    Returns the rules, the flags and the scanner table of the compiled grammar
+    by their symbols, since the ids of the symbols of an overlay differ.
+    """
+    def names(ids):
+        return [compiled.symbols[s] for s in ids]
+
+    return (dict((sym, ([str(compiled.rules[crule[0]]) for crule in compiled.rules_of[s]],
+                        compiled.terminal[s], compiled.tag[s], compiled.nullable[s],
+                        compiled.error[s], sorted(names(compiled.rhs_symbols[s])),
+                        compiled.symbols[compiled.error_base[s]] if compiled.error_base[s] >= 0 else None))
+                 for s, sym in enumerate(compiled.symbols)),
+            dict((compiled.symbols[t], [(compiled.symbols[tag], str(rule), cost) for tag, (rule, _, cost) in tags.items()])
+                 for t, tags in compiled.scan_table.items()),
+            str(compiled.start[0]))
+
+
+@pytest.mark.parametrize("top_n", [0, 5, 20, 50, 201])
+def test_overlay_compiles_as_whole_grammar(top_n):
+    with open(SRC_DIR / "top-erules.txt", "r") as in_file:
+        erules = [line.rstrip('\n') for line in in_file if line.strip()][:top_n]
+    base = read_grammar(SRC_DIR / "python-grammar.txt")
+    grammar = deepcopy(base)
+    grammar.update_error_grammar_with_erules(erules)
+    base_tables = symbolic_tables(base.compile())
+    overlay = base.with_erules(erules)
+    assert dict((key, [str(r) for r in rules]) for key, rules in overlay.rules.items() if rules) == \
+        dict((key, [str(r) for r in rules]) for key, rules in grammar.rules.items() if rules)
+    assert symbolic_tables(overlay.compiled) == symbolic_tables(grammar.compiled)
+    # The overlays share the tables of the base grammar, without changing them
+    assert symbolic_tables(base.compile()) == base_tables
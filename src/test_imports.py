@@ -0,0 +1,22 @@
+"""
+Checks that the CLI and parser modules start without importing the heavy (ML)
+packages, which are only needed once the classifier or the parse trees are
+used.
+"""
+
+import sys
+import subprocess
+from pathlib import Path
+import pytest
+
+HEAVY_MODULES = ["tensorflow", "numpy", "nltk"]
+
+
+@pytest.mark.parametrize("module", ["seq2parse", "ecpp_individual_grammar", "earleyparser_interm_repr", "caches"])
+def test_no_heavy_imports(module):
+    # A fresh interpreter, since this one may have imported them already
+    result = subprocess.run([sys.executable, "-c",
+                             "import sys, " + module + "; print(' '.join(sorted(sys.modules)))"],
+                            cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+    imported = set(name.split('.')[0] for name in result.stdout.split())
+    assert imported.isdisjoint(HEAVY_MODULES), sorted(imported.intersection(HEAVY_MODULES))
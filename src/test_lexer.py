@@ -0,0 +1,41 @@
+"""
+Checks that the lexer produces the same (abstract) token lists as the original
+(baseline) Lexer, which were recorded in golden/ for a sample of the tests/
+programs, and that it puts back the strings of the programs in the actual ones,
+also of string and comment heavy programs.
+"""
+
+import json
+from pathlib import Path
+import pytest
+from ecpp_individual_grammar import read_grammar, Lexer
+
+SRC_DIR = Path(__file__).parent
+GOLDEN = json.loads((SRC_DIR / "golden" / "lexer-tests.json").read_text())
+# The abstract tokens are the baseline's in both, while the actual ones have the
+# strings of the programs (as tokenize finds them), which the baseline mixed up
+# with the quotes of the comments and other strings
+STRINGS_GOLDEN = json.loads((SRC_DIR / "golden" / "lexer-strings.json").read_text())
+
+
+@pytest.fixture(scope="module")
+def terminals():
+    return read_grammar(SRC_DIR / "python-grammar.txt").get_alphabet()
+
+
+@pytest.mark.parametrize("prog_path", sorted(GOLDEN))
+def test_same_tokens_as_baseline(terminals, prog_path):
+    prog = (SRC_DIR / prog_path).read_text()
+    expected = GOLDEN[prog_path]
+    assert Lexer(terminals).lex(prog) == expected["tokens"]
+    assert Lexer(terminals).clean_with_lex(prog) == expected["actual_tokens"]
+    assert Lexer(terminals).lex_all(prog) == (expected["tokens"], expected["actual_tokens"])
+
+
+@pytest.mark.parametrize("name", sorted(STRINGS_GOLDEN))
+def test_strings_are_put_back(terminals, name):
+    expected = STRINGS_GOLDEN[name]
+    prog = expected["program"]
+    assert Lexer(terminals).lex(prog) == expected["tokens"]
+    assert Lexer(terminals).clean_with_lex(prog) == expected["actual_tokens"]
+    assert Lexer(terminals).lex_all(prog) == (expected["tokens"], expected["actual_tokens"])
@@ -0,0 +1,54 @@
+"""
+Checks that the repairs that raise in the workers of RepairService fail
+without holding on to the budget of the pool or ending the batches.
+"""
+
+import json
+from pathlib import Path
+import pytest
+
+pytest.importorskip("pebble")
+
+from ecpp_individual_grammar import read_grammar
+from repair_service import RepairService
+
+SRC_DIR = Path(__file__).parent
+PROGRAM = (SRC_DIR / "repairs" / "orig_14.py").read_text()
+# An error rule without '->', so the worker raises when it builds the error grammar
+BAD_ERULES = ["Err_Colon"]
+
+
+class BadPredictor():
+    """
+    Predicts error rules that make the repairs raise.
+    """
+
+    def predict_batch(self, progs, max_erules=20, tokens=None):
+        return [BAD_ERULES for _ in progs]
+
+
+@pytest.fixture(scope="module")
+def service():
+    service = RepairService(read_grammar(SRC_DIR / "python-grammar.txt"), max_workers=1, max_pending=2,
+                            max_batch_pending=2, timeout=60)
+    yield service
+    service.close()
+
+
+def test_failed_repairs_release_the_budget(service):
+    # More failures than max_pending, which would all be rejected if the
+    # failed ones were still pending
+    for _ in range(4):
+        assert service.repair(PROGRAM, BAD_ERULES) == (None, 'failed')
+    metrics = service.metrics()
+    assert metrics["failures"] == 4
+    assert metrics["rejected"] == 0
+    assert not service.pending
+
+
+def test_failed_repairs_do_not_end_the_batch(service):
+    lines = [json.dumps({"id": num, "program": PROGRAM}) for num in range(5)]
+    results = list(service.repair_batch(BadPredictor(), lines, batch_size=2))
+    assert [result["id"] for result in results] == list(range(5))
+    assert all(result["repair"] == 'failed' for result in results)
+    assert not service.pending and not service.batch_pending
@@ -77,6 +77,15 @@ class TransformerClassifier(layers.Layer):
         outputs = layers.Dense(self.y_maxlen, activation=self.activation)(x)
 
         self.model = keras.Model(inputs=input, outputs=outputs)
+        # Graph-compiled forward pass for inference, built here (rather than
+        # by the first predict_fast) since the classifier is shared by threads.
+        # It is traced on its first call (tf.function traces under its own
+        # lock) and uses the model's variables, i.e. any weights loaded later.
+        # It takes the token ids as int32, which Keras casts to the (float32)
+        # input of the trained model, like predict does
+        model = self.model
+        self.forward = tf.function(lambda x: model(x, training=False),
+                                   input_signature=[tf.TensorSpec(shape=(None, self.maxlen), dtype=tf.int32)])
 
     def compile(self, optimizer='adam', loss="sparse_categorical_crossentropy", metrics=["accuracy"]):
         self.model.summary()
@@ -89,6 +98,14 @@ class TransformerClassifier(layers.Layer):
         print("predicting...", xs)
         return self.model.predict(xs)
 
+    def predict_fast(self, xs):
+        """
+        Inference-only prediction through a tf.function with a fixed
+        (None, maxlen) signature, i.e. traced once and without the per-call
+        dataset and callback overhead of predict.
+        """
+        return self.forward(tf.convert_to_tensor(xs, dtype=tf.int32)).numpy()
+
     def save_weights(self, path):
         return self.model.save_weights(path)
 